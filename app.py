@@ -1,32 +1,174 @@
+import json
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify, stream_with_context
+from sqlalchemy import literal, or_, select, union_all
 from sqlalchemy.exc import IntegrityError
 
+from archive import archived_page, init_archive
+from bulk import (ON_CONFLICT, FollowConflict, follow_users, ingest_messages,
+                  init_bulk, insert_follows, resolve_users, unfollow_users)
+from cache import cached, init_cache, invalidate
+from config import PROFILES, TestingConfig, engine_options
+from export import FORMATS, BadCursor, export_lines, init_export
+from feeds import SharedFeed
+from followgraph import (FOLLOW, UNFOLLOW, init_follow_graph,
+                         record_follow_change, record_follow_changes)
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from instrumentation import init_instrumentation
+from jobs import enqueue, init_jobs
+from metrics import init_metrics
+from recommendations import init_recommendations
+from replicas import init_replicas, reads_from_replica
+from rows import (Author, MessageRow, Profile, card_rows, message_rows,
+                  select_cards, select_messages)
+from search import init_search, search_message_ids
+from slowlog import init_slowlog
+from tags import WINDOWS, index_message, init_tags, trending, unindex_message
+from models import db, connect_db, User, Message, Follows, Likes
+import tasks  # registers the job handlers used by the routes
 
 CURR_USER_KEY = "curr_user"
-def create_app(database_name, testing=False):
-    
 
 
-    app = Flask(__name__)
+def user_counts(user_id):
+    """The user's message/following/follower/like counts, via the cache."""
 
-    # Get DB_URI from environ variable (useful for production/testing) or,
-    # if not set there, use development local db.
-    app.config['SQLALCHEMY_DATABASE_URI'] = (
-        os.environ.get('DATABASE_URL', f'postgresql:///{database_name}'))
+    return cached(f'user:{user_id}', 'counts',
+                  lambda: User.counts_for(user_id))
 
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    app.config['SQLALCHEMY_ECHO'] = False
-    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-    toolbar = DebugToolbarExtension(app)
 
-    #app.app_context().push()
-    #connect_db(app)
+def message_row(msg):
+    """MessageRow copy of the ORM Message `msg`, for a message just written."""
+
+    return MessageRow(msg.id, msg.text, msg.timestamp, msg.user_id,
+                      Author(msg.user.id, msg.user.username, msg.user.image_url))
+
+
+def user_profile(user_id):
+    """The user's Profile via the cache, or 404 if there's no such user.
+
+    Misses are cached too (as an empty dict), so a burst of requests for a
+    missing user costs one query.
+    """
+
+    def load():
+        row = db.session.execute(
+            select(*(getattr(User, field) for field in Profile._fields))
+            .where(User.id == user_id, User.deleted_at.is_(None))).first()
+        return Profile(*row) if row else {}
+
+    profile = cached(f'user:{user_id}', 'profile', load)
+    if not profile:
+        abort(404)
+    return profile
+
+
+def follow_page(user_id, followers, after, per_page):
+    """One page of the cards for who `user_id` follows (or their followers).
+
+    Keyset-paginated by user id: `after` is the last id of the previous
+    page (None for the first). Returns (cards, next cursor or None).
+    Reads only the card columns, through the follows primary key or its
+    (follower, followed) index, so a page costs the same however long the
+    list is.
+    """
+
+    if followers:
+        mine, theirs = Follows.user_being_followed_id, Follows.user_following_id
+    else:
+        mine, theirs = Follows.user_following_id, Follows.user_being_followed_id
+
+    query = (select_cards()
+             .join(Follows, theirs == User.id)
+             .where(mine == user_id)
+             .order_by(theirs)
+             .limit(per_page + 1))
+    if after is not None:
+        query = query.where(theirs > after)
+
+    cards = card_rows(db.session.execute(query))
+    if len(cards) <= per_page:
+        return cards, None
+    cards = cards[:per_page]
+    return cards, cards[-1].id
+
+
+def load_latest(size):
+    """The `size` newest messages site-wide, for the shared latest feed."""
+
+    return message_rows(db.session.execute(
+        select_messages()
+        .order_by(Message.timestamp.desc())
+        .limit(size)))
+
+
+def create_app(database_name, testing=False, profile=None):
+    """Build the Warbler app using one of the config.PROFILES.
+
+    The profile is `profile`, else "test" when `testing`, else the
+    WARBLER_PROFILE environment variable, else "dev".
+    """
+
+    if profile is None:
+        profile = 'test' if testing else os.environ.get('WARBLER_PROFILE', 'dev')
+
+    app = Flask(__name__)
+    app.config.from_object(PROFILES[profile])
+    app.config['PROFILE'] = profile
+
+    if profile == 'test':
+        app.config['SQLALCHEMY_DATABASE_URI'] = TestingConfig.database_uri()
+    else:
+        # Get DB_URI from environ variable (useful for production) or,
+        # if not set there, use development local db.
+        app.config['SQLALCHEMY_DATABASE_URI'] = (
+            os.environ.get('DATABASE_URL', f'postgresql:///{database_name}'))
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'], app.config)
+    init_replicas(app)
+
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    init_jobs(app)
+    init_instrumentation(app)
+    init_metrics(app)
+    init_slowlog(app)
+    init_cache(app)
+    init_search(app)
+    init_tags(app)
+    init_recommendations(app)
+    init_follow_graph(app)
+    init_bulk(app)
+    init_export(app)
+    init_archive(app)
+    app.config.setdefault('CACHE_TIMELINE_TTL', 30)
+    app.config.setdefault('FOLLOW_PAGE_SIZE', 48)
+
+    # The latest messages site-wide, shown to users who follow nobody and
+    # (the first few) to visitors who aren't logged in.
+    app.config.setdefault('LATEST_FEED_INTERVAL', 10)
+    app.config.setdefault('LATEST_FEED_MAX_STALE', 300)
+    app.config.setdefault('LATEST_FEED_BACKGROUND', True)
+    app.config.setdefault('LATEST_TEASER_SIZE', 10)
+    latest_feed = app.extensions['latest_feed'] = SharedFeed(
+        load_latest,
+        interval=app.config['LATEST_FEED_INTERVAL'],
+        max_stale=app.config['LATEST_FEED_MAX_STALE'],
+        background=app.config['LATEST_FEED_BACKGROUND'])
+
+    if profile == 'test':
+        connect_db(app)
+
+    @app.cli.command('create-schema')
+    def create_schema():
+        """Create any missing tables and indexes."""
+
+        db.create_all()
 
 
     ##############################################################################
@@ -39,6 +181,8 @@ def create_app(database_name, testing=False):
 
         if CURR_USER_KEY in session:
             g.user = User.query.get(session[CURR_USER_KEY])
+            if g.user is not None and g.user.deleted_at is not None:
+                g.user = None
 
         else:
             g.user = None
@@ -80,6 +224,7 @@ def create_app(database_name, testing=False):
                     image_url=form.image_url.data or User.image_url.default.arg,
                 )
                 db.session.commit()
+                invalidate('users', f'user:{user.id}')
 
             except IntegrityError:
                 flash("Username already taken", 'danger')
@@ -129,6 +274,7 @@ def create_app(database_name, testing=False):
     # General user routes:
 
     @app.route('/users')
+    @reads_from_replica
     def list_users():
         """Page with listing of users.
 
@@ -137,54 +283,104 @@ def create_app(database_name, testing=False):
 
         search = request.args.get('q')
 
-        if not search:
-            users = User.query.all()
-        else:
-            users = User.query.filter(User.username.like(f"%{search}%")).all()
+        def find_users():
+            query = select_cards()
+            if search:
+                # Case-insensitive on every backend (SQLite's LIKE already
+                # is, Postgres' isn't); % and _ are taken literally.
+                query = query.where(User.username.icontains(search,
+                                                            autoescape=True))
+            return card_rows(db.session.execute(query))
+
+        users = cached('users', f'search:{search or ""}', find_users)
 
-        return render_template('users/index.html', users=users)
+        following_ids = g.user.following_ids() if g.user else set()
+        return render_template('users/index.html', users=users,
+                               following_ids=following_ids)
 
 
     @app.route('/users/<int:user_id>')
+    @reads_from_replica
     def users_show(user_id):
         """Show user profile."""
 
-        user = User.query.get_or_404(user_id)
+        user = user_profile(user_id)
 
-        # snagging messages in order from the database;
-        # user.messages won't be in order by default
-        messages = (Message
-                    .query
-                    .filter(Message.user_id == user_id)
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        likes = g.user.likes
-        return render_template('users/show.html', user=user, messages=messages, likes=likes)
+        def latest_messages():
+            # snagging messages in order from the database;
+            # user.messages won't be in order by default
+            return message_rows(db.session.execute(
+                select_messages()
+                .where(Message.user_id == user_id)
+                .order_by(Message.timestamp.desc())
+                .limit(100)))
 
+        messages = cached(f'user:{user_id}', 'messages', latest_messages)
+        followed_ids = (g.user.following_ids(among=[user_id])
+                        if g.user else set())
+        return render_template('users/show.html', user=user, messages=messages,
+                               counts=user_counts(user_id),
+                               followed_ids=followed_ids)
 
-    @app.route('/users/<int:user_id>/following')
-    def show_following(user_id):
-        """Show list of people this user is following."""
+
+    @app.route('/users/<int:user_id>/archive')
+    @reads_from_replica
+    def users_archive(user_id):
+        """Show a user's archived messages, newest first; see archive.py.
+
+        ?before= is the cursor from the previous page.
+        """
+
+        user = user_profile(user_id)
+
+        try:
+            messages, next_before = archived_page(
+                user_id, request.args.get('before'),
+                app.config['ARCHIVE_PAGE_SIZE'])
+        except ValueError:
+            abort(400)
+
+        followed_ids = (g.user.following_ids(among=[user_id])
+                        if g.user else set())
+        return render_template('users/show.html', user=user, messages=messages,
+                               archived=True, next_before=next_before,
+                               counts=user_counts(user_id),
+                               followed_ids=followed_ids)
+
+
+    def follow_list(user_id, followers, template):
+        """Render one page of a user's following or followers list."""
 
         if not g.user:
             flash("Access unauthorized.", "danger")
             return redirect("/")
 
-        user = User.query.get_or_404(user_id)
-        return render_template('users/following.html', user=user)
+        user = user_profile(user_id)
+        after = request.args.get('after', type=int)
+        cards, next_after = follow_page(user_id, followers, after,
+                                        app.config['FOLLOW_PAGE_SIZE'])
+
+        # The viewer's follow state for the whole page, in one lookup.
+        followed_ids = g.user.following_ids(
+            among=[user_id] + [card.id for card in cards])
+        return render_template(template, user=user, cards=cards,
+                               after=after, next_after=next_after,
+                               counts=user_counts(user_id),
+                               followed_ids=followed_ids)
+
+
+    @app.route('/users/<int:user_id>/following')
+    def show_following(user_id):
+        """Show list of people this user is following."""
+
+        return follow_list(user_id, False, 'users/following.html')
 
 
     @app.route('/users/<int:user_id>/followers')
     def users_followers(user_id):
         """Show list of followers of this user."""
 
-        if not g.user:
-            flash("Access unauthorized.", "danger")
-            return redirect("/")
-
-        user = User.query.get_or_404(user_id)
-        return render_template('users/followers.html', user=user)
+        return follow_list(user_id, True, 'users/followers.html')
 
 
     @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -195,11 +391,18 @@ def create_app(database_name, testing=False):
             flash("Access unauthorized.", "danger")
             return redirect("/")
 
-        followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
+        User.query.filter_by(id=follow_id, deleted_at=None).first_or_404()
+        user_id = g.user.id
+        # Not is_following(): the shared graph can trail the table.
+        added = insert_follows([dict(user_following_id=user_id,
+                                     user_being_followed_id=follow_id)])
         db.session.commit()
+        if added:
+            record_follow_change(FOLLOW, user_id, follow_id)
+            db.session.commit()
+        invalidate(f'user:{user_id}', f'user:{follow_id}')
 
-        return redirect(f"/users/{g.user.id}/following")
+        return redirect(f"/users/{user_id}/following")
 
 
     @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
@@ -210,11 +413,70 @@ def create_app(database_name, testing=False):
             flash("Access unauthorized.", "danger")
             return redirect("/")
 
-        followed_user = User.query.get(follow_id)
-        g.user.following.remove(followed_user)
+        user_id = g.user.id
+        db.session.execute(
+            db.delete(Follows)
+            .where(Follows.user_following_id == user_id,
+                   Follows.user_being_followed_id == follow_id)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        record_follow_change(UNFOLLOW, user_id, follow_id)
+        db.session.commit()
+        invalidate(f'user:{user_id}', f'user:{follow_id}')
+
+        return redirect(f"/users/{user_id}/following")
+
+
+    @app.route('/api/follows', methods=['POST'])
+    def bulk_follows():
+        """Follow or unfollow many users at once; see bulk.py. JSON in and out."""
+
+        if not g.user:
+            return jsonify(error="Login required."), 401
+
+        # Requiring a JSON body also keeps cross-site form posts out.
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return jsonify(error="Expected a JSON object."), 400
+
+        action = body.get('action', 'follow')
+        users = body.get('users')
+        on_conflict = body.get('on_conflict', 'ignore')
+        if (action not in ('follow', 'unfollow')
+                or on_conflict not in ON_CONFLICT
+                or not isinstance(users, list)
+                or not all(isinstance(ref, (int, str)) for ref in users)):
+            return jsonify(error="Bad action, on_conflict or users."), 400
+        if len(users) > app.config['BULK_FOLLOW_MAX']:
+            return jsonify(error=f"At most {app.config['BULK_FOLLOW_MAX']} "
+                                 "users per request."), 413
+
+        user_id = g.user.id
+        user_ids, missing = resolve_users(users)
+        try:
+            if action == 'follow':
+                changed = follow_users(user_id, user_ids, on_conflict)
+            else:
+                changed = unfollow_users(user_id, user_ids)
+            db.session.commit()
+        except (FollowConflict, IntegrityError) as exc:
+            db.session.rollback()
+            conflicts = getattr(exc, 'user_ids', None)
+            return jsonify(error="Already following some of these users.",
+                           conflicts=conflicts), 409
+
+        op = FOLLOW if action == 'follow' else UNFOLLOW
+        record_follow_changes([(op, user_id, target) for target in changed])
         db.session.commit()
+        if changed:
+            invalidate(f'user:{user_id}',
+                       *(f'user:{target}' for target in changed))
 
-        return redirect(f"/users/{g.user.id}/following")
+        changed_ids = set(changed)
+        return jsonify(action=action, changed=changed,
+                       unchanged=[target for target in user_ids
+                                  if target not in changed_ids],
+                       missing=missing)
 
 
     @app.route('/users/profile', methods=["GET", "POST"])
@@ -241,6 +503,7 @@ def create_app(database_name, testing=False):
                 user.bio = form.bio.data
                 db.session.add(user)
                 db.session.commit()
+                invalidate('users', f'user:{user.id}')
                 flash(f'Changes updated', "info")
                 return redirect(f'/users/{g.user.id}')
             
@@ -261,12 +524,47 @@ def create_app(database_name, testing=False):
 
         do_logout()
 
-        db.session.delete(g.user)
+        # Hide the account straight away. Removing its messages, likes and
+        # follows can be a lot of work; let a job worker do it instead of
+        # this request.
+        user_id = g.user.id
+        g.user.deleted_at = datetime.utcnow()
+        enqueue('delete_user', {'user_id': user_id},
+                idempotency_key=f"delete_user:{user_id}")
         db.session.commit()
+        invalidate('users', f'user:{user_id}')
+        latest_feed.clear()
 
         return redirect("/signup")
 
 
+    @app.route('/users/export')
+    @reads_from_replica
+    def users_export():
+        """Stream the current user's data as ?format= ndjson or csv; see export.py.
+
+        ?after= resumes after a record's cursor.
+        """
+
+        if not g.user:
+            flash("Access unauthorized.", "danger")
+            return redirect("/")
+
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in FORMATS:
+            abort(400)
+
+        try:
+            chunks = export_lines(g.user.id, fmt, request.args.get('after'))
+        except BadCursor:
+            abort(400)
+
+        filename = f'warbler-{g.user.username}.{fmt}'
+        return app.response_class(
+            stream_with_context(chunks), mimetype=FORMATS[fmt],
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
     ##############################################################################
     # Messages routes:
 
@@ -284,21 +582,108 @@ def create_app(database_name, testing=False):
         form = MessageForm()
 
         if form.validate_on_submit():
-            msg = Message(text=form.text.data)
-            g.user.messages.append(msg)
+            user_id = g.user.id
+            msg = Message(text=form.text.data, user_id=user_id)
+            db.session.add(msg)
+            db.session.flush()
+            index_message(msg)
+            row = message_row(msg)
             db.session.commit()
+            invalidate(f'user:{user_id}')
+            latest_feed.push(row)
 
-            return redirect(f"/users/{g.user.id}")
+            return redirect(f"/users/{user_id}")
 
         return render_template('messages/new.html', form=form)
 
 
+    @app.route('/api/messages', methods=['POST'])
+    def messages_ingest():
+        """Post many messages from an NDJSON body; see bulk.py."""
+
+        if not g.user:
+            return jsonify(error="Login required."), 401
+
+        # Like /api/follows, a body a cross-site form can't send.
+        if request.mimetype != 'application/x-ndjson':
+            return jsonify(error="Expected application/x-ndjson."), 415
+
+        user_id = g.user.id
+        batches = ingest_messages(
+            user_id, request.stream, app.config['INGEST_BATCH_SIZE'],
+            app.config['INGEST_MAX_ITEMS'])
+
+        def respond():
+            # Each batch's results go out as soon as it commits, so a client
+            # whose request fails part way knows which lines were saved.
+            try:
+                for results, messages in batches:
+                    rows = [message_row(msg) for msg in messages]
+                    db.session.commit()
+
+                    if rows:
+                        invalidate(f'user:{user_id}')
+                        for row in rows[-latest_feed.size:]:
+                            latest_feed.push(row)
+
+                    yield ''.join(json.dumps(result) + '\n'
+                                  for result in results)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Ingest failed for user %s", user_id)
+                yield json.dumps({'error': "Ingest failed; lines without a "
+                                           "result above were not saved."}) + '\n'
+
+        return app.response_class(stream_with_context(respond()),
+                                  mimetype='application/x-ndjson')
+
+
+    @app.route('/messages/search')
+    @reads_from_replica
+    def messages_search():
+        """Search messages' text; ranked best match first, a page at a time."""
+
+        q = request.args.get('q', '')
+        page = max(request.args.get('page', 1, type=int), 1)
+
+        ids, has_more = search_message_ids(q, page,
+                                           app.config['SEARCH_PER_PAGE'])
+
+        # One query for the page's messages and their authors.
+        found = message_rows(db.session.execute(
+            select_messages().where(Message.id.in_(ids)))) if ids else []
+        rows = {msg.id: msg for msg in found}
+        messages = [rows[message_id] for message_id in ids
+                    if message_id in rows]
+
+        return render_template('messages/search.html', q=q, page=page,
+                               messages=messages, has_more=has_more)
+
+
     @app.route('/messages/<int:message_id>', methods=["GET"])
+    @reads_from_replica
     def messages_show(message_id):
         """Show a message."""
 
-        msg = Message.query.get_or_404(message_id)
-        return render_template('messages/show.html', message=msg)
+        def load():
+            found = message_rows(db.session.execute(
+                select_messages().where(Message.id == message_id)))
+            if not found:
+                # Misses aren't cached: ids are sequential, so the next
+                # message posted may well be this one.
+                abort(404)
+            return found[0]
+
+        # Popular permalinks get hit by many visitors at once; the cache
+        # makes sure only one of them queries for the message.
+        msg = cached(f'message:{message_id}', 'row', load)
+
+        # The row's copy of the author may be stale; take the cached profile.
+        msg = msg._replace(user=user_profile(msg.user_id))
+        followed_ids = (g.user.following_ids(among=[msg.user_id])
+                        if g.user else set())
+        return render_template('messages/show.html', message=msg,
+                               followed_ids=followed_ids)
 
 
     @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -314,11 +699,28 @@ def create_app(database_name, testing=False):
             flash("Access unauthorized.", "danger")
             return redirect("/")
                     
+        unindex_message(msg)
         db.session.delete(msg)
         db.session.commit()
+        invalidate(f'user:{g.user.id}', f'message:{message_id}')
+        latest_feed.remove(message_id)
         flash("Message Deleted", "info")
         return redirect(f"/users/{g.user.id}")
 
+    @app.route('/trending')
+    @reads_from_replica
+    def trending_tags():
+        """Most used tags over ?window= 1h, 24h (the default) or 7d, as JSON."""
+
+        window = request.args.get('window', '24h')
+        if window not in WINDOWS:
+            abort(400)
+
+        tags = cached('trending', window, lambda: trending(window),
+                      ttl=app.config['TRENDING_CACHE_TTL'])
+        return jsonify(window=window, tags=tags)
+
+
     ##############################################################################
     # Likes routes:
 
@@ -330,12 +732,12 @@ def create_app(database_name, testing=False):
             flash("Access unauthorized.", "danger")
             return redirect("/")
         
-        msg = Message.query.get(message_id)
-        """        followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
-        db.session.commit()"""
-        g.user.likes.append(msg)
-        db.session.commit()
+        msg = Message.query.get_or_404(message_id)
+        if not g.user.liked_ids(among=[msg.id]):
+            user_id = g.user.id
+            db.session.add(Likes(user_id=user_id, message_id=msg.id))
+            db.session.commit()
+            invalidate(f'user:{user_id}')
         if(request.referrer):
             return redirect(request.referrer)
         return redirect('/')
@@ -346,46 +748,60 @@ def create_app(database_name, testing=False):
 
 
     @app.route('/')
+    @reads_from_replica
     def homepage():
         """Show homepage:
 
-        - anon users: no messages
+        - anon users: a teaser of the latest messages
+        - logged in, following nobody: the latest messages site-wide
         - logged in: 100 most recent messages of followed_users
         """
-        #import pdb; pdb.set_trace()
-        if g.user:
-            if g.user.following != []:
-                user_ids = []
-                for user in g.user.following:
-                    user_ids.append(user.id)
-                user_ids.append(g.user.id) 
-                messages = (Message
-                            .query
-                            .filter(Message.user_id.in_(user_ids))
-                            .order_by(Message.timestamp.desc())
-                            .limit(100)
-                            .all())
-                messages += (Message
-                            .query
-                            .filter(Message.user_id.not_in(user_ids))
-                            .order_by(Message.timestamp.desc())
-                            .limit(100 - len(messages))
-                            .all())
-            else:
-                messages = (Message
-                            .query
-                            .order_by(Message.timestamp.desc())
-                            .limit(100)
-                            .all())
-            likes = []    
-            for like in g.user.likes:
-                likes.append(like.id)
-            print(likes)
-            return render_template('home.html', messages=messages, likes=likes)
+        if not g.user:
+            teaser = latest_feed.rows()[:app.config['LATEST_TEASER_SIZE']]
+            return render_template('home-anon.html', messages=teaser)
 
+        # Counts and "who to follow" in one query and one cache entry.
+        counts = cached(f'user:{g.user.id}', 'home',
+                        lambda: User.counts_for(g.user.id, suggestions=5))
+
+        if not counts['following']:
+            messages = latest_feed.rows()
         else:
-            return render_template('home-anon.html')
-        
+            def load_timeline():
+                # Followed users' (and our own) latest messages come first;
+                # anything short of 100 is filled with everyone else's.
+                # Both halves run as one UNION ALL statement.
+                followed_ids = (select(Follows.user_being_followed_id)
+                                .where(Follows.user_following_id == g.user.id))
+                in_feed = or_(Message.user_id == g.user.id,
+                              Message.user_id.in_(followed_ids))
+
+                def latest(condition, rank):
+                    return select(select(Message.id,
+                                         Message.timestamp,
+                                         literal(rank).label('rank'))
+                                  .where(condition)
+                                  .order_by(Message.timestamp.desc())
+                                  .limit(100)
+                                  .subquery())
+
+                timeline = union_all(latest(in_feed, 0),
+                                     latest(~in_feed, 1)).subquery()
+                return message_rows(db.session.execute(
+                    select_messages()
+                    .join(timeline, timeline.c.id == Message.id)
+                    .order_by(timeline.c.rank, timeline.c.timestamp.desc())
+                    .limit(100)))
+
+            # Our own posts and follows invalidate this straight away; other
+            # people's new messages show up within CACHE_TIMELINE_TTL.
+            messages = cached(f'user:{g.user.id}', 'timeline', load_timeline,
+                              ttl=app.config['CACHE_TIMELINE_TTL'])
+
+        likes = g.user.liked_ids(among=[msg.id for msg in messages])
+        return render_template('home.html', messages=messages, likes=likes,
+                               counts=counts, suggestions=counts['suggestions'])
+
     @app.errorhandler(404)
     def page_not_found(e):
         return render_template('404.html'), 404
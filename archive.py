@@ -0,0 +1,257 @@
+"""Hot/cold tiering of messages.
+
+``messages`` holds only the last ``MESSAGES_HOT_DAYS`` days of warbles.
+Timelines, profiles, search and trending read only that table, so routine
+page loads touch hot data however many years of history there are.
+Anything older is moved, a batch at a time, into ``messages_archive``, and
+its likes go to ``likes_archive``:
+
+    flask --app server archive run
+
+Archived messages still count towards profile totals, are listed on each
+user's "older warbles" page and are part of account exports. They are no
+longer searchable, likeable or shown one at a time.
+
+On Postgres ``messages_archive`` is natively partitioned by month.
+``archive run`` creates the partitions it needs, and queries bounded by
+time (the older-warbles page) only read the months they cover. Partitions
+can be created ahead of time, and whole old months can be detached into
+standalone tables, to dump and drop or to move to cheaper storage:
+
+    flask --app server archive partitions --ahead 3
+    flask --app server archive detach --before 2020-01
+
+SQLite has no partitioning, so there the archive is a single table. It
+keeps the same split between hot and cold data.
+"""
+
+import sys
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, insert, select, text, union
+
+from cache import invalidate
+from models import db, writes, ArchivedLike, ArchivedMessage, Likes, Message
+from tags import WINDOWS
+
+archive_cli = AppGroup('archive', help="Move old messages to the archive.")
+
+
+def hot_cutoff(now=None):
+    """Messages older than this belong in the archive."""
+
+    days = current_app.config['MESSAGES_HOT_DAYS']
+    return (now or datetime.utcnow()) - timedelta(days=days)
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'messages_archive_{month:%Y_%m}'
+
+
+def _postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def ensure_partitions(first, last):
+    """Make sure there are archive partitions for every month first..last.
+
+    Does nothing except on Postgres. Returns the names of new partitions.
+    """
+
+    if not _postgres():
+        return []
+
+    existing = set(_partitions())
+    created = []
+    month = month_start(first)
+    while month <= last:
+        name = partition_name(month)
+        if name not in existing:
+            db.session.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} "
+                f"PARTITION OF messages_archive "
+                f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+                f"TO ('{next_month(month):%Y-%m-%d}')"))
+            created.append(name)
+        month = next_month(month)
+    return created
+
+
+def _partitions():
+    """Names of the partitions attached to messages_archive (Postgres)."""
+
+    return db.session.scalars(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'messages_archive' "
+        "ORDER BY child.relname")).all()
+
+
+def archive_messages(cutoff, batch_size):
+    """Move messages older than `cutoff` and their likes into the archive.
+
+    One short transaction per `batch_size` messages, oldest first; safe to
+    stop and re-run. Returns how many messages were moved.
+    """
+
+    # Trending counters are left as they are, so only messages past every
+    # trending window may go.
+    if cutoff > datetime.utcnow() - max(WINDOWS.values()):
+        raise ValueError("Can't archive messages that are still trending.")
+
+    moved = 0
+
+    with writes():
+        while True:
+            batch = db.session.execute(
+                select(Message.id, Message.timestamp)
+                .where(Message.timestamp < cutoff)
+                .order_by(Message.timestamp)
+                .limit(batch_size)).all()
+            if not batch:
+                return moved
+
+            ids = [message_id for message_id, _ in batch]
+            ensure_partitions(batch[0].timestamp, batch[-1].timestamp)
+
+            # Everyone whose counts or timelines change.
+            user_ids = db.session.scalars(union(
+                select(Message.user_id).where(Message.id.in_(ids)),
+                select(Likes.user_id).where(Likes.message_id.in_(ids)))).all()
+
+            db.session.execute(insert(ArchivedMessage).from_select(
+                ['id', 'timestamp', 'text', 'user_id'],
+                select(Message.id, Message.timestamp, Message.text,
+                       Message.user_id)
+                .where(Message.id.in_(ids))))
+            db.session.execute(insert(ArchivedLike).from_select(
+                ['user_id', 'message_id'],
+                select(Likes.user_id, Likes.message_id)
+                .where(Likes.message_id.in_(ids))))
+
+            # Likes, tags, mentions and the search index go by cascade.
+            db.session.execute(
+                delete(Message)
+                .where(Message.id.in_(ids))
+                .execution_options(synchronize_session=False))
+            db.session.commit()
+
+            invalidate(*(f'user:{user_id}' for user_id in user_ids),
+                       *(f'message:{message_id}' for message_id in ids))
+            moved += len(ids)
+
+
+def archived_page(user_id, before, per_page):
+    """A page of `user_id`'s archived messages, newest first.
+
+    Keyset-paginated: `before` is the cursor returned with the previous
+    page, or None for the first. Returns (rows, cursor for the next page or
+    None). A malformed `before` raises ValueError.
+    """
+
+    query = (select(ArchivedMessage.id, ArchivedMessage.text,
+                    ArchivedMessage.timestamp)
+             .where(ArchivedMessage.user_id == user_id)
+             .order_by(ArchivedMessage.timestamp.desc(),
+                       ArchivedMessage.id.desc())
+             .limit(per_page + 1))
+    if before:
+        timestamp, _, message_id = before.rpartition('/')
+        timestamp, message_id = datetime.fromisoformat(timestamp), int(message_id)
+        # The bound on timestamp alone lets Postgres skip newer partitions.
+        query = query.where(
+            ArchivedMessage.timestamp <= timestamp,
+            (ArchivedMessage.timestamp < timestamp)
+            | (ArchivedMessage.id < message_id))
+
+    rows = [row._asdict() for row in db.session.execute(query)]
+    if len(rows) <= per_page:
+        return rows, None
+
+    rows = rows[:per_page]
+    return rows, f"{rows[-1]['timestamp'].isoformat()}/{rows[-1]['id']}"
+
+
+def detach_partitions(before):
+    """Detach archive partitions for months wholly before `before`.
+
+    Postgres only. The detached tables stay in the database, as ordinary
+    tables, until they are dumped and dropped. Returns their names.
+    """
+
+    if not _postgres():
+        raise RuntimeError("Partitions are only used on Postgres.")
+
+    cutoff = partition_name(month_start(before))
+    detached = [name for name in _partitions() if name < cutoff]
+    for name in detached:
+        db.session.execute(text(
+            f"ALTER TABLE messages_archive DETACH PARTITION {name}"))
+    db.session.commit()
+    return detached
+
+
+@archive_cli.command('run')
+@click.option('--days', type=int,
+              help="Keep this many days hot (default MESSAGES_HOT_DAYS).")
+def run_command(days):
+    """Move messages past the hot window into the archive."""
+
+    cutoff = (hot_cutoff() if days is None
+              else datetime.utcnow() - timedelta(days=days))
+    try:
+        moved = archive_messages(cutoff, current_app.config['ARCHIVE_BATCH_SIZE'])
+    except ValueError as exc:
+        sys.exit(str(exc))
+    click.echo(f"Archived {moved} messages.")
+
+
+@archive_cli.command('partitions')
+@click.option('--ahead', type=int, default=3,
+              help="Months past the one now being archived to create.")
+def partitions_command(ahead):
+    """Create the archive partitions the next --ahead months of runs need."""
+
+    first = last = month_start(hot_cutoff())
+    for _ in range(ahead):
+        last = next_month(last)
+
+    created = ensure_partitions(first, last)
+    db.session.commit()
+    click.echo(f"Created {len(created)} partitions.")
+
+
+@archive_cli.command('detach')
+@click.option('--before', required=True,
+              type=click.DateTime(formats=['%Y-%m']),
+              help="Detach months before this one (YYYY-MM).")
+def detach_command(before):
+    """Detach archive partitions for months before --before."""
+
+    try:
+        detached = detach_partitions(before)
+    except RuntimeError as exc:
+        sys.exit(str(exc))
+    for name in detached:
+        click.echo(f"Detached {name}.")
+
+
+def init_archive(app):
+    """Register the archive CLI on `app` and apply default config."""
+
+    app.config.setdefault('MESSAGES_HOT_DAYS', 90)
+    app.config.setdefault('ARCHIVE_BATCH_SIZE', 1000)
+    app.config.setdefault('ARCHIVE_PAGE_SIZE', 100)
+    app.cli.add_command(archive_cli)
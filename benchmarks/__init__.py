@@ -0,0 +1,9 @@
+"""Performance benchmarks for Warbler.
+
+Run them from the repo root, e.g.:
+
+    python -m benchmarks.routes --dataset medium --out bench_output.txt
+    python -m benchmarks.compare before.json after.json
+    python -m benchmarks.startup --out startup.json
+    python -m benchmarks.rows --dataset medium --out rows.json
+"""
@@ -0,0 +1,63 @@
+"""Compare two benchmark result files and flag regressions.
+
+    python -m benchmarks.compare before.json after.json --threshold 10
+
+Prints the change in each route's numbers and exits with status 1 if any
+latency percentile got more than `--threshold` percent slower, or any route
+now issues more queries per request.
+"""
+
+import argparse
+import json
+import sys
+
+LATENCY_KEYS = ('p50_ms', 'p95_ms', 'p99_ms')
+REPORTED_KEYS = LATENCY_KEYS + ('throughput_rps', 'queries_per_request')
+
+
+def compare(before, after, threshold):
+    """Return (report lines, regression lines) for two result dicts."""
+
+    report = []
+    regressions = []
+
+    for route, new in after['routes'].items():
+        old = before['routes'].get(route)
+        if old is None:
+            report.append(f"{route}: new route")
+            continue
+
+        for key in REPORTED_KEYS:
+            change = ((new[key] - old[key]) / old[key] * 100) if old[key] else 0
+            line = f"{route:20} {key:20} {old[key]:>10} -> {new[key]:>10} ({change:+.1f}%)"
+            report.append(line)
+
+            if key in LATENCY_KEYS and change > threshold:
+                regressions.append(line)
+            if key == 'queries_per_request' and new[key] > old[key]:
+                regressions.append(line)
+
+    return report, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="Allowed latency increase, in percent.")
+    args = parser.parse_args(argv)
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+
+    report, regressions = compare(before, after, args.threshold)
+    print('\n'.join(report))
+
+    if regressions:
+        print("\nRegressions:\n" + '\n'.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
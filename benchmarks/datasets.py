@@ -0,0 +1,88 @@
+"""Seed benchmark databases from the generator CSVs.
+
+The ``small`` dataset is exactly what seed.py loads. ``medium`` and
+``large`` repeat those users and messages several times over (renaming users
+so they stay unique) and draw proportionally more random follows, so the
+shape of the data stays the same while the volume grows.
+"""
+
+import csv
+import random
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from models import db, User, Message, Follows
+
+GENERATOR_DIR = 'generator'
+
+# Copies of the generator data in each dataset.
+DATASETS = {
+    'small': 1,
+    'medium': 10,
+    'large': 50,
+}
+
+
+def _read_csv(name):
+    with open(f'{GENERATOR_DIR}/{name}.csv') as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def seed(dataset, seed_value=0):
+    """Drop and recreate all tables, then load `dataset`.
+
+    Users get ids 1..n in file order, which the messages and follows rely on.
+
+    Must be called inside an app context. Returns a dict of row counts.
+    """
+
+    copies = DATASETS[dataset]
+    rng = random.Random(seed_value)
+
+    users = _read_csv('users')
+    messages = _read_csv('messages')
+    num_follows = len(_read_csv('follows')) * copies
+
+    db.drop_all()
+    db.create_all()
+
+    user_rows = []
+    for copy in range(copies):
+        for user in users:
+            suffix = f'{copy}' if copy else ''
+            user_rows.append(dict(
+                user,
+                username=f"{user['username']}{suffix}",
+                email=f"{suffix}{user['email']}",
+            ))
+    db.session.execute(insert(User), user_rows)
+
+    num_users = len(user_rows)
+    message_rows = []
+    for copy in range(copies):
+        for message in messages:
+            message_rows.append(dict(
+                text=message['text'],
+                timestamp=datetime.fromisoformat(message['timestamp']),
+                user_id=int(message['user_id']) + copy * len(users),
+            ))
+    db.session.execute(insert(Message), message_rows)
+
+    follow_pairs = set()
+    while len(follow_pairs) < num_follows:
+        followed, follower = rng.randint(1, num_users), rng.randint(1, num_users)
+        if followed != follower:
+            follow_pairs.add((followed, follower))
+    db.session.execute(insert(Follows), [
+        dict(user_being_followed_id=followed, user_following_id=follower)
+        for followed, follower in sorted(follow_pairs)
+    ])
+
+    db.session.commit()
+
+    return {
+        'users': num_users,
+        'messages': len(message_rows),
+        'follows': len(follow_pairs),
+    }
@@ -0,0 +1,97 @@
+"""Shared plumbing for the benchmark scripts."""
+
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+from instrumentation import record_queries
+
+
+def make_app(database_url=None, profile='prod', cache=True):
+    """Create a Warbler app pointed at `database_url` for benchmarking.
+
+    Defaults to a throwaway SQLite file and the production profile, which
+    doesn't create the schema; the benchmarks build their own. CSRF and the
+    slow query log are switched off so they don't skew the numbers. Without
+    `cache`, every request does its full work: benchmarks that rebuild the
+    database between measurements would otherwise read entries cached from
+    the previous build.
+    """
+
+    if database_url is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='warbler-bench-'), 'bench.db')
+        database_url = f'sqlite:///{path}'
+
+    os.environ['DATABASE_URL'] = database_url
+    # The benchmarks drive the app from this one process.
+    os.environ.setdefault('CACHE_SINGLE_PROCESS', '1')
+
+    from app import create_app
+    from models import connect_db
+
+    app = create_app('warbler-bench', profile=profile)
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['SLOW_QUERY_MS'] = None
+    app.config['CACHE_ENABLED'] = cache
+    # N+1 warnings for every request would drown the report.
+    logging.getLogger('warbler.sql').setLevel(logging.ERROR)
+    connect_db(app)
+    return app
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (which need not be sorted)."""
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def timed_request(client, method, path):
+    """Issue one request; return (seconds, queries, status code)."""
+
+    with record_queries() as stats:
+        start = time.perf_counter()
+        response = client.open(path, method=method)
+        elapsed = time.perf_counter() - start
+    return elapsed, stats.count, response.status_code
+
+
+def summarize(latencies, queries, errors, wall_seconds):
+    """Reduce raw per-request samples to the numbers we report."""
+
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / count * 1000, 3) if count else 0,
+        'throughput_rps': round(count / wall_seconds, 1) if wall_seconds else 0,
+        'queries_per_request': round(sum(queries) / count, 2) if count else 0,
+    }
+
+
+def environment():
+    """Describe what was benchmarked, so results can be compared later."""
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'at': datetime.utcnow().isoformat(),
+    }
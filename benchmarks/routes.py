@@ -0,0 +1,134 @@
+"""End-to-end route benchmarks.
+
+Seeds a dataset, then drives the main routes through the Flask test client
+from `--concurrency` threads, each logged in as a different user, and
+reports latency percentiles, throughput and queries per request as JSON:
+
+    python -m benchmarks.routes --dataset small --requests 200 --out a.json
+
+Point `--database-url` at a Postgres database to benchmark against it; the
+default is a temporary SQLite file.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import CURR_USER_KEY
+from benchmarks.datasets import DATASETS, seed
+from benchmarks.harness import environment, make_app, summarize, timed_request
+from models import db, User, Message
+
+# name -> (method, path template). {user} is a random user id and {message}
+# a message id nobody has liked yet.
+ROUTES = {
+    'home': ('GET', '/'),
+    'users_list': ('GET', '/users'),
+    'users_show': ('GET', '/users/{user}'),
+    'users_followers': ('GET', '/users/{user}/followers'),
+    'messages_new': ('GET', '/messages/new'),
+    'add_like': ('POST', '/users/add_like/{message}'),
+}
+
+
+def run_route(app, method, template, user_ids, message_ids, requests, concurrency):
+    """Fire `requests` requests at one route; return the summary dict."""
+
+    latencies = []
+    queries = []
+    errors = 0
+    lock = threading.Lock()
+
+    # Only routes that like a message use one up.
+    liking = '{message}' in template
+    if liking and requests > len(message_ids):
+        raise ValueError(f"{requests} requests but only {len(message_ids)} "
+                         f"unliked messages")
+    unliked = iter(message_ids)
+
+    def worker(count):
+        nonlocal errors
+
+        client = app.test_client()
+        viewer = random.choice(user_ids)
+        with client.session_transaction() as session:
+            session[CURR_USER_KEY] = viewer
+
+        for _ in range(count):
+            message = None
+            if liking:
+                with lock:
+                    message = next(unliked)
+            path = template.format(user=random.choice(user_ids), message=message)
+
+            elapsed, num_queries, status = timed_request(client, method, path)
+
+            with lock:
+                latencies.append(elapsed)
+                queries.append(num_queries)
+                if status >= 400:
+                    errors += 1
+
+    shares = [requests // concurrency + (i < requests % concurrency)
+              for i in range(concurrency)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, shares))
+    wall = time.perf_counter() - start
+
+    return summarize(latencies, queries, errors, wall)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dataset', choices=DATASETS, default='small')
+    parser.add_argument('--database-url')
+    parser.add_argument('--requests', type=int, default=200,
+                        help="Requests per route.")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--routes', nargs='*', choices=ROUTES,
+                        default=list(ROUTES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="Write JSON results here too.")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    app = make_app(args.database_url)
+
+    with app.app_context():
+        counts = seed(args.dataset, args.seed)
+        user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+        message_ids = [message_id for (message_id,)
+                       in db.session.query(Message.id).order_by(Message.id)]
+
+    results = {
+        'environment': environment(),
+        'dataset': dict(counts, name=args.dataset),
+        'concurrency': args.concurrency,
+        'routes': {},
+    }
+
+    for name in args.routes:
+        method, template = ROUTES[name]
+        # Warm caches and connection pools before measuring, liking
+        # messages the measured run won't.
+        run_route(app, method, template, user_ids, message_ids[-20:], 10, 1)
+        results['routes'][name] = run_route(
+            app, method, template, user_ids, message_ids[:-20],
+            args.requests, args.concurrency)
+        print(f"{name:20} {results['routes'][name]}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            out_file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
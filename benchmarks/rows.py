@@ -0,0 +1,124 @@
+"""ORM instances versus the lightweight rows of rows.py on read paths.
+
+For each page size, loads that many of the newest messages (with their
+authors) and that many user cards both ways, and reads every attribute a
+template would. Reports the median time per load and the peak Python
+memory of one load, plus the light path's ratio to the ORM one:
+
+    python -m benchmarks.rows --dataset medium --sizes 100 1000 10000
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from benchmarks.datasets import DATASETS, seed
+from benchmarks.harness import environment, make_app
+from models import db, Message, User
+from rows import card_rows, message_rows, select_cards, select_messages
+
+
+def orm_messages(size):
+    messages = db.session.scalars(
+        select(Message)
+        .options(joinedload(Message.user))
+        .order_by(Message.timestamp.desc())
+        .limit(size)).all()
+    return [(msg.id, msg.text, msg.timestamp, msg.user.id, msg.user.username,
+             msg.user.image_url) for msg in messages]
+
+
+def light_messages(size):
+    messages = message_rows(db.session.execute(
+        select_messages()
+        .order_by(Message.timestamp.desc())
+        .limit(size)))
+    return [(msg.id, msg.text, msg.timestamp, msg.user.id, msg.user.username,
+             msg.user.image_url) for msg in messages]
+
+
+def orm_cards(size):
+    users = db.session.scalars(select(User).order_by(User.id).limit(size)).all()
+    return [(user.id, user.username, user.image_url, user.header_image_url,
+             user.bio) for user in users]
+
+
+def light_cards(size):
+    cards = card_rows(db.session.execute(
+        select_cards().order_by(User.id).limit(size)))
+    return [(card.id, card.username, card.image_url, card.header_image_url,
+             card.bio) for card in cards]
+
+
+PATHS = {
+    'messages': (orm_messages, light_messages),
+    'user_cards': (orm_cards, light_cards),
+}
+
+
+def measure(load, size, repeat):
+    """(median ms, peak KiB) for `load(size)`, each in a fresh session."""
+
+    timings = []
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.perf_counter()
+        load(size)
+        timings.append(time.perf_counter() - start)
+
+    db.session.remove()
+    tracemalloc.start()
+    load(size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (round(statistics.median(timings) * 1000, 3),
+            round(peak / 1024, 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dataset', choices=DATASETS, default='small')
+    parser.add_argument('--database-url')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--out')
+    args = parser.parse_args(argv)
+
+    app = make_app(args.database_url)
+    results = {'environment': environment(), 'dataset': args.dataset,
+               'paths': {}}
+
+    with app.app_context():
+        seed(args.dataset)
+
+        for path, (orm, light) in PATHS.items():
+            results['paths'][path] = []
+            for size in args.sizes:
+                orm_ms, orm_kb = measure(orm, size, args.repeat)
+                light_ms, light_kb = measure(light, size, args.repeat)
+                results['paths'][path].append(dict(
+                    size=size, orm_ms=orm_ms, light_ms=light_ms,
+                    orm_peak_kb=orm_kb, light_peak_kb=light_kb,
+                    time_ratio=round(light_ms / orm_ms, 3) if orm_ms else None,
+                    memory_ratio=round(light_kb / orm_kb, 3) if orm_kb else None,
+                ))
+                print(f"{path:10} {size:>6}  orm {orm_ms:>9} ms {orm_kb:>9} KiB"
+                      f"  light {light_ms:>9} ms {light_kb:>9} KiB",
+                      file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            out_file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""Scaling benchmarks: how route cost grows with a user's graph size.
+
+Each sweep grows one quantity (how many users the viewer follows, how many
+follow the profile being viewed, how many messages the viewer has liked,
+how many messages the viewer has written) over several sizes and measures
+every affected route's median latency and peak Python memory at each size.
+
+The sweep is run ``--rounds`` times and each size's latency is the median
+of its rounds, so a slow spell while one size is measured doesn't pass for
+growth. From the smallest and largest sizes we estimate a growth exponent
+k, as in cost ~ n**k, and compare it to the bound declared for that route
+in BOUNDS.
+Routes that grow faster than their bound are flagged and the script exits
+non-zero, so an accidental O(n) shows up here before it shows up in
+production. Paged routes only level off once a list is longer than one page
+(``FOLLOW_PAGE_SIZE``), so the smallest size should be bigger than that:
+
+    python -m benchmarks.scaling --sizes 100 1000 5000 --out scaling.json
+"""
+
+import argparse
+import json
+import math
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from app import CURR_USER_KEY
+from benchmarks.harness import environment, make_app
+from models import db, User, Message, Follows, Likes
+
+VIEWER_ID = 1
+TARGET_ID = 2
+
+# Largest growth exponent allowed for each complexity class. Fixed
+# per-request overhead pulls measured exponents below their true value, so
+# these are deliberately loose. Flat routes still measure k anywhere in
+# about +-0.1 from run to run (+-0.15 from a single round), so every bound
+# has 0.1 of noise margin over what the class itself can produce: a true
+# O(log n) gives about 0.16 between 100 and 5000.
+MAX_EXPONENT = {
+    'O(1)': 0.2,
+    'O(log n)': 0.3,
+    'O(n)': 1.15,
+}
+
+# sweep -> {route name: (path, declared bound)}
+BOUNDS = {
+    'following': {
+        'home': ('/', 'O(1)'),
+        'users_show': (f'/users/{TARGET_ID}', 'O(1)'),
+        'show_following': (f'/users/{VIEWER_ID}/following', 'O(1)'),
+    },
+    'followers': {
+        'users_show': (f'/users/{TARGET_ID}', 'O(1)'),
+        'users_followers': (f'/users/{TARGET_ID}/followers', 'O(1)'),
+    },
+    'likes': {
+        'home': ('/', 'O(1)'),
+        'users_show': (f'/users/{TARGET_ID}', 'O(1)'),
+    },
+    'messages': {
+        'home': ('/', 'O(1)'),
+        'users_show': (f'/users/{VIEWER_ID}', 'O(1)'),
+    },
+}
+
+
+def build(sweep, size):
+    """Recreate the schema holding one viewer, one target and `size` extras."""
+
+    db.drop_all()
+    db.create_all()
+
+    now = datetime.utcnow()
+    db.session.execute(insert(User), [
+        dict(username=f'user{i}', email=f'user{i}@example.com', password='x')
+        for i in range(1, size + 3)
+    ])
+    others = range(3, size + 3)
+
+    if sweep == 'following':
+        rows = [dict(user_following_id=VIEWER_ID, user_being_followed_id=i)
+                for i in others]
+        db.session.execute(insert(Follows), rows)
+
+    elif sweep == 'followers':
+        rows = [dict(user_following_id=i, user_being_followed_id=TARGET_ID)
+                for i in others]
+        db.session.execute(insert(Follows), rows)
+
+    elif sweep == 'likes':
+        db.session.execute(insert(Message), [
+            dict(text=f'message {i}', user_id=i, timestamp=now - timedelta(seconds=i))
+            for i in others
+        ])
+        message_ids = [message_id for (message_id,) in db.session.query(Message.id)]
+        db.session.execute(insert(Likes), [
+            dict(user_id=VIEWER_ID, message_id=message_id)
+            for message_id in message_ids
+        ])
+
+    elif sweep == 'messages':
+        db.session.execute(insert(Message), [
+            dict(text=f'message {i}', user_id=VIEWER_ID,
+                 timestamp=now - timedelta(seconds=i))
+            for i in range(size)
+        ])
+
+    db.session.commit()
+
+
+def measure(client, path, repeat):
+    """Median latency (s) and peak traced memory (bytes) for GET `path`."""
+
+    client.get(path)
+
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(path)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            raise RuntimeError(f"GET {path} returned {response.status_code}")
+
+    tracemalloc.start()
+    client.get(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return statistics.median(latencies), peak
+
+
+def growth_exponent(sizes, values):
+    """k such that value ~ size**k between the smallest and largest sizes."""
+
+    if values[0] <= 0 or sizes[0] == sizes[-1]:
+        return 0.0
+    return math.log(values[-1] / values[0]) / math.log(sizes[-1] / sizes[0])
+
+
+def run_sweep(app, sweep, sizes, repeat, rounds=1):
+    """Measure every route in `sweep` at each size, `rounds` times over."""
+
+    latencies = {route: [[] for _ in sizes] for route in BOUNDS[sweep]}
+    peaks = {route: [[] for _ in sizes] for route in BOUNDS[sweep]}
+
+    for _ in range(rounds):
+        for i, size in enumerate(sizes):
+            with app.app_context():
+                build(sweep, size)
+
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = VIEWER_ID
+
+            for route, (path, _) in BOUNDS[sweep].items():
+                latency, peak = measure(client, path, repeat)
+                latencies[route][i].append(latency)
+                peaks[route][i].append(peak)
+
+    samples = {
+        route: {
+            'latency_ms': [round(statistics.median(values) * 1000, 3)
+                           for values in latencies[route]],
+            'peak_kb': [round(statistics.median(values) / 1024, 1)
+                        for values in peaks[route]],
+        }
+        for route in BOUNDS[sweep]
+    }
+
+    results = {}
+    for route, (_, bound) in BOUNDS[sweep].items():
+        latency_k = growth_exponent(sizes, samples[route]['latency_ms'])
+        memory_k = growth_exponent(sizes, samples[route]['peak_kb'])
+        results[route] = dict(
+            samples[route],
+            bound=bound,
+            latency_exponent=round(latency_k, 3),
+            memory_exponent=round(memory_k, 3),
+            violates=max(latency_k, memory_k) > MAX_EXPONENT[bound],
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--sweeps', nargs='*', choices=BOUNDS, default=list(BOUNDS))
+    parser.add_argument('--repeat', type=int, default=15)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--database-url')
+    parser.add_argument('--out')
+    args = parser.parse_args(argv)
+
+    sizes = sorted(args.sizes)
+    # Cached pages would hide how the work behind them grows.
+    app = make_app(args.database_url, cache=False)
+
+    results = {'environment': environment(), 'sizes': sizes, 'sweeps': {}}
+    violations = []
+
+    for sweep in args.sweeps:
+        results['sweeps'][sweep] = run_sweep(app, sweep, sizes, args.repeat,
+                                             args.rounds)
+        for route, result in results['sweeps'][sweep].items():
+            print(f"{sweep:10} {route:16} bound {result['bound']:9} "
+                  f"latency k={result['latency_exponent']:<6} "
+                  f"memory k={result['memory_exponent']:<6} "
+                  f"{'VIOLATION' if result['violates'] else 'ok'}",
+                  file=sys.stderr)
+            if result['violates']:
+                violations.append(f'{sweep}/{route}')
+
+    results['violations'] = violations
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            out_file.write(output)
+    print(output)
+
+    if violations:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Startup time and fixed per-request overhead of each config profile.
+
+Startup is measured in fresh interpreters, so it includes importing Warbler
+and its dependencies, building the app with create_app() and connecting it
+with connect_db() (which creates the schema in every profile but "prod").
+
+Per-request overhead is what Warbler's own hooks (current user lookup,
+SQL instrumentation, metrics, the debug toolbar in "dev") add to a request
+that does nothing else: the median latency of an empty route on the
+profile's app minus the same route on a bare Flask app. An anonymous GET
+/login is reported alongside as a realistic cheap page.
+
+    python -m benchmarks.startup --runs 5 --requests 500 --out startup.json
+
+The "dev" app runs with debug on, as it does under ``flask run --debug``,
+so the toolbar is actually active.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from flask import Flask
+
+from benchmarks.harness import environment, make_app, percentile
+
+PROFILES = ('dev', 'prod')
+
+# Run in a child interpreter; prints seconds from first import to ready.
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+from app import create_app
+from models import connect_db
+app = create_app('warbler-bench')
+connect_db(app)
+print(time.perf_counter() - start)
+"""
+
+
+def startup_seconds(profile, database_url, runs):
+    """Median seconds for a new process to import, create and connect."""
+
+    env = dict(os.environ, WARBLER_PROFILE=profile, DATABASE_URL=database_url,
+               FLASK_DEBUG='1' if profile == 'dev' else '0',
+               CACHE_SINGLE_PROCESS='1')
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT],
+                                env=env, capture_output=True, text=True,
+                                check=True)
+        samples.append(float(result.stdout.strip().splitlines()[-1]))
+    return statistics.median(samples)
+
+
+def _noop():
+    return ''
+
+
+def request_latencies(app, path, requests):
+    """Latencies in seconds of `requests` GETs of `path` on `app`."""
+
+    client = app.test_client()
+    client.get(path)
+
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.get(path)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--database-url')
+    parser.add_argument('--out')
+    args = parser.parse_args(argv)
+
+    database_url = args.database_url
+    if database_url is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='warbler-bench-'), 'bench.db')
+        database_url = f'sqlite:///{path}'
+
+    bare = Flask(__name__)
+    bare.add_url_rule('/noop', 'noop', _noop)
+    baseline = statistics.median(request_latencies(bare, '/noop', args.requests))
+
+    results = {'environment': environment(),
+               'baseline_noop_us': round(baseline * 1e6, 1),
+               'profiles': {}}
+
+    debug = os.environ.get('FLASK_DEBUG')
+
+    for profile in PROFILES:
+        # Flask reads FLASK_DEBUG when the app is created, and the toolbar
+        # decides whether to switch itself on at the same moment.
+        os.environ['FLASK_DEBUG'] = '1' if profile == 'dev' else '0'
+        app = make_app(database_url, profile=profile)
+        app.add_url_rule('/noop', 'noop', _noop)
+        with app.app_context():
+            from models import db
+            db.create_all()
+
+        noop = request_latencies(app, '/noop', args.requests)
+        login = request_latencies(app, '/login', args.requests)
+
+        results['profiles'][profile] = {
+            'startup_ms': round(
+                startup_seconds(profile, database_url, args.runs) * 1000, 1),
+            'noop_p50_us': round(statistics.median(noop) * 1e6, 1),
+            'overhead_us': round((statistics.median(noop) - baseline) * 1e6, 1),
+            'login_p50_ms': round(statistics.median(login) * 1000, 3),
+            'login_p95_ms': round(percentile(login, 95) * 1000, 3),
+        }
+
+    if debug is None:
+        os.environ.pop('FLASK_DEBUG')
+    else:
+        os.environ['FLASK_DEBUG'] = debug
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            out_file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Bulk writes for onboarding flows, migrations and integrations.
+
+Follows
+-------
+
+``POST /api/follows`` follows or unfollows up to ``BULK_FOLLOW_MAX``
+accounts in one request. The accounts can be given by id or username, and
+they are all resolved in one query. The ``follows`` rows are then inserted
+or deleted as one set-based statement in one transaction:
+
+    {"action": "follow", "users": [12, "alice", "bob"], "on_conflict": "ignore"}
+
+With ``on_conflict`` "ignore" (the default), accounts already followed are
+reported as unchanged. With "error", the whole request fails with 409 and
+nothing is written.
+
+Messages
+--------
+
+``POST /api/messages`` posts messages from an NDJSON body (content type
+``application/x-ndjson``), one ``{"text": ...}`` object per line. Each text
+is checked against the same rules as MessageForm. Valid ones are inserted
+``INGEST_BATCH_SIZE`` at a time with one multi-row INSERT and one
+transaction per batch, and their tags and mentions are indexed per batch
+too. The response is NDJSON with one result per input line, in input order:
+
+    {"line": 1, "id": 1041}
+    {"line": 2, "errors": ["Field must be between 0 and 140 characters long."]}
+
+At most ``INGEST_MAX_ITEMS`` messages are read per request.
+"""
+
+import json
+
+from sqlalchemy import delete, insert, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from forms import MessageForm
+from models import db, Follows, Message, User
+from tags import index_messages
+
+ON_CONFLICT = ('ignore', 'error')
+
+
+class FollowConflict(Exception):
+    """Some of the accounts to follow are followed already."""
+
+    def __init__(self, user_ids):
+        super().__init__(f"Already following {sorted(user_ids)}")
+        self.user_ids = sorted(user_ids)
+
+
+def resolve_users(refs):
+    """Map user ids (ints) and usernames (strs) in `refs` to user ids.
+
+    Returns (ids, missing): the ids found, in the order first referred to,
+    and the refs that matched no one.
+    """
+
+    ids = {ref for ref in refs if isinstance(ref, int)}
+    names = {ref for ref in refs if isinstance(ref, str)}
+
+    found = db.session.execute(
+        select(User.id, User.username)
+        .where(or_(User.id.in_(ids), User.username.in_(names)),
+               User.deleted_at.is_(None))).all()
+    by_ref = {}
+    for user_id, username in found:
+        by_ref[user_id] = by_ref[username] = user_id
+
+    resolved = list(dict.fromkeys(by_ref[ref] for ref in refs if ref in by_ref))
+    missing = [ref for ref in refs if ref not in by_ref]
+    return resolved, missing
+
+
+def _followed_among(user_id, user_ids):
+    return set(db.session.scalars(
+        select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id,
+               Follows.user_being_followed_id.in_(user_ids))))
+
+
+def follow_users(user_id, user_ids, on_conflict='ignore'):
+    """Have `user_id` follow everyone in `user_ids`. Doesn't commit.
+
+    Returns the ids newly followed. Raises FollowConflict if `on_conflict`
+    is "error" and any of them are followed already.
+    """
+
+    targets = [target for target in user_ids if target != user_id]
+    existing = _followed_among(user_id, targets)
+    if existing and on_conflict == 'error':
+        raise FollowConflict(existing)
+
+    new = [target for target in targets if target not in existing]
+    if not new:
+        return []
+
+    rows = [dict(user_following_id=user_id, user_being_followed_id=target)
+            for target in new]
+    if on_conflict == 'error':
+        db.session.execute(insert(Follows), rows)
+    else:
+        # Someone else's request may have added one since we looked.
+        insert_follows(rows)
+    return new
+
+
+def insert_follows(rows):
+    """INSERT `rows` into follows, skipping any already there. Doesn't commit.
+
+    Returns how many were inserted.
+    """
+
+    dialect = db.session.get_bind().dialect.name
+    upsert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    return db.session.execute(
+        upsert(Follows).values(rows).on_conflict_do_nothing()).rowcount
+
+
+def unfollow_users(user_id, user_ids):
+    """Have `user_id` stop following everyone in `user_ids`. Doesn't commit.
+
+    Returns the ids that were followed until now.
+    """
+
+    existing = _followed_among(user_id, user_ids)
+    if not existing:
+        return []
+
+    db.session.execute(
+        delete(Follows)
+        .where(Follows.user_following_id == user_id,
+               Follows.user_being_followed_id.in_(existing))
+        .execution_options(synchronize_session=False))
+    return [target for target in user_ids if target in existing]
+
+
+def message_errors(text):
+    """MessageForm's complaints about `text`, as a list (empty if it's fine)."""
+
+    if not isinstance(text, str):
+        return ["Text must be a string."]
+
+    form = MessageForm(formdata=None, data={'text': text}, meta={'csrf': False})
+    form.validate()
+    return form.errors.get('text', [])
+
+
+def _parse(line):
+    """(text, errors) for one NDJSON line."""
+
+    try:
+        item = json.loads(line)
+    except ValueError:
+        return None, ["Not valid JSON."]
+    if not isinstance(item, dict):
+        return None, ["Expected a JSON object."]
+
+    text = item.get('text')
+    return text, message_errors(text)
+
+
+def ingest_messages(user_id, lines, batch_size, max_items):
+    """Insert the messages in NDJSON `lines` as `user_id`, a batch at a time.
+
+    Yields (results, messages) for each batch once it is inserted and
+    indexed, but before it is committed: the caller commits. `results` has
+    the per-line results for the batch and `messages` the new Messages.
+    """
+
+    results, pending, seen = [], [], 0
+
+    def flush():
+        messages = db.session.scalars(
+            insert(Message).returning(Message, sort_by_parameter_order=True),
+            [dict(text=text, user_id=user_id) for _, text in pending]).all()
+        index_messages(messages)
+        for (number, _), message in zip(pending, messages):
+            results.append({'line': number, 'id': message.id})
+        results.sort(key=lambda result: result['line'])
+        return messages
+
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+
+        seen += 1
+        if seen > max_items:
+            results.append({'line': number, 'errors': [
+                f"Too many messages; at most {max_items} per request."]})
+            break
+
+        text, errors = _parse(line)
+        if errors:
+            results.append({'line': number, 'errors': errors})
+        else:
+            pending.append((number, text))
+
+        if len(pending) == batch_size:
+            messages = flush()
+            yield results, messages
+            results, pending = [], []
+
+    messages = flush() if pending else []
+    if results:
+        yield results, messages
+
+
+def init_bulk(app):
+    """Apply default config for the bulk APIs."""
+
+    app.config.setdefault('BULK_FOLLOW_MAX', 1000)
+    app.config.setdefault('INGEST_BATCH_SIZE', 500)
+    app.config.setdefault('INGEST_MAX_ITEMS', 10000)
@@ -0,0 +1,371 @@
+"""Shared cache for Warbler views.
+
+Views cache plain data (dicts, lists, numbers, the namedtuple rows of
+rows.py; never ORM objects) with ``cached()``:
+
+    counts = cached(f'user:{user.id}', 'counts', user.counts)
+
+Keys live in a namespace, such as everything about one user (``user:42``)
+or the user directory (``users``). Each namespace has a version, stored in
+the cache itself, that is part of every key in it. Write routes call
+``invalidate()`` to give a namespace a new version once their change is
+committed. Old entries are never looked up again and age out on their own,
+so invalidation is one write however many keys the namespace holds.
+
+Two backends, picked with ``CACHE_BACKEND`` (or the environment variable of
+the same name):
+
+- ``memory``: a per-process LRU of at most ``CACHE_MAX_ENTRIES`` entries.
+- ``redis``: any Redis-protocol server at ``CACHE_REDIS_URL``, shared by
+  every process. Needs the ``redis`` package.
+
+``invalidate()`` only reaches the processes that share the backend. With
+``memory`` that is the calling process alone: other web workers keep
+serving what they cached, and invalidations made by job workers (an
+account deletion, say) reach no web process at all, until the entries
+expire. So ``memory`` is only for one process on its own, and its entries
+expire after 30 seconds rather than five minutes. The app refuses to start
+with it unless it is in debug or testing mode or ``CACHE_SINGLE_PROCESS``
+(or the environment variable of the same name) says this process is the
+only one; the dev profile sets it. Any real deployment should use
+``redis``.
+
+Every entry expires after ``CACHE_TTL`` seconds unless given its own ttl,
+less a random ``CACHE_TTL_JITTER`` fraction so that entries filled together
+don't all expire (and get refilled) in the same instant. Hits, misses and
+coalesced waits are counted per namespace in
+``warbler_cache_requests_total``.
+
+Misses are computed on the primary database even in views that otherwise
+read from a replica. An entry filled from a lagging replica just after an
+``invalidate()`` would keep serving the old data to everyone, the writer
+included, long after their replica pin (see replicas.py) runs out.
+
+Misses are single-flight: when several requests miss the same key at once,
+one computes the value and the rest wait up to ``CACHE_FLIGHT_TIMEOUT``
+seconds for it instead of all running the same queries. Threads of one
+process wait on each other directly; with a shared backend, processes also
+coordinate through a short-lived lock key in the cache.
+
+When ``CACHE_ALLOW_BYPASS`` is set (the default in debug mode), a request
+sent with an ``X-Cache-Bypass: 1`` header skips the cache entirely, which
+is handy for checking whether a bug is a stale entry.
+"""
+
+import os
+import pickle
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, has_app_context, has_request_context, request
+
+from metrics import add_collector, counter, inc
+from replicas import primary_reads
+
+CACHE_REQUESTS = counter(
+    'warbler_cache_requests_total', "Cache lookups by namespace and result.")
+
+# Seconds between checks while waiting on another process's computation.
+FLIGHT_POLL_INTERVAL = 0.01
+
+
+class MemoryCache:
+    """Thread-safe in-process LRU cache with per-entry expiry."""
+
+    shared = False
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value stored at `key`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, only_if_missing=False):
+        """Store `value` at `key` for `ttl` seconds (None: until evicted).
+
+        With `only_if_missing`, leave an existing live entry alone. Returns
+        whether the value was stored.
+        """
+
+        expires_at = None if ttl is None else time.monotonic() + ttl
+
+        with self._lock:
+            if only_if_missing:
+                entry = self._entries.get(key)
+                if entry is not None and (entry[1] is None
+                                          or entry[1] > time.monotonic()):
+                    return False
+
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Cache stored on a Redis-protocol server, shared between processes.
+
+    `client` is a redis-py client, or anything with the same get, set (with
+    ``px`` and ``nx``), delete and flushdb methods.
+    """
+
+    shared = True
+
+    def __init__(self, client, prefix='warbler:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, value, ttl=None, only_if_missing=False):
+        px = None if ttl is None else max(1, int(ttl * 1000))
+        return bool(self.client.set(self.prefix + key, pickle.dumps(value),
+                                    px=px, nx=only_if_missing))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+def make_backend(config):
+    """Build the backend described by `config`."""
+
+    if config['CACHE_BACKEND'] == 'redis':
+        import redis
+        return RedisCache(redis.Redis.from_url(config['CACHE_REDIS_URL']))
+
+    return MemoryCache(config['CACHE_MAX_ENTRIES'])
+
+
+def _backend():
+    return current_app.extensions['warbler_cache']
+
+
+def _bypassed():
+    if not has_request_context():
+        return False
+    if 'cache_bypass' not in g:
+        g.cache_bypass = (current_app.config['CACHE_ALLOW_BYPASS']
+                          and request.headers.get('X-Cache-Bypass') == '1')
+    return g.cache_bypass
+
+
+def _version(backend, namespace):
+    """Current version of `namespace`, creating one if there is none.
+
+    A fresh version is a timestamp rather than 0, so a namespace whose
+    version was evicted can't come back to a number its old entries used.
+    """
+
+    key = f'ns:{namespace}'
+    version = backend.get(key)
+    if version is None:
+        backend.set(key, time.time_ns(), only_if_missing=True)
+        version = backend.get(key)
+    return version
+
+
+class _Flight:
+    """One in-progress computation that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _wait_for_value(backend, key, timeout):
+    """Poll `backend` for `key` until it appears or `timeout` runs out."""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(FLIGHT_POLL_INTERVAL)
+        value = backend.get(key)
+        if value is not None:
+            return value
+    return None
+
+
+def _fill(backend, key, compute, ttl):
+    """Compute and store `key`, unless another process is already on it."""
+
+    config = current_app.config
+    timeout = config['CACHE_FLIGHT_TIMEOUT']
+
+    if backend.shared:
+        lock_key = f'lock:{key}'
+        if not backend.set(lock_key, 1, timeout, only_if_missing=True):
+            value = _wait_for_value(backend, key, timeout)
+            if value is not None:
+                return value, 'coalesced'
+        try:
+            value = compute()
+            backend.set(key, value, ttl)
+        finally:
+            backend.delete(lock_key)
+        return value, 'miss'
+
+    value = compute()
+    backend.set(key, value, ttl)
+    return value, 'miss'
+
+
+def _single_flight(backend, key, compute, ttl):
+    """Fill `key` once however many threads of this process miss it at once."""
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if flight.done.wait(current_app.config['CACHE_FLIGHT_TIMEOUT']):
+            if flight.value is not None:
+                return flight.value, 'coalesced'
+        # The leader failed or is too slow; don't wait on it any longer.
+        return compute(), 'miss'
+
+    try:
+        flight.value, result = _fill(backend, key, compute, ttl)
+        return flight.value, result
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def _on_primary(compute):
+    with primary_reads():
+        return compute()
+
+
+def cached(namespace, key, compute, ttl=None):
+    """Return the value cached under `namespace`/`key`, computing it on a miss.
+
+    `compute()` is called with no arguments and its result stored for `ttl`
+    seconds (default ``CACHE_TTL``). It must not return None.
+    """
+
+    label = namespace.split(':', 1)[0]
+
+    if not current_app.config['CACHE_ENABLED'] or _bypassed():
+        inc(CACHE_REQUESTS, namespace=label, result='bypass')
+        return compute()
+
+    backend = _backend()
+    full_key = f'{namespace}:v{_version(backend, namespace)}:{key}'
+
+    value = backend.get(full_key)
+    if value is not None:
+        inc(CACHE_REQUESTS, namespace=label, result='hit')
+        return value
+
+    if ttl is None:
+        ttl = current_app.config['CACHE_TTL']
+    ttl *= 1 - random.random() * current_app.config['CACHE_TTL_JITTER']
+
+    value, result = _single_flight(backend, full_key,
+                                   lambda: _on_primary(compute), ttl)
+    inc(CACHE_REQUESTS, namespace=label, result=result)
+    return value
+
+
+def invalidate(*namespaces):
+    """Drop everything cached in `namespaces` by moving them to new versions."""
+
+    if not has_app_context() or not current_app.config['CACHE_ENABLED']:
+        return
+
+    backend = _backend()
+    for namespace in namespaces:
+        backend.set(f'ns:{namespace}', time.time_ns())
+
+
+def clear():
+    """Empty the current app's cache."""
+
+    _backend().clear()
+
+
+def cache_gauges():
+    """Scrape-time gauge: entries held by in-process caches."""
+
+    if not has_app_context():
+        return []
+
+    backend = current_app.extensions.get('warbler_cache')
+    if not isinstance(backend, MemoryCache):
+        return []
+
+    return [('warbler_cache_entries', "Entries in the in-process cache.",
+             {}, len(backend))]
+
+
+def init_cache(app):
+    """Give `app` a cache backend and apply default config."""
+
+    app.config.setdefault('CACHE_ENABLED', True)
+    app.config.setdefault('CACHE_BACKEND',
+                          os.environ.get('CACHE_BACKEND', 'memory'))
+    app.config.setdefault('CACHE_REDIS_URL',
+                          os.environ.get('CACHE_REDIS_URL',
+                                         'redis://localhost:6379/0'))
+    app.config.setdefault('CACHE_MAX_ENTRIES', 10000)
+    # Per-process entries can't be invalidated from other processes, so
+    # keep them short-lived.
+    app.config.setdefault(
+        'CACHE_TTL', 300 if app.config['CACHE_BACKEND'] == 'redis' else 30)
+    app.config.setdefault('CACHE_TTL_JITTER', 0.1)
+    app.config.setdefault('CACHE_FLIGHT_TIMEOUT', 5)
+    app.config.setdefault('CACHE_ALLOW_BYPASS', app.debug)
+    app.config.setdefault('CACHE_SINGLE_PROCESS',
+                          bool(os.environ.get('CACHE_SINGLE_PROCESS')))
+
+    # Nothing tells us how many web and job workers share the database, so
+    # a per-process cache has to be asked for.
+    single_process = (app.debug or app.testing
+                      or app.config['CACHE_SINGLE_PROCESS'])
+    if (app.config['CACHE_ENABLED'] and app.config['CACHE_BACKEND'] == 'memory'
+            and not single_process):
+        raise RuntimeError(
+            "CACHE_BACKEND 'memory' can't be invalidated from other "
+            "processes; use 'redis', or set CACHE_SINGLE_PROCESS if this "
+            "process runs alone.")
+
+    app.extensions['warbler_cache'] = make_backend(app.config)
+    add_collector(cache_gauges)
@@ -0,0 +1,130 @@
+"""Configuration profiles for create_app()."""
+
+import os
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Whether to install Flask-DebugToolbar at all.
+    DEBUG_TOOLBAR = False
+    # Whether connect_db() creates missing tables at startup.
+    CREATE_SCHEMA = True
+
+    # Connection pool for server databases (ignored for SQLite), and the
+    # longest a single statement may run before the server cancels it.
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_PRE_PING = False
+    DB_POOL_RECYCLE = -1
+    DB_STATEMENT_TIMEOUT_MS = None
+
+
+class DevelopmentConfig(Config):
+    """Local development: debug toolbar, schema created on demand."""
+
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+    # `flask run` is one process, so the in-process cache is safe.
+    CACHE_SINGLE_PROCESS = True
+
+
+class TestingConfig(Config):
+    """Fast, isolated settings for the test suite.
+
+    Runs against in-memory SQLite with the cheapest bcrypt cost, no CSRF and
+    jobs run inline. Set TEST_DATABASE_URL to test against something else;
+    a ``{worker}`` placeholder in it is replaced by the pytest-xdist worker
+    id so parallel workers each get their own database, e.g.
+    ``postgresql:///warbler-test-{worker}``.
+    """
+
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    JOBS_EAGER = True
+    SQL_REPEAT_RAISE = True
+    SLOW_QUERY_MS = None
+    LATEST_FEED_BACKGROUND = False
+
+    @staticmethod
+    def database_uri():
+        """Database URI for this test process."""
+
+        uri = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+        worker = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+        return uri.replace('{worker}', worker)
+
+
+class ProductionConfig(Config):
+    """Serving real traffic.
+
+    No debug toolbar, and the schema is left alone at startup: it is created
+    once with ``flask --app server create-schema`` (or by migrations), not by
+    every worker as it boots. Connections are checked before use and
+    recycled every half hour so the pool survives database restarts and
+    idle-connection reaping, and runaway statements are cancelled.
+    """
+
+    CREATE_SCHEMA = False
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    DB_POOL_PRE_PING = True
+    DB_POOL_RECYCLE = 1800
+    DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+
+
+PROFILES = {
+    'dev': DevelopmentConfig,
+    'test': TestingConfig,
+    'prod': ProductionConfig,
+}
+
+
+def engine_options(database_uri, config):
+    """Engine settings suited to `database_uri`'s backend.
+
+    Server databases get a QueuePool sized and tuned by the DB_* settings in
+    `config` (an app.config); on Postgres DB_STATEMENT_TIMEOUT_MS becomes the connection's
+    ``statement_timeout``.
+
+    A SQLite file gets a QueuePool too, sized by the same settings: a
+    connection is only ever used by one thread at a time, and pooled
+    connections keep their page cache warm. Pragmas are set per connection
+    in models.configure_sqlite. This lets Warbler run from a single file:
+
+        DATABASE_URL=sqlite:///warbler.db flask --app server run
+    """
+
+    url = make_url(database_uri)
+
+    if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+        return {
+            'poolclass': QueuePool,
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'connect_args': {'check_same_thread': False},
+        }
+
+    if url.get_backend_name() == 'sqlite':
+        return {}
+
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    }
+
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if timeout and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': f'-c statement_timeout={timeout}'}
+
+    return options
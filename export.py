@@ -0,0 +1,217 @@
+"""Streaming export of everything about one account.
+
+An export is a stream of records: the profile, then the user's messages,
+likes, followers and following, each section in key order. Messages and
+likes that have been archived (see archive.py) are merged into the same
+sections, in the same order, as the hot ones. Every section is read with a server-side cursor,
+``EXPORT_CHUNK_SIZE`` rows at a time, and each record is written out as
+soon as it is read, so memory use is the same for ten messages or ten
+million. Formats are NDJSON (one JSON object per
+line) and CSV (one row per record, with the union of the columns).
+
+Each record carries a ``cursor``. An export that was cut short can pick up
+after the last record it got by passing that cursor back as ``after``.
+Archiving a message or like keeps its place in that order, so rows moved
+between an interrupted export and its resume are neither missed nor
+repeated.
+
+Users download their own export from ``/users/export``. Anyone's can be
+written from the command line, e.g. for a compliance request:
+
+    flask --app server export user 42 --format csv --out user-42.csv
+"""
+
+import csv
+import io
+import json
+import sys
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, or_, select, union_all
+
+from models import (db, ArchivedLike, ArchivedMessage, Follows, Likes,
+                    Message, User)
+
+export_cli = AppGroup('export', help="Export account data.")
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+CSV_FIELDS = ('type', 'cursor', 'id', 'username', 'email', 'bio', 'location',
+              'image_url', 'header_image_url', 'text', 'timestamp',
+              'message_id')
+
+SECTIONS = ('profile', 'messages', 'likes', 'followers', 'following')
+
+
+class BadCursor(ValueError):
+    """An `after` cursor that no export could have produced."""
+
+
+def _parse_cursor(after):
+    """(section index, key) for `after`; (0, None) starts from the top.
+
+    Raises BadCursor for anything an export couldn't have produced.
+    """
+
+    if not after:
+        return 0, None
+
+    section, _, key = after.partition(':')
+    try:
+        if section == 'messages':
+            timestamp, _, message_id = key.rpartition('/')
+            key = (datetime.fromisoformat(timestamp), int(message_id))
+        else:
+            key = int(key)
+        return SECTIONS.index(section), key
+    except ValueError as exc:
+        raise BadCursor(after) from exc
+
+
+def _stream(query):
+    """Rows of `query`, fetched from a server-side cursor a chunk at a time."""
+
+    chunk = current_app.config['EXPORT_CHUNK_SIZE']
+    return db.session.execute(query.execution_options(yield_per=chunk))
+
+
+def _profile(user_id, key):
+    if key is not None:
+        return
+    user = db.session.get(User, user_id)
+    yield {'type': 'profile', 'cursor': 'profile:0', 'id': user.id,
+           'username': user.username, 'email': user.email, 'bio': user.bio,
+           'location': user.location, 'image_url': user.image_url,
+           'header_image_url': user.header_image_url}
+
+
+def _messages(user_id, key):
+    def part(model):
+        # (timestamp, id) order follows the (user_id, timestamp) indexes.
+        query = (select(model.id, model.text, model.timestamp)
+                 .where(model.user_id == user_id))
+        if key is not None:
+            timestamp, message_id = key
+            query = query.where(or_(
+                model.timestamp > timestamp,
+                and_(model.timestamp == timestamp, model.id > message_id)))
+        return query
+
+    both = union_all(part(ArchivedMessage), part(Message)).subquery()
+    query = select(both).order_by(both.c.timestamp, both.c.id)
+
+    for message_id, text, timestamp in _stream(query):
+        yield {'type': 'message',
+               'cursor': f'messages:{timestamp.isoformat()}/{message_id}',
+               'id': message_id, 'text': text,
+               'timestamp': timestamp.isoformat()}
+
+
+def _likes(user_id, key):
+    def part(model):
+        query = select(model.message_id).where(model.user_id == user_id)
+        if key is not None:
+            query = query.where(model.message_id > key)
+        return query
+
+    both = union_all(part(ArchivedLike), part(Likes)).subquery()
+    query = select(both).order_by(both.c.message_id)
+
+    for (message_id,) in _stream(query):
+        yield {'type': 'like', 'cursor': f'likes:{message_id}',
+               'message_id': message_id}
+
+
+def _follows(section, record_type, mine, theirs):
+    # Accounts that have been deleted but not yet purged are left out.
+    def records(user_id, key):
+        query = (select(User.id, User.username)
+                 .join(Follows, theirs == User.id)
+                 .where(mine == user_id, User.deleted_at.is_(None))
+                 .order_by(theirs))
+        if key is not None:
+            query = query.where(theirs > key)
+
+        for other_id, username in _stream(query):
+            yield {'type': record_type,
+                   'cursor': f'{section}:{other_id}',
+                   'id': other_id, 'username': username}
+    return records
+
+
+_READERS = (
+    _profile,
+    _messages,
+    _likes,
+    _follows('followers', 'follower', Follows.user_being_followed_id,
+             Follows.user_following_id),
+    _follows('following', 'following', Follows.user_following_id,
+             Follows.user_being_followed_id),
+)
+
+
+def export_records(user_id, after=None):
+    """Every record of `user_id`'s export, resuming after cursor `after`.
+
+    A bad `after` raises BadCursor straight away, before anything is read.
+    """
+
+    start, key = _parse_cursor(after)
+    return _records(user_id, start, key)
+
+
+def _records(user_id, start, key):
+    for index in range(start, len(SECTIONS)):
+        yield from _READERS[index](user_id, key if index == start else None)
+
+
+def export_lines(user_id, fmt='ndjson', after=None):
+    """`user_id`'s export as text chunks in format `fmt` (see FORMATS)."""
+
+    records = export_records(user_id, after)
+    if fmt == 'ndjson':
+        return (json.dumps(record) + '\n' for record in records)
+    return _csv_lines(records)
+
+
+def _csv_lines(records):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+@export_cli.command('user')
+@click.argument('user_id', type=int)
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)),
+              default='ndjson')
+@click.option('--after', help="Resume after this record's cursor.")
+@click.option('--out', type=click.File('w'), default='-',
+              help="File to write to (default: standard output).")
+def export_user(user_id, fmt, after, out):
+    """Write everything about one account to --out."""
+
+    if db.session.get(User, user_id) is None:
+        sys.exit(f"No user {user_id}.")
+
+    try:
+        chunks = export_lines(user_id, fmt, after)
+    except BadCursor:
+        sys.exit(f"Not an export cursor: {after}")
+
+    for chunk in chunks:
+        out.write(chunk)
+
+
+def init_export(app):
+    """Register the export CLI on `app` and apply default config."""
+
+    app.config.setdefault('EXPORT_CHUNK_SIZE', 1000)
+    app.cli.add_command(export_cli)
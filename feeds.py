@@ -0,0 +1,135 @@
+"""Feeds computed once and shared by every request in the process.
+
+A SharedFeed holds one list of rows in memory, e.g. the latest messages
+site-wide, and serves it stale-while-revalidate:
+
+- younger than ``interval`` seconds: served as is;
+- older, but younger than ``max_stale``: served as is while one background
+  thread recomputes it;
+- older than that (or never loaded): recomputed before serving, by one
+  request while any others wait for it.
+
+Writers can also patch the rows in place with ``push()`` and ``remove()``
+so that changes show up before the next refresh. Changes made while a
+background refresh is loading are applied again to its rows, so none are
+lost when they replace the old ones.
+"""
+
+import threading
+import time
+
+from flask import current_app
+
+
+class SharedFeed:
+    """An in-memory list of at most `size` rows, refreshed by `load()`.
+
+    `load(size)` runs inside an app context and returns the rows newest
+    first. With `background` False, stale rows are refreshed inline instead
+    of in a thread (for tests, where a second thread can't share the
+    test's database connection).
+    """
+
+    def __init__(self, load, size=100, interval=10, max_stale=300,
+                 background=True):
+        self.load = load
+        self.size = size
+        self.interval = interval
+        self.max_stale = max_stale
+        self.background = background
+
+        self._rows = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        # (change, argument) for each push() or remove() made while a
+        # background refresh is loading; None otherwise.
+        self._pending = None
+
+    def rows(self):
+        """The feed's rows, newest first."""
+
+        age = time.monotonic() - self._loaded_at
+
+        if self._rows is not None and age < self.interval:
+            return self._rows
+
+        if self._rows is not None and age < self.max_stale and self.background:
+            self._refresh_in_background()
+            return self._rows
+
+        with self._lock:
+            # Someone else may have refreshed it while we waited.
+            if (self._rows is None
+                    or time.monotonic() - self._loaded_at >= self.interval):
+                self._refresh()
+            return self._rows
+
+    def push(self, row):
+        """Put a new row at the top, if the feed has been loaded."""
+
+        self._change(self._pushed, row)
+
+    def remove(self, row_id):
+        """Drop the row whose ``id`` attribute is `row_id`."""
+
+        self._change(self._removed, row_id)
+
+    def clear(self):
+        """Forget the rows; the next read loads them again.
+
+        A background refresh that is already loading is thrown away.
+        """
+
+        with self._lock:
+            self._rows = None
+            self._loaded_at = 0.0
+            self._pending = None
+
+    def _change(self, change, argument):
+        with self._lock:
+            if self._rows is not None:
+                self._rows = change(self._rows, argument)
+            if self._pending is not None:
+                self._pending.append((change, argument))
+
+    def _pushed(self, rows, row):
+        # The row may already be there if it was loaded as well as pushed.
+        rows = [other for other in rows if other.id != row.id]
+        return [row] + rows[:self.size - 1]
+
+    def _removed(self, rows, row_id):
+        return [row for row in rows if row.id != row_id]
+
+    def _refresh(self):
+        rows = self.load(self.size)
+        self._rows = rows
+        self._loaded_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._pending = []
+
+        app = current_app._get_current_object()
+
+        def refresh():
+            try:
+                with app.app_context():
+                    rows = self.load(self.size)
+                with self._lock:
+                    if self._pending is not None:
+                        for change, argument in self._pending:
+                            rows = change(rows, argument)
+                        self._rows = rows
+                        self._loaded_at = time.monotonic()
+            except Exception:
+                app.logger.exception("Refreshing a shared feed failed")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+                    self._pending = None
+
+        threading.Thread(target=refresh, daemon=True).start()
@@ -0,0 +1,445 @@
+"""Memory-mapped follow graph shared by every worker process on a host.
+
+A snapshot of the ``follows`` table is written to ``FOLLOW_GRAPH_DIR`` as
+sorted adjacency arrays in CSR form, one ``.npy`` file each:
+
+- ``out_indptr`` / ``out_indices``: who each user follows;
+- ``in_indptr`` / ``in_indices``: who follows each user.
+
+``indices[indptr[u]:indptr[u + 1]]`` is user ``u``'s sorted neighbour list,
+with user ids as row numbers. Workers open the files with ``mmap``, so all
+of them share one copy in the page cache. Membership is a binary search and
+a count is two array reads; neither needs a database round trip.
+
+Snapshots are never modified. ``record_follow_change()``, called by the
+follow, unfollow and account-deletion code once its change is committed,
+appends a fixed-size record to the current delta log. Every worker applies new
+records to a small in-memory overlay before answering, looking for them at
+most once every ``FOLLOW_GRAPH_REFRESH_MS`` (a process sees its own changes
+at once). Once the log holds ``FOLLOW_GRAPH_MAX_DELTAS`` records a rebuild
+is queued, which writes a fresh snapshot and starts a new log:
+
+    flask --app server graph rebuild
+
+Files are versioned by generation. ``WRITING`` names the log new records go
+to and ``CURRENT`` names the snapshot readers load. A rebuild switches
+writers to the new log before it reads the table, and readers replay every
+log from their snapshot's onwards, so no change is lost in between.
+Replaying a change the snapshot already has does nothing.
+
+The files are per host, so the graph is only used when
+``FOLLOW_GRAPH_SINGLE_HOST`` says every web and job process runs on this
+one; otherwise changes made elsewhere would never reach its log, and every
+lookup asks the database.
+
+A change is logged after its transaction commits, so a process that dies in
+between, or a failed write, leaves the graph missing it. A failed write
+queues a rebuild. To bound the rest, a snapshot older than
+``FOLLOW_GRAPH_MAX_AGE`` seconds is not used (lookups go to the database
+until the next rebuild), and logging a change queues a rebuild once the
+snapshot is half that age.
+"""
+
+import glob
+import os
+import struct
+import threading
+import time
+
+import click
+import numpy as np
+from flask import current_app, has_app_context
+from flask.cli import AppGroup
+
+graph_cli = AppGroup('graph', help="Maintain the shared follow graph.")
+
+FOLLOW = 1
+UNFOLLOW = 2
+DELETE_USER = 3
+
+_RECORD = struct.Struct('<iii')
+_ARRAYS = ('out_indptr', 'out_indices', 'in_indptr', 'in_indices')
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+def _read_generation(directory, name):
+    try:
+        with open(os.path.join(directory, name)) as pointer:
+            return int(pointer.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_generation(directory, name, generation):
+    path = os.path.join(directory, name)
+    with open(f'{path}.tmp', 'w') as pointer:
+        pointer.write(str(generation))
+    os.replace(f'{path}.tmp', path)
+
+
+def _log_path(directory, generation):
+    return os.path.join(directory, f'deltas-{generation}.log')
+
+
+def _built_at(directory, generation):
+    """Wall-clock time the snapshot `generation` was written, or None."""
+
+    try:
+        return os.path.getmtime(
+            os.path.join(directory, f'out_indptr-{generation}.npy'))
+    except OSError:
+        return None
+
+
+def _csr(rows, columns, size):
+    """(indptr, indices) with each row's columns sorted."""
+
+    order = np.lexsort((columns, rows))
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+    return indptr, columns[order].astype(np.int32)
+
+
+def write_snapshot(directory, followers, followed, generation):
+    """Write CSR arrays for the (followers[i] -> followed[i]) edges."""
+
+    followers = np.asarray(followers, dtype=np.int64)
+    followed = np.asarray(followed, dtype=np.int64)
+    size = int(max(followers.max(initial=0), followed.max(initial=0))) + 1
+
+    arrays = dict(zip(('out_indptr', 'out_indices'),
+                      _csr(followers, followed, size)))
+    arrays.update(zip(('in_indptr', 'in_indices'),
+                      _csr(followed, followers, size)))
+
+    for name, array in arrays.items():
+        path = os.path.join(directory, f'{name}-{generation}.npy')
+        np.save(f'{path}.tmp.npy', array)
+        os.replace(f'{path}.tmp.npy', path)
+
+
+def rebuild(directory):
+    """Snapshot the follows table as a new generation and publish it."""
+
+    from models import db, Follows
+
+    os.makedirs(directory, exist_ok=True)
+    generation = (_read_generation(directory, 'WRITING') or 0) + 1
+
+    # New records go to the new log before the table is read, so none fall
+    # between the snapshot and its log.
+    open(_log_path(directory, generation), 'ab').close()
+    _write_generation(directory, 'WRITING', generation)
+
+    edges = np.array(
+        db.session.execute(db.select(Follows.user_following_id,
+                                     Follows.user_being_followed_id)).all(),
+        dtype=np.int64).reshape(-1, 2)
+
+    write_snapshot(directory, edges[:, 0], edges[:, 1], generation)
+    _write_generation(directory, 'CURRENT', generation)
+    _graph(directory).expire()
+
+    # Workers still on the previous generation keep their mappings; files
+    # two generations back are no longer needed by anyone.
+    for path in glob.glob(os.path.join(directory, '*-*.*')):
+        stem = os.path.basename(path).split('.')[0]
+        try:
+            if int(stem.rsplit('-', 1)[1]) < generation - 1:
+                os.remove(path)
+        except (ValueError, OSError):
+            continue
+
+    return generation
+
+
+class SharedGraph:
+    """One process's view of the shared graph: a snapshot plus overlay."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.generation = None
+        self._checked_at = None
+        self._lock = threading.RLock()
+
+    # Snapshot and log handling
+
+    def _load(self, generation):
+        for name in _ARRAYS:
+            path = os.path.join(self.directory, f'{name}-{generation}.npy')
+            setattr(self, name, np.load(path, mmap_mode='r'))
+
+        self.size = len(self.out_indptr) - 1
+        self.generation = generation
+        self.built_at = _built_at(self.directory, generation)
+        self._offsets = {}
+        self._added_out = {}
+        self._added_in = {}
+        self._removed_out = {}
+        self._removed_in = {}
+
+    def refresh(self, max_age=0):
+        """Pick up a newer snapshot and any new log records.
+
+        Skipped if the last check was less than `max_age` seconds ago and
+        nothing has been written here since. Returns whether there is a
+        snapshot.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is not None and now - self._checked_at < max_age:
+                return self.generation is not None
+
+            current = _read_generation(self.directory, 'CURRENT')
+            if current is None:
+                return False
+            if current != self.generation:
+                self._load(current)
+
+            writing = _read_generation(self.directory, 'WRITING') or current
+            for generation in range(current, writing + 1):
+                self._replay(generation)
+            self._checked_at = now
+            return True
+
+    def expire(self):
+        """Make the next refresh() look at the files, however recent."""
+
+        with self._lock:
+            self._checked_at = None
+
+    def _replay(self, generation):
+        path = _log_path(self.directory, generation)
+        offset = self._offsets.get(generation, 0)
+        try:
+            if os.path.getsize(path) <= offset:
+                return
+            with open(path, 'rb') as log:
+                log.seek(offset)
+                data = log.read()
+        except OSError:
+            return
+
+        # A record still being written is picked up next time.
+        usable = len(data) - len(data) % _RECORD.size
+        for op, a, b in _RECORD.iter_unpack(data[:usable]):
+            if op == FOLLOW:
+                self._follow(a, b)
+            elif op == UNFOLLOW:
+                self._unfollow(a, b)
+            elif op == DELETE_USER:
+                self._delete_user(a)
+        self._offsets[generation] = offset + usable
+
+    # The overlay. Every change is relative to the snapshot, so replaying one
+    # the snapshot already includes is a no-op.
+
+    def _base_row(self, indptr, indices, user_id):
+        if user_id < 0 or user_id >= self.size:
+            return indices[:0]
+        return indices[indptr[user_id]:indptr[user_id + 1]]
+
+    def _in_base(self, a, b):
+        row = self._base_row(self.out_indptr, self.out_indices, a)
+        i = np.searchsorted(row, b)
+        return bool(i < len(row) and row[i] == b)
+
+    def _follow(self, a, b):
+        if b in self._removed_out.get(a, ()):
+            self._removed_out[a].discard(b)
+            self._removed_in[b].discard(a)
+        elif not self._in_base(a, b):
+            self._added_out.setdefault(a, set()).add(b)
+            self._added_in.setdefault(b, set()).add(a)
+
+    def _unfollow(self, a, b):
+        if b in self._added_out.get(a, ()):
+            self._added_out[a].discard(b)
+            self._added_in[b].discard(a)
+        elif self._in_base(a, b):
+            self._removed_out.setdefault(a, set()).add(b)
+            self._removed_in.setdefault(b, set()).add(a)
+
+    def _delete_user(self, user_id):
+        for followed in self.following(user_id):
+            self._unfollow(user_id, followed)
+        for follower in self.followers(user_id):
+            self._unfollow(follower, user_id)
+
+    # Queries
+
+    def _neighbours(self, indptr, indices, removed, added, user_id):
+        """Sorted array of a snapshot row with the overlay applied."""
+
+        row = self._base_row(indptr, indices, user_id)
+        if removed.get(user_id):
+            row = np.setdiff1d(row, _ids(removed[user_id]), assume_unique=True)
+        if added.get(user_id):
+            row = np.union1d(row, _ids(added[user_id]))
+        return row
+
+    def follows(self, a, b):
+        """Does user `a` follow user `b`?"""
+
+        with self._lock:
+            if b in self._added_out.get(a, ()):
+                return True
+            return self._in_base(a, b) and b not in self._removed_out.get(a, ())
+
+    def following(self, user_id):
+        """Sorted list of the ids `user_id` follows."""
+
+        with self._lock:
+            return self._neighbours(self.out_indptr, self.out_indices,
+                                    self._removed_out, self._added_out,
+                                    user_id).tolist()
+
+    def followers(self, user_id):
+        """Sorted list of the ids following `user_id`."""
+
+        with self._lock:
+            return self._neighbours(self.in_indptr, self.in_indices,
+                                    self._removed_in, self._added_in,
+                                    user_id).tolist()
+
+    def following_among(self, user_id, among):
+        """Which of the ids in `among` `user_id` follows, as a set."""
+
+        with self._lock:
+            row = self._neighbours(self.out_indptr, self.out_indices,
+                                   self._removed_out, self._added_out, user_id)
+            among = _ids(among)
+            return set(among[np.isin(among, row)].tolist())
+
+    def following_count(self, user_id):
+        with self._lock:
+            row = self._base_row(self.out_indptr, self.out_indices, user_id)
+            return (len(row) - len(self._removed_out.get(user_id, ()))
+                    + len(self._added_out.get(user_id, ())))
+
+    def followers_count(self, user_id):
+        with self._lock:
+            row = self._base_row(self.in_indptr, self.in_indices, user_id)
+            return (len(row) - len(self._removed_in.get(user_id, ()))
+                    + len(self._added_in.get(user_id, ())))
+
+
+def _ids(ids):
+    return np.fromiter(ids, dtype=np.int64)
+
+
+def shared_graph():
+    """This process's up-to-date SharedGraph, or None if there isn't one.
+
+    None when ``FOLLOW_GRAPH_DIR`` or ``FOLLOW_GRAPH_SINGLE_HOST`` isn't
+    set, or the snapshot is missing or older than ``FOLLOW_GRAPH_MAX_AGE``;
+    callers then ask the database instead.
+    """
+
+    directory = _directory()
+    if not directory:
+        return None
+
+    graph = _graph(directory)
+    max_age = current_app.config['FOLLOW_GRAPH_REFRESH_MS'] / 1000
+    if not graph.refresh(max_age):
+        return None
+    if _too_old(graph.built_at, current_app.config['FOLLOW_GRAPH_MAX_AGE']):
+        return None
+    return graph
+
+
+def _directory():
+    """FOLLOW_GRAPH_DIR, if the graph is in use here."""
+
+    if not has_app_context():
+        return None
+    if not current_app.config['FOLLOW_GRAPH_SINGLE_HOST']:
+        return None
+    return current_app.config.get('FOLLOW_GRAPH_DIR')
+
+
+def _too_old(built_at, max_age):
+    return built_at is None or time.time() - built_at > max_age
+
+
+def _graph(directory):
+    with _graphs_lock:
+        graph = _graphs.get(directory)
+        if graph is None:
+            graph = _graphs[directory] = SharedGraph(directory)
+        return graph
+
+
+def record_follow_change(op, a, b=0):
+    """Log a committed change to the follows table for every worker.
+
+    `op` is FOLLOW or UNFOLLOW (user `a` and user `b`) or DELETE_USER (user
+    `a`). A rebuild job is added to the session when the write fails, once
+    the log holds ``FOLLOW_GRAPH_MAX_DELTAS`` records, or once the snapshot
+    is half ``FOLLOW_GRAPH_MAX_AGE`` old; committing it is up to the caller.
+    """
+
+    record_follow_changes([(op, a, b)])
+
+
+def record_follow_changes(changes):
+    """record_follow_change() for each (op, a, b) in `changes`, in one write."""
+
+    if not changes:
+        return
+
+    directory = _directory()
+    generation = directory and _read_generation(directory, 'WRITING')
+    if not generation:
+        return
+
+    # O_APPEND writes land whole, whichever process wins.
+    data = b''.join(_RECORD.pack(op, a, b) for op, a, b in changes)
+    try:
+        fd = os.open(_log_path(directory, generation),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+    except OSError:
+        # The change is committed; the rebuild will pick it up from the table.
+        current_app.logger.exception("Logging a follow graph change failed")
+        size = None
+
+    # This process reads its own writes straight away.
+    _graph(directory).expire()
+
+    config = current_app.config
+    built_at = _built_at(directory, _read_generation(directory, 'CURRENT'))
+    if (size is None
+            or size >= config['FOLLOW_GRAPH_MAX_DELTAS'] * _RECORD.size
+            or _too_old(built_at, config['FOLLOW_GRAPH_MAX_AGE'] / 2)):
+        from jobs import enqueue
+        enqueue('rebuild_follow_graph', idempotency_key='rebuild_follow_graph')
+
+
+@graph_cli.command('rebuild')
+def rebuild_command():
+    """Write a fresh snapshot of the follows table."""
+
+    generation = rebuild(current_app.config['FOLLOW_GRAPH_DIR'])
+    click.echo(f"Follow graph generation {generation} written.")
+
+
+def init_follow_graph(app):
+    """Register the graph CLI on `app` and apply default config."""
+
+    app.config.setdefault('FOLLOW_GRAPH_DIR', os.environ.get('FOLLOW_GRAPH_DIR'))
+    app.config.setdefault('FOLLOW_GRAPH_MAX_DELTAS', 100000)
+    app.config.setdefault('FOLLOW_GRAPH_REFRESH_MS', 100)
+    # Set only if every process that changes follows runs on this host.
+    app.config.setdefault('FOLLOW_GRAPH_SINGLE_HOST',
+                          bool(os.environ.get('FOLLOW_GRAPH_SINGLE_HOST')))
+    app.config.setdefault('FOLLOW_GRAPH_MAX_AGE', 24 * 60 * 60)
+    app.cli.add_command(graph_cli)
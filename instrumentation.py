@@ -0,0 +1,214 @@
+"""Per-request SQL instrumentation for Warbler.
+
+Every statement sent through a SQLAlchemy engine is timed by two engine
+event listeners. While a request is being handled, the timings are gathered
+into a QueryStats on ``g.query_stats``; when it finishes they are reported in
+a ``Server-Timing`` header and a one-line JSON log record on the
+``warbler.sql`` logger.
+
+Routes that run the same statement shape over and over (the classic N+1 from
+touching a relationship inside a loop) are flagged: a warning is logged when
+any shape repeats more than ``SQL_REPEAT_THRESHOLD`` times, and with
+``SQL_REPEAT_RAISE`` set the request fails with RepeatedQueryError instead.
+
+Outside of requests, ``record_queries()`` collects the same numbers for a
+block of code:
+
+    with record_queries() as stats:
+        client.get('/')
+    print(stats.count)
+"""
+
+import heapq
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.sql')
+
+# How many of the slowest statements each QueryStats keeps.
+SLOWEST_KEPT = 5
+
+# Callables run after every statement as
+# fn(conn, statement, parameters, duration); other modules (e.g. the slow
+# query log) hook in here.
+query_observers = []
+
+_local = threading.local()
+
+
+class RepeatedQueryError(Exception):
+    """A request ran the same statement shape more times than allowed."""
+
+
+class QueryStats:
+    """Query count, DB time and statement shapes for one unit of work."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self._slowest = []
+
+    def record(self, statement, duration):
+        """Add one executed statement taking `duration` seconds."""
+
+        shape = statement_shape(statement)
+
+        self.count += 1
+        self.duration += duration
+        self.shapes[shape] += 1
+
+        entry = (duration, self.count, shape)
+        if len(self._slowest) < SLOWEST_KEPT:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    @property
+    def slowest(self):
+        """[(duration, shape)] for the slowest statements, slowest first."""
+
+        return [(duration, shape)
+                for duration, _, shape in sorted(self._slowest, reverse=True)]
+
+    def repeated(self, threshold):
+        """[(shape, count)] for shapes run more than `threshold` times."""
+
+        return [(shape, count)
+                for shape, count in self.shapes.most_common()
+                if count > threshold]
+
+
+_WHITESPACE = re.compile(r'\s+')
+# A colon not preceded by another, so Postgres ``::type`` casts survive.
+_PARAM = re.compile(r'%\(\w+\)s|(?<!:):\w+|\?|\$\d+')
+_NUMBER = re.compile(r'\b\d+(\.\d+)?\b')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PARAM_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def statement_shape(statement):
+    """Normalise a SQL statement so calls differing only in values match.
+
+    Placeholders and literals become ``?`` and expanded IN lists collapse to
+    ``(?+)``, so ``WHERE id IN (?, ?, ?)`` and ``WHERE id IN (?)`` share a
+    shape.
+    """
+
+    shape = _WHITESPACE.sub(' ', statement).strip()
+    shape = _STRING.sub('?', shape)
+    shape = _PARAM.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    return _PARAM_LIST.sub('(?+)', shape)
+
+
+def _collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+@contextmanager
+def record_queries():
+    """Collect a QueryStats for every statement run inside the block."""
+
+    stats = QueryStats()
+    collectors = _collectors()
+    collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        collectors.remove(stats)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+
+    for stats in _collectors():
+        stats.record(statement, duration)
+
+    for observer in query_observers:
+        observer(conn, statement, parameters, duration)
+
+
+def init_instrumentation(app):
+    """Install the per-request query hooks on `app`."""
+
+    app.config.setdefault('SQL_INSTRUMENTATION', True)
+    app.config.setdefault('SQL_REPEAT_THRESHOLD', 10)
+    app.config.setdefault('SQL_REPEAT_RAISE', False)
+
+    @app.before_request
+    def start_query_stats():
+        """Begin collecting query stats for this request."""
+
+        if app.config['SQL_INSTRUMENTATION']:
+            g.query_stats = QueryStats()
+            g.request_started = time.perf_counter()
+            _collectors().append(g.query_stats)
+
+    @app.after_request
+    def report_query_stats(response):
+        """Send this request's query stats out as headers and a log line."""
+
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+
+        _collectors().remove(stats)
+        total = time.perf_counter() - g.request_started
+
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries"')
+        response.headers.add('Server-Timing', f'app;dur={total * 1000:.2f}')
+
+        threshold = app.config['SQL_REPEAT_THRESHOLD']
+        repeated = stats.repeated(threshold)
+
+        logger.info(json.dumps({
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': stats.count,
+            'db_ms': round(stats.duration * 1000, 2),
+            'total_ms': round(total * 1000, 2),
+            'repeated': [{'count': count, 'sql': shape}
+                         for shape, count in repeated],
+            'slowest': [{'ms': round(duration * 1000, 2), 'sql': shape}
+                        for duration, shape in stats.slowest],
+        }))
+
+        if repeated:
+            shape, count = repeated[0]
+            message = (f"{request.endpoint} ran the same query {count} times "
+                       f"(limit {threshold}): {shape}")
+            if app.config['SQL_REPEAT_RAISE']:
+                raise RepeatedQueryError(message)
+            logger.warning(message)
+
+        return response
+
+    @app.teardown_request
+    def discard_query_stats(exc):
+        """Stop collecting if the request died before after_request ran."""
+
+        stats = g.pop('query_stats', None)
+        if stats is not None and stats in _collectors():
+            _collectors().remove(stats)
@@ -0,0 +1,407 @@
+"""Background job queue for Warbler.
+
+Jobs are rows in the ``jobs`` table, so enqueueing one joins the request's
+own transaction: if the request rolls back, the job never existed. Worker
+processes (``flask jobs work``) claim queued jobs with a conditional UPDATE,
+which is safe across processes on both Postgres and SQLite, run the
+registered handler and retry failures with exponential backoff. While a
+handler runs, its worker renews the job's lease (``heartbeat_at``) every
+``HEARTBEAT_INTERVAL`` seconds; workers periodically put back jobs whose
+lease has lapsed, since their worker must have died.
+
+Handlers are registered with the ``@job`` decorator and receive the job's
+payload as keyword arguments:
+
+    @job('purge_user')
+    def purge_user(user_id):
+        ...
+
+    enqueue('purge_user', {'user_id': 42}, idempotency_key='purge_user:42')
+
+With ``JOBS_EAGER`` set in the app config, jobs run inline as soon as they
+are enqueued (handy for tests and one-off scripts).
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, update
+from sqlalchemy.exc import IntegrityError
+
+from metrics import add_collector
+from models import db, writes, Job
+
+HANDLERS = {}
+
+# Seconds between polls when the queue is empty.
+POLL_INTERVAL = 1.0
+
+# Seconds between heartbeats of a running job.
+HEARTBEAT_INTERVAL = 30
+
+# Running jobs without a heartbeat for this long are assumed to belong to a
+# dead worker and are put back on the queue.
+STALE_AFTER = timedelta(minutes=2)
+
+# Seconds between a worker's checks for such jobs.
+STALE_CHECK_INTERVAL = 60
+
+# How many recently finished jobs feed the latency numbers in queue_stats().
+LATENCY_SAMPLE = 100
+
+
+def job(name):
+    """Register the decorated function as the handler for jobs called `name`."""
+
+    def decorator(fn):
+        HANDLERS[name] = fn
+        return fn
+
+    return decorator
+
+
+def enqueue(name, payload=None, idempotency_key=None, delay=0, max_attempts=5):
+    """Queue a job and return its row.
+
+    The job is added to the current session; it is committed along with the
+    caller's transaction. If `idempotency_key` matches a job that is still
+    queued or running, that job is returned instead of queueing a duplicate.
+    """
+
+    if name not in HANDLERS:
+        raise ValueError(f"No handler registered for job {name!r}")
+
+    if idempotency_key is not None:
+        existing = Job.query.filter_by(idempotency_key=idempotency_key).first()
+        if existing and existing.status in ('queued', 'running'):
+            return existing
+        if existing:
+            # Finished jobs give up their key so the work can be queued again.
+            existing.idempotency_key = None
+
+    now = datetime.utcnow()
+    new_job = Job(
+        name=name,
+        payload=payload or {},
+        idempotency_key=idempotency_key,
+        max_attempts=max_attempts,
+        enqueued_at=now,
+        run_at=now + timedelta(seconds=delay),
+    )
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(new_job)
+    except IntegrityError:
+        # Someone else queued the same key between our check and insert.
+        return Job.query.filter_by(idempotency_key=idempotency_key).one()
+
+    if current_app.config.get('JOBS_EAGER'):
+        _run(new_job)
+
+    return new_job
+
+
+def _claim_next():
+    """Claim the next runnable job for this worker, or return None."""
+
+    now = datetime.utcnow()
+    due = (Job.status == 'queued', Job.run_at <= now)
+
+    # Polling an empty queue is only a read: don't take SQLite's write lock
+    # for it.
+    if db.session.query(Job.id).filter(*due).first() is None:
+        db.session.commit()
+        return None
+
+    with writes():
+        candidates = (db.session
+                      .query(Job.id)
+                      .filter(*due)
+                      .order_by(Job.run_at)
+                      .limit(10)
+                      .with_for_update(skip_locked=True)
+                      .all())
+
+        for (job_id,) in candidates:
+            # Only one worker can flip a given row from queued to running.
+            claimed = db.session.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == 'queued')
+                .values(status='running',
+                        started_at=now,
+                        heartbeat_at=now,
+                        attempts=Job.attempts + 1))
+            db.session.commit()
+            if claimed.rowcount == 1:
+                return db.session.get(Job, job_id)
+
+        db.session.commit()
+        return None
+
+
+def _run(claimed_job):
+    """Run a job's handler and record the outcome on its row."""
+
+    if current_app.config.get('JOBS_EAGER'):
+        # Eager jobs never went through _claim_next, and their row is part
+        # of the caller's transaction: run inline and let errors propagate.
+        # Handlers that commit as they go (delete_user does) commit the job
+        # row and the caller's changes so far with them; the caller commits
+        # the rest.
+        claimed_job.status = 'running'
+        claimed_job.started_at = datetime.utcnow()
+        claimed_job.attempts += 1
+        HANDLERS[claimed_job.name](**claimed_job.payload)
+        claimed_job.status = 'done'
+        claimed_job.finished_at = datetime.utcnow()
+        return True
+
+    with writes():
+        return _run_claimed(claimed_job)
+
+
+def _run_claimed(claimed_job):
+    """Run a job claimed by this worker; see _run."""
+
+    job_id = claimed_job.id
+
+    try:
+        handler = HANDLERS.get(claimed_job.name)
+        if handler is None:
+            raise LookupError(f"No handler registered for job "
+                              f"{claimed_job.name!r}")
+        with _Heartbeat(current_app._get_current_object(), job_id):
+            handler(**claimed_job.payload)
+
+    except Exception as exc:
+        db.session.rollback()
+        failed = db.session.get(Job, job_id)
+        failed.last_error = f"{type(exc).__name__}: {exc}"
+        if failed.attempts >= failed.max_attempts:
+            failed.status = 'failed'
+            failed.finished_at = datetime.utcnow()
+            current_app.logger.error("Job %s failed permanently: %s",
+                                     job_id, failed.last_error)
+        else:
+            failed.status = 'queued'
+            failed.run_at = (datetime.utcnow()
+                             + timedelta(seconds=2 ** failed.attempts))
+            current_app.logger.warning("Job %s failed, retrying: %s",
+                                       job_id, failed.last_error)
+        db.session.commit()
+        return False
+
+    done = db.session.get(Job, job_id)
+    done.status = 'done'
+    done.finished_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+
+class _Heartbeat:
+    """Renews a running job's lease from a background thread.
+
+    Its own connection and transaction, so a handler's long transaction
+    doesn't hold the heartbeat back.
+    """
+
+    def __init__(self, app, job_id, interval=HEARTBEAT_INTERVAL):
+        self.app = app
+        self.job_id = job_id
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+    def _beat(self):
+        with self.app.app_context():
+            while not self._stopped.wait(self.interval):
+                try:
+                    with db.engine.begin() as connection:
+                        connection.execute(
+                            update(Job)
+                            .where(Job.id == self.job_id,
+                                   Job.status == 'running')
+                            .values(heartbeat_at=datetime.utcnow()))
+                except Exception:
+                    current_app.logger.exception(
+                        "Heartbeat for job %s failed", self.job_id)
+
+
+def requeue_stale():
+    """Put jobs abandoned by crashed workers back on the queue.
+
+    Jobs that have used up their attempts fail instead. Returns how many
+    were requeued.
+    """
+
+    now = datetime.utcnow()
+    stale = (Job.status == 'running',
+             func.coalesce(Job.heartbeat_at, Job.started_at) < now - STALE_AFTER)
+
+    db.session.execute(
+        update(Job)
+        .where(*stale, Job.attempts >= Job.max_attempts)
+        .values(status='failed', finished_at=now,
+                last_error="Worker stopped responding"))
+    result = db.session.execute(
+        update(Job)
+        .where(*stale)
+        .values(status='queued', run_at=now))
+    db.session.commit()
+    return result.rowcount
+
+
+def run_worker(burst=False, poll_interval=POLL_INTERVAL):
+    """Process jobs until stopped.
+
+    With `burst`, return as soon as the queue is empty. Returns the number of
+    jobs processed.
+    """
+
+    processed = 0
+    next_stale_check = 0
+
+    while True:
+        if time.monotonic() >= next_stale_check:
+            requeue_stale()
+            next_stale_check = time.monotonic() + STALE_CHECK_INTERVAL
+
+        claimed_job = _claim_next()
+
+        if claimed_job is None:
+            if burst:
+                return processed
+            time.sleep(poll_interval)
+            continue
+
+        _run(claimed_job)
+        processed += 1
+
+
+def queue_stats():
+    """Return queue length and latency figures as a dict.
+
+    `wait_seconds` is the average time recent jobs spent queued before a
+    worker picked them up; `run_seconds` is how long they took to run.
+    """
+
+    counts = dict(db.session
+                  .query(Job.status, func.count(Job.id))
+                  .group_by(Job.status)
+                  .all())
+
+    oldest = (db.session
+              .query(func.min(Job.enqueued_at))
+              .filter(Job.status == 'queued')
+              .scalar())
+
+    recent = (db.session
+              .query(Job.enqueued_at, Job.started_at, Job.finished_at)
+              .filter(Job.status == 'done')
+              .order_by(Job.finished_at.desc())
+              .limit(LATENCY_SAMPLE)
+              .all())
+
+    now = datetime.utcnow()
+    waits = [(started - enqueued).total_seconds()
+             for enqueued, started, _ in recent]
+    runs = [(finished - started).total_seconds()
+            for _, started, finished in recent]
+
+    return {
+        'queued': counts.get('queued', 0),
+        'running': counts.get('running', 0),
+        'done': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'oldest_queued_seconds': (now - oldest).total_seconds() if oldest else 0,
+        'wait_seconds': sum(waits) / len(waits) if waits else 0,
+        'run_seconds': sum(runs) / len(runs) if runs else 0,
+    }
+
+
+##############################################################################
+# CLI: flask jobs work / flask jobs stats
+
+jobs_cli = AppGroup('jobs', help="Run and inspect the background job queue.")
+
+
+def _work_in_child(app, burst):
+    """Entry point for forked worker processes."""
+
+    with app.app_context():
+        # Connections inherited from the parent must not be shared.
+        db.engine.dispose(close=False)
+        run_worker(burst=burst)
+
+
+@jobs_cli.command('work')
+@click.option('--processes', default=1, help="Number of worker processes.")
+@click.option('--burst', is_flag=True, help="Exit once the queue is empty.")
+def work_command(processes, burst):
+    """Start job workers."""
+
+    if processes == 1:
+        processed = run_worker(burst=burst)
+        click.echo(f"Processed {processed} jobs")
+        return
+
+    app = current_app._get_current_object()
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=_work_in_child, args=(app, burst))
+               for _ in range(processes)]
+
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    """Print queue length and latency as JSON."""
+
+    click.echo(json.dumps(queue_stats(), indent=2))
+
+
+def queue_gauges():
+    """Report queue_stats() to the /metrics endpoint."""
+
+    stats = queue_stats()
+    return [
+        ('warbler_jobs', "Jobs by status.", {'status': status}, stats[status])
+        for status in ('queued', 'running', 'done', 'failed')
+    ] + [
+        ('warbler_jobs_oldest_queued_seconds',
+         "Age of the oldest job still waiting.", {},
+         stats['oldest_queued_seconds']),
+        ('warbler_jobs_wait_seconds',
+         "Average queue wait of recently finished jobs.", {},
+         stats['wait_seconds']),
+        ('warbler_jobs_run_seconds',
+         "Average run time of recently finished jobs.", {},
+         stats['run_seconds']),
+    ]
+
+
+def init_jobs(app):
+    """Register the jobs CLI on `app` and apply default config."""
+
+    app.config.setdefault('JOBS_EAGER', bool(os.environ.get('JOBS_EAGER')))
+    app.cli.add_command(jobs_cli)
+    add_collector(queue_gauges)
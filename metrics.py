@@ -0,0 +1,355 @@
+"""Prometheus-style metrics for Warbler, served at ``/metrics``.
+
+Each process keeps its counters and histograms in memory; recording a value
+is a couple of dict updates under a lock. When ``METRICS_DIR`` is set (as it
+should be under gunicorn), every process also writes a snapshot of its
+numbers to ``METRICS_DIR/metrics-<pid>.json`` at most once every
+``METRICS_FLUSH_INTERVAL`` seconds, and whichever worker answers a scrape
+adds up the snapshots of all of them. Snapshots of exited workers are kept
+so counters never go backwards; empty the directory when the server starts.
+
+Only addresses in ``METRICS_ALLOWED_IPS`` (loopback by default) may scrape,
+unless the scraper sends ``METRICS_TOKEN`` as a bearer token. Behind load
+balancers or reverse proxies, set ``PROXY_HOPS`` to how many of them there
+are so the client's own address is checked; until then a request that came
+through a proxy (one with ``X-Forwarded-For``) needs the token.
+
+Metrics are declared once with ``counter()`` or ``histogram()`` and then
+recorded with ``inc()`` / ``observe()``:
+
+    BCRYPT = histogram('warbler_bcrypt_seconds', "Time spent in bcrypt.")
+    observe(BCRYPT, 0.25, op='hash')
+
+Numbers that are cheaper to compute at scrape time (queue length, for
+instance) come from collectors registered with ``add_collector()``. Each
+collector runs at most once every ``METRICS_COLLECT_INTERVAL`` seconds per
+process; scrapes in between get its last numbers.
+"""
+
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, abort, g, request, template_rendered, before_render_template
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_definitions = {}
+_counters = {}
+_histograms = {}
+_collectors = []
+_collected = {}
+_lock = threading.Lock()
+_last_flush = 0.0
+
+
+def counter(name, help_text):
+    """Declare a counter and return its name."""
+
+    _definitions[name] = ('counter', help_text, None)
+    return name
+
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS):
+    """Declare a histogram with upper bounds `buckets` and return its name."""
+
+    _definitions[name] = ('histogram', help_text, tuple(buckets))
+    return name
+
+
+def add_collector(fn):
+    """Register fn() -> [(name, help, labels, value)] gauges for scrapes."""
+
+    if fn not in _collectors:
+        _collectors.append(fn)
+
+
+def inc(name, value=1, **labels):
+    """Add `value` to a counter."""
+
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """Record one observation of `value` in a histogram."""
+
+    buckets = _definitions[name][2]
+    key = (name, tuple(sorted(labels.items())))
+
+    with _lock:
+        series = _histograms.get(key)
+        if series is None:
+            # One slot per bucket plus +Inf, then sum and count.
+            series = _histograms[key] = [0] * (len(buckets) + 3)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[len(buckets)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+
+@contextmanager
+def timed(name, **labels):
+    """Observe how long the block takes in histogram `name`."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+REQUEST_SECONDS = histogram(
+    'warbler_request_duration_seconds', "Request latency by route.")
+REQUEST_DB_SECONDS = histogram(
+    'warbler_request_db_seconds', "Time spent in the database per request.")
+REQUEST_QUERIES = histogram(
+    'warbler_request_queries', "SQL statements per request.", COUNT_BUCKETS)
+TEMPLATE_SECONDS = histogram(
+    'warbler_template_render_seconds', "Jinja template render time.")
+BCRYPT_SECONDS = histogram(
+    'warbler_bcrypt_seconds', "Time spent hashing or checking passwords.")
+
+
+##############################################################################
+# Cross-process snapshots
+
+
+def _snapshot():
+    with _lock:
+        return {
+            'counters': [[name, list(labels), value]
+                         for (name, labels), value in _counters.items()],
+            'histograms': [[name, list(labels), list(series)]
+                           for (name, labels), series in _histograms.items()],
+        }
+
+
+def flush(directory):
+    """Write this process's numbers to its snapshot file in `directory`."""
+
+    global _last_flush
+
+    # Counted from the attempt, so a failing disk isn't retried on every
+    # request.
+    _last_flush = time.monotonic()
+
+    path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as snapshot_file:
+        json.dump(_snapshot(), snapshot_file)
+    os.replace(tmp_path, path)
+
+
+def _merged(directory):
+    """Add up the snapshots of every process, using live numbers for ours."""
+
+    counters = {}
+    histograms = {}
+    snapshots = []
+
+    if directory:
+        own = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, ValueError):
+                # A worker is mid-write or just exited; skip it this scrape.
+                continue
+
+    snapshots.append(_snapshot())
+
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, series in snapshot['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            total = histograms.setdefault(key, [0] * len(series))
+            for i, value in enumerate(series):
+                total[i] += value
+
+    return counters, histograms
+
+
+##############################################################################
+# Prometheus text format
+
+
+def _escape(value):
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    inner = ','.join(f'{key}="{_escape(value)}"' for key, value in pairs)
+    return '{' + inner + '}'
+
+
+def _collect(collector, max_age):
+    """collector()'s gauges, reused if collected less than `max_age` ago."""
+
+    now = time.monotonic()
+    with _lock:
+        collected = _collected.get(collector)
+    if collected is not None and now - collected[0] < max_age:
+        return collected[1]
+
+    gauges = list(collector())
+    with _lock:
+        _collected[collector] = (now, gauges)
+    return gauges
+
+
+def render(directory=None, max_age=0):
+    """Return every metric in Prometheus text exposition format.
+
+    Collectors that ran less than `max_age` seconds ago aren't run again.
+    """
+
+    counters, histograms = _merged(directory)
+    lines = []
+
+    for name, (kind, help_text, buckets) in sorted(_definitions.items()):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+        if kind == 'counter':
+            for (series_name, labels), value in sorted(counters.items()):
+                if series_name == name:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+            continue
+
+        for (series_name, labels), series in sorted(histograms.items()):
+            if series_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), series):
+                cumulative += count
+                bucket_labels = labels + (('le', bound),)
+                lines.append(
+                    f'{name}_bucket{_labels(bucket_labels)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {series[-2]}')
+            lines.append(f'{name}_count{_labels(labels)} {series[-1]}')
+
+    described = set()
+    for collector in _collectors:
+        for name, help_text, labels, value in _collect(collector, max_age):
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name}{_labels(tuple(labels.items()))} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+##############################################################################
+# Flask wiring
+
+
+def init_metrics(app):
+    """Time every request on `app` and serve the numbers at /metrics."""
+
+    app.config.setdefault('METRICS_DIR', os.environ.get('METRICS_DIR'))
+    app.config.setdefault('METRICS_FLUSH_INTERVAL', 5)
+    # Scrapes must come from one of these addresses or bring the token as
+    # "Authorization: Bearer <token>".
+    app.config.setdefault('METRICS_ALLOWED_IPS', os.environ.get(
+        'METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(','))
+    app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+    # Load balancers or proxies in front of the app. ProxyFix takes the
+    # client's address from their X-Forwarded-For for every request.
+    app.config.setdefault('PROXY_HOPS', int(os.environ.get('PROXY_HOPS', 0)))
+    # Seconds a collector's gauges are reused; about the scrape interval.
+    app.config.setdefault('METRICS_COLLECT_INTERVAL', 15)
+
+    if app.config['PROXY_HOPS']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'])
+
+    if app.config['METRICS_DIR']:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+
+    @app.before_request
+    def start_request_timer():
+        """Note when this request started."""
+
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        """Record latency, DB time and query count for the matched route."""
+
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe(REQUEST_SECONDS, time.perf_counter() - started,
+                route=route, method=request.method)
+
+        stats = g.get('query_stats')
+        if stats is not None:
+            observe(REQUEST_DB_SECONDS, stats.duration, route=route)
+            observe(REQUEST_QUERIES, stats.count, route=route)
+
+        directory = app.config['METRICS_DIR']
+        interval = app.config['METRICS_FLUSH_INTERVAL']
+        if directory and time.monotonic() - _last_flush >= interval:
+            try:
+                flush(directory)
+            except OSError:
+                # The user's request succeeded; only the metrics suffer.
+                app.logger.exception("Writing the metrics snapshot failed")
+
+        return response
+
+    def start_template_timer(sender, template, context, **extra):
+        g.setdefault('template_started', []).append(time.perf_counter())
+
+    def stop_template_timer(sender, template, context, **extra):
+        started = g.get('template_started')
+        if started:
+            observe(TEMPLATE_SECONDS, time.perf_counter() - started.pop(),
+                    template=template.name)
+
+    before_render_template.connect(start_template_timer, app, weak=False)
+    template_rendered.connect(stop_template_timer, app, weak=False)
+
+    @app.route('/metrics')
+    def metrics():
+        """Expose metrics for Prometheus to scrape."""
+
+        # Without PROXY_HOPS, a proxied request's remote_addr is the proxy's.
+        proxied = ('X-Forwarded-For' in request.headers
+                   and not app.config['PROXY_HOPS'])
+        allowed = (not proxied
+                   and request.remote_addr in app.config['METRICS_ALLOWED_IPS'])
+
+        token = app.config['METRICS_TOKEN']
+        offered = request.headers.get('Authorization', '')
+        if not (allowed
+                or token and hmac.compare_digest(offered, f'Bearer {token}')):
+            abort(403)
+
+        return Response(render(app.config['METRICS_DIR'],
+                               app.config['METRICS_COLLECT_INTERVAL']),
+                        mimetype='text/plain; version=0.0.4')
@@ -1,14 +1,120 @@
 """SQLAlchemy models for Warbler."""
 
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
 
+from flask import has_request_context, request
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from followgraph import shared_graph
+from metrics import timed, BCRYPT_SECONDS
+from replicas import replica_engine
+
+
+class WarblerSession(Session):
+    """Flask-SQLAlchemy session that honours an explicit `bind`.
+
+    Flask-SQLAlchemy always picks an engine by bind key; tests bind the
+    session to a connection with an open transaction instead, so that
+    everything a test does can be rolled back. Otherwise reads may be sent
+    to a replica (see replicas.py).
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.bind is not None:
+            return self.bind
+        if bind is None:
+            replica = replica_engine(clause, self._flushing)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': WarblerSession})
+
+
+# Applied to every SQLite connection. WAL lets readers carry on while a
+# writer commits; synchronous=NORMAL is durable across app crashes in WAL
+# mode (only an OS crash can lose the last commits); the page cache and
+# memory map keep hot pages out of syscalls. (In-memory test databases
+# quietly ignore the ones that don't apply.)
+SQLITE_PRAGMAS = {
+    'foreign_keys': 'ON',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite(dbapi_connection, connection_record):
+    """Make SQLite behave like the Postgres setup the app expects.
+
+    SQLite ignores ON DELETE CASCADE unless foreign keys are switched on, and
+    the sqlite3 driver's own transaction handling breaks SAVEPOINTs, so we
+    take over and emit BEGIN ourselves (see begin_sqlite_transaction).
+    """
+
+    if type(dbapi_connection).__module__.startswith('sqlite3'):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+
+# Set by writes(): the work in progress will write to the database.
+_writing = ContextVar('writing', default=False)
 
 
+@contextmanager
+def writes():
+    """Mark the transactions begun inside the block as ones that write.
+
+    On SQLite they take the write lock up front (see
+    begin_sqlite_transaction); elsewhere this does nothing.
+    """
+
+    token = _writing.set(True)
+    try:
+        yield
+    finally:
+        _writing.reset(token)
+
+
+@event.listens_for(Engine, "begin")
+def begin_sqlite_transaction(conn):
+    """Start SQLite transactions ourselves (see configure_sqlite).
+
+    A deferred transaction that reads and then writes can't wait for another
+    writer: SQLite fails it with "database is locked" at once, whatever the
+    busy timeout. So work that reads and then writes takes the write lock up
+    front with BEGIN IMMEDIATE: requests with unsafe methods (POST and
+    friends), and anything run under writes(), such as job handlers and
+    archiving. Everything else, including background refreshes and job
+    polling, starts deferred and leaves the lock to writers.
+    """
+
+    if conn.dialect.name != 'sqlite':
+        return
+
+    writing = _writing.get() or (
+        has_request_context() and request.method not in ('GET', 'HEAD'))
+    mode = 'IMMEDIATE' if writing else 'DEFERRED'
+
+    # Straight to the driver, so BEGIN doesn't show up as a query in the
+    # instrumentation (psycopg2 doesn't issue one visibly either).
+    conn.connection.dbapi_connection.execute(f"BEGIN {mode}")
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -27,6 +133,14 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key starts with the followed user, which covers follower
+    # lookups; "who does X follow" needs its own index. Both end with the
+    # other user's id, so either list can be paged through in id order.
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -46,7 +160,12 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        index=True,
+    )
+
+    # A user likes a message at most once; many users can like the same one.
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
     )
 
 
@@ -95,25 +214,37 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Set as soon as the account is deleted, which hides it everywhere; the
+    # row itself goes once the delete_user job has purged everything else.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # passive_deletes: deleting a user must not load these collections; the
+    # ON DELETE CASCADE foreign keys clean up the rows in the database.
+
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -128,8 +259,98 @@ class User(db.Model):
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        if 'following' not in db.inspect(self).unloaded:
+            return other_user in self.following
+
+        graph = shared_graph()
+        if graph is not None:
+            return graph.follows(self.id, other_user.id)
+
+        # Don't load the whole collection just to look for one user.
+        return db.session.query(
+            db.exists().where(
+                Follows.user_following_id == self.id,
+                Follows.user_being_followed_id == other_user.id,
+            )).scalar()
+
+    def following_ids(self, among=None):
+        """Set of ids this user follows, optionally only those in `among`."""
+
+        graph = shared_graph()
+        if graph is not None:
+            if among is None:
+                return set(graph.following(self.id))
+            return graph.following_among(self.id, among)
+
+        query = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == self.id))
+        if among is not None:
+            query = query.filter(Follows.user_being_followed_id.in_(among))
+        return {user_id for (user_id,) in query}
+
+    def liked_ids(self, among):
+        """Set of the message ids in `among` that this user has liked."""
+
+        query = (db.session
+                 .query(Likes.message_id)
+                 .filter(Likes.user_id == self.id, Likes.message_id.in_(among)))
+        return {message_id for (message_id,) in query}
+
+    def counts(self):
+        """Count messages, following, followers and likes in one query."""
+
+        return User.counts_for(self.id)
+
+    @staticmethod
+    def counts_for(user_id, suggestions=0):
+        """counts() for the user with id `user_id`, without loading them.
+
+        Follow counts come from the shared follow graph when there is one.
+        With `suggestions`, the same query also fetches that many "who to
+        follow" cards, as a list under the 'suggestions' key.
+        """
+
+        from recommendations import suggestion_cards, suggestions_column
+
+        def count(column, condition):
+            return (db.select(db.func.count(column))
+                    .where(condition)
+                    .scalar_subquery())
+
+        # Archived messages and likes still count.
+        messages = (count(Message.id, Message.user_id == user_id)
+                    + count(ArchivedMessage.id, ArchivedMessage.user_id == user_id))
+        likes = (count(Likes.id, Likes.user_id == user_id)
+                 + count(ArchivedLike.message_id, ArchivedLike.user_id == user_id))
+
+        extra = [suggestions_column(user_id, suggestions)] if suggestions else []
+
+        graph = shared_graph()
+        if graph is not None:
+            messages, likes, *rest = db.session.execute(
+                db.select(messages, likes, *extra)).one()
+            counts = dict(messages=messages,
+                          following=graph.following_count(user_id),
+                          followers=graph.followers_count(user_id),
+                          likes=likes)
+        else:
+            row = db.session.execute(db.select(
+                messages,
+                count(Follows.user_being_followed_id,
+                      Follows.user_following_id == user_id),
+                count(Follows.user_following_id,
+                      Follows.user_being_followed_id == user_id),
+                likes,
+                *extra,
+            )).one()
+            counts = dict(zip(('messages', 'following', 'followers', 'likes'),
+                              row))
+            rest = row[4:]
+
+        if suggestions:
+            counts['suggestions'] = suggestion_cards(rest[0])
+        return counts
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -138,7 +359,8 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        with timed(BCRYPT_SECONDS, op='hash'):
+            hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -161,10 +383,11 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with timed(BCRYPT_SECONDS, op='check'):
+                is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
 
@@ -189,7 +412,8 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        index=True,
     )
 
     user_id = db.Column(
@@ -200,6 +424,299 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # Profile pages and timelines read a user's messages newest first. Ids
+    # are never reused, so they stay unique across messages_archive too.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+        {'sqlite_autoincrement': True},
+    )
+
+
+class MessageTag(db.Model):
+    """A #tag used in a message (see tags.py)."""
+
+    __tablename__ = 'message_tags'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # "Messages tagged #x", newest first.
+    __table_args__ = (
+        db.Index('ix_message_tags_tag_message_id', 'tag', 'message_id'),
+    )
+
+
+class Mention(db.Model):
+    """A user @mentioned in a message (see tags.py)."""
+
+    __tablename__ = 'mentions'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # "Messages mentioning X", newest first.
+    __table_args__ = (
+        db.Index('ix_mentions_user_id_message_id', 'user_id', 'message_id'),
+    )
+
+
+class TagCount(db.Model):
+    """How often a tag was used in one time bucket (see tags.py)."""
+
+    __tablename__ = 'tag_counts'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # Trending sums every tag's buckets since some moment.
+    __table_args__ = (
+        db.Index('ix_tag_counts_bucket', 'bucket'),
+    )
+
+
+class Recommendation(db.Model):
+    """A ranked account suggestion for a user (see recommendations.py)."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    candidate_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+        index=True,
+    )
+
+    # How many of the people the user follows follow the candidate.
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+# Full-text index over messages.text, kept up to date by the database itself
+# on every insert, update and delete (queried in search.py). Postgres uses a
+# GIN index over the text's tsvector; SQLite uses an FTS5 table that mirrors
+# messages through triggers.
+MESSAGE_SEARCH_DDL = {
+    'postgresql': [
+        "CREATE INDEX IF NOT EXISTS ix_messages_text_search ON messages "
+        "USING GIN (to_tsvector('english', text))",
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+        "text, content='messages', content_rowid='id', "
+        "tokenize='porter unicode61')",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_insert "
+        "AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_delete "
+        "AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, text) "
+        "VALUES ('delete', old.id, old.text); "
+        "END",
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_update "
+        "AFTER UPDATE OF text ON messages BEGIN "
+        "INSERT INTO messages_fts (messages_fts, rowid, text) "
+        "VALUES ('delete', old.id, old.text); "
+        "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); "
+        "END",
+    ],
+}
+
+
+@event.listens_for(Message.__table__, "after_create")
+def create_message_search(target, connection, **kw):
+    """Build the full-text index along with the messages table."""
+
+    for statement in MESSAGE_SEARCH_DDL.get(connection.dialect.name, []):
+        connection.exec_driver_sql(statement)
+
+
+@event.listens_for(Message.__table__, "before_drop")
+def drop_message_search(target, connection, **kw):
+    """SQLite's FTS table isn't dropped with messages; do it ourselves."""
+
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql("DROP TABLE IF EXISTS messages_fts")
+
+
+class ArchivedMessage(db.Model):
+    """A message moved out of the hot table by archive.py.
+
+    On Postgres the table is partitioned by month of `timestamp`, so the
+    partitioning key is part of the primary key.
+    """
+
+    __tablename__ = 'messages_archive'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_id_timestamp', 'user_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+
+
+class ArchivedLike(db.Model):
+    """A like of an archived message."""
+
+    __tablename__ = 'likes_archive'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+        index=True,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work queued by a request (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    enqueued_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    started_at = db.Column(
+        db.DateTime,
+    )
+
+    # Refreshed by the worker while the job runs; see jobs.requeue_stale().
+    heartbeat_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} [{self.status}]>"
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -209,4 +726,6 @@ def connect_db(app):
     with app.app_context():
         db.app = app
         db.init_app(app)
-        db.create_all()
+        bcrypt.init_app(app)
+        if app.config.get('CREATE_SCHEMA', True):
+            db.create_all()
@@ -0,0 +1,212 @@
+""""Who to follow" suggestions from friends of friends.
+
+Suggestions are computed offline, by a job or cron:
+
+    flask --app server recommendations refresh
+
+That loads the whole ``follows`` table once, as two integer arrays, and
+turns it into CSR form: ``indices[indptr[u]:indptr[u + 1]]`` lists the users
+that ``u`` follows. Candidates for ``u`` are everyone two hops away, scored
+by how many of the people ``u`` follows follow them, less anyone ``u``
+already follows. Ties go to the more-followed account. All of it is
+vectorized NumPy over batches of ``BATCH_USERS`` users.
+
+Memory grows with the graph: the refresh holds the whole follows table, a
+few dozen bytes per follow. The two-hop expansion is capped on top of
+that. Only the first ``RECOMMENDATIONS_MAX_FANOUT`` accounts anyone follows
+are expanded, at either hop, so one batch is at most ``BATCH_USERS``
+times the cap squared pairs, however popular the accounts in it.
+
+The best ``RECOMMENDATIONS_TOP_K`` candidates for each user are stored in
+``recommendations`` in one transaction, so readers see the old set until
+the new one is complete. ``suggestions_for()`` reads them back with a single
+query, and ``suggestions_column()`` does the same as one JSON column of a
+bigger query.
+"""
+
+import json
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, insert, literal_column, select
+
+from models import db, Follows, Recommendation, User
+
+recommendations_cli = AppGroup(
+    'recommendations', help='Maintain "who to follow" suggestions.')
+
+# Users whose two-hop neighbourhoods are expanded at once.
+BATCH_USERS = 256
+
+# Rows per INSERT when storing the results.
+INSERT_BATCH = 5000
+
+
+class FollowGraph:
+    """The follows table as CSR arrays over dense user indices."""
+
+    def __init__(self, followers, followed):
+        # Dense indices 0..n-1 for every user id that appears in an edge.
+        self.user_ids, inverse = np.unique(
+            np.concatenate([followers, followed]), return_inverse=True)
+        self.size = len(self.user_ids)
+        sources = inverse[:len(followers)]
+        targets = inverse[len(followers):]
+
+        order = np.lexsort((targets, sources))
+        self.indices = targets[order]
+        self.indptr = np.zeros(self.size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=self.size),
+                  out=self.indptr[1:])
+
+        self.in_degree = np.bincount(targets, minlength=self.size)
+
+        # Every edge as one sortable integer, for membership tests.
+        self.edge_keys = np.sort(sources.astype(np.int64) * self.size + targets)
+
+    @classmethod
+    def load(cls):
+        """Read the whole follows table."""
+
+        rows = db.session.execute(
+            select(Follows.user_following_id, Follows.user_being_followed_id))
+        edges = np.array(rows.all(), dtype=np.int64).reshape(-1, 2)
+        return cls(edges[:, 0], edges[:, 1])
+
+    def neighbours(self, users, fanout):
+        """(source, target) arrays of each of `users`' first `fanout` edges."""
+
+        starts = self.indptr[users]
+        lengths = np.minimum(self.indptr[users + 1] - starts, fanout)
+        offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.repeat(starts, lengths) + (np.arange(lengths.sum())
+                                                  - offsets)
+        return np.repeat(users, lengths), self.indices[positions]
+
+    def follows(self, sources, targets):
+        """Elementwise: does sources[i] follow targets[i]?"""
+
+        keys = sources * self.size + targets
+        found = np.searchsorted(self.edge_keys, keys)
+        found[found == len(self.edge_keys)] = 0
+        return self.edge_keys[found] == keys
+
+    def top_candidates(self, users, top_k, fanout):
+        """(user, candidate, score) arrays: each of `users`' best `top_k`."""
+
+        sources, middles = self.neighbours(users, fanout)
+        # Second hop, remembering who we started from.
+        lengths = np.minimum(self.indptr[middles + 1] - self.indptr[middles],
+                             fanout)
+        origin = np.repeat(sources, lengths)
+        _, candidates = self.neighbours(middles, fanout)
+
+        keep = (candidates != origin) & ~self.follows(origin, candidates)
+        keys, scores = np.unique(origin[keep] * self.size + candidates[keep],
+                                 return_counts=True)
+        origin, candidates = np.divmod(keys, self.size)
+
+        # Best first within each user; then cut each user's run at top_k.
+        order = np.lexsort((candidates, -self.in_degree[candidates], -scores,
+                            origin))
+        origin, candidates, scores = (origin[order], candidates[order],
+                                      scores[order])
+        first = np.searchsorted(origin, origin)
+        rank = np.arange(len(origin)) - first
+        keep = rank < top_k
+        return origin[keep], candidates[keep], scores[keep], rank[keep]
+
+
+def refresh():
+    """Recompute and store every user's suggestions. Returns rows stored."""
+
+    top_k = current_app.config['RECOMMENDATIONS_TOP_K']
+    fanout = current_app.config['RECOMMENDATIONS_MAX_FANOUT']
+    graph = FollowGraph.load()
+
+    db.session.execute(delete(Recommendation))
+
+    stored = 0
+    for start in range(0, graph.size, BATCH_USERS):
+        users = np.arange(start, min(start + BATCH_USERS, graph.size))
+        origin, candidates, scores, ranks = graph.top_candidates(
+            users, top_k, fanout)
+
+        rows = [dict(user_id=int(user_id), rank=int(rank),
+                     candidate_id=int(candidate_id), score=int(score))
+                for user_id, candidate_id, score, rank in zip(
+                    graph.user_ids[origin], graph.user_ids[candidates],
+                    scores, ranks)]
+        for i in range(0, len(rows), INSERT_BATCH):
+            db.session.execute(insert(Recommendation), rows[i:i + INSERT_BATCH])
+        stored += len(rows)
+
+    db.session.commit()
+    return stored
+
+
+def _suggestions(user_id, limit):
+    already_followed = (select(Follows.user_being_followed_id)
+                        .where(Follows.user_following_id == user_id))
+    return (select(User.id, User.username, User.image_url,
+                   Recommendation.score, Recommendation.rank)
+            .join(Recommendation, Recommendation.candidate_id == User.id)
+            .where(Recommendation.user_id == user_id,
+                   Recommendation.candidate_id.not_in(already_followed),
+                   User.deleted_at.is_(None))
+            .order_by(Recommendation.rank)
+            .limit(limit))
+
+
+def suggestions_for(user_id, limit=5):
+    """User cards of `user_id`'s best suggestions they don't yet follow."""
+
+    rows = db.session.execute(_suggestions(user_id, limit))
+    return [{'id': id, 'username': username, 'image_url': image_url,
+             'score': score}
+            for id, username, image_url, score, _ in rows]
+
+
+def suggestions_column(user_id, limit=5):
+    """suggestions_for() as a scalar subquery of one JSON array, to select
+    along with other columns. Decode it with suggestion_cards()."""
+
+    found = _suggestions(user_id, limit).subquery()
+    fields = ('id', 'username', 'image_url', 'score', 'rank')
+    pairs = [part for field in fields
+             for part in (literal_column(f"'{field}'"), found.c[field])]
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        array = func.json_agg(func.json_build_object(*pairs))
+    else:
+        array = func.json_group_array(func.json_object(*pairs))
+    return select(array).select_from(found).scalar_subquery()
+
+
+def suggestion_cards(value):
+    """The cards in a suggestions_column() value, best first."""
+
+    if isinstance(value, str):
+        value = json.loads(value)
+    # JSON aggregates needn't keep the subquery's order.
+    cards = sorted(value or [], key=lambda card: card['rank'])
+    return [{field: card[field] for field in ('id', 'username', 'image_url',
+                                              'score')}
+            for card in cards]
+
+
+@recommendations_cli.command('refresh')
+def refresh_command():
+    """Recompute every user's "who to follow" suggestions."""
+
+    click.echo(f"Stored {refresh()} suggestions.")
+
+
+def init_recommendations(app):
+    """Register the recommendations CLI on `app` and apply default config."""
+
+    app.config.setdefault('RECOMMENDATIONS_TOP_K', 20)
+    app.config.setdefault('RECOMMENDATIONS_MAX_FANOUT', 200)
+    app.cli.add_command(recommendations_cli)
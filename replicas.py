@@ -0,0 +1,143 @@
+"""Read-replica routing.
+
+Replica databases are listed in ``DATABASE_REPLICA_URLS`` (comma-separated,
+read from the environment by default) and become Flask-SQLAlchemy binds
+named ``replica-0``, ``replica-1``, ... . Nothing else about the models
+changes; ``WarblerSession.get_bind`` asks ``replica_engine()`` whether a
+statement may go to a replica.
+
+A SELECT goes to a replica only when all of these hold:
+
+- the view is marked with ``@reads_from_replica``,
+- the request is a GET or HEAD,
+- nothing has been written yet in this request,
+- the visitor hasn't written anything in the last ``REPLICA_PIN_SECONDS``.
+
+The last rule gives read-your-writes: after any request that writes, a
+timestamp in the visitor's session pins them to the primary for long enough
+for the replicas to catch up, so the page they are redirected to shows what
+they just did. Everything else (writes, flushes, jobs, scripts) uses the
+primary, and so do cache fills (see cache.py): a shared cache entry
+outlives any pin.
+
+To try it locally, copy a SQLite database and point a replica at the copy:
+
+    cp warbler.db replica.db
+    DATABASE_URL=sqlite:///warbler.db \\
+    DATABASE_REPLICA_URLS=sqlite:///replica.db flask --app server run
+"""
+
+import os
+import random
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request, session
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from config import engine_options
+
+PIN_KEY = 'db_pinned_until'
+
+
+def reads_from_replica(view):
+    """Mark `view` as safe to serve from a possibly lagging replica."""
+
+    view.reads_from_replica = True
+    return view
+
+
+def replica_engine(clause, flushing):
+    """The replica engine to run `clause` on, or None for the primary."""
+
+    if flushing or not has_request_context():
+        return None
+
+    key = g.get('read_replica')
+    if key is None or g.get('db_wrote'):
+        return None
+
+    if clause is None or not getattr(clause, 'is_select', False):
+        return None
+
+    return current_app.extensions['sqlalchemy'].engines[key]
+
+
+@contextmanager
+def primary_reads():
+    """Send the current request's reads to the primary inside the block."""
+
+    if not has_request_context():
+        yield
+        return
+
+    replica = g.get('read_replica')
+    g.read_replica = None
+    try:
+        yield
+    finally:
+        g.read_replica = replica
+
+
+@event.listens_for(Session, "after_flush")
+def _note_flush(session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _note_write(orm_execute_state):
+    if has_request_context() and not orm_execute_state.is_select:
+        g.db_wrote = True
+
+
+def init_replicas(app):
+    """Register `app`'s replicas as binds and route reads to them.
+
+    Must run before the app is connected to the database.
+    """
+
+    app.config.setdefault('DATABASE_REPLICA_URLS',
+                          os.environ.get('DATABASE_REPLICA_URLS', ''))
+    app.config.setdefault('REPLICA_PIN_SECONDS', 5)
+
+    urls = app.config['DATABASE_REPLICA_URLS']
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+
+    keys = []
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    for i, url in enumerate(urls):
+        key = f'replica-{i}'
+        binds[key] = dict(engine_options(url, app.config), url=url)
+        keys.append(key)
+
+    if not keys:
+        return
+
+    @app.before_request
+    def choose_read_database():
+        """Send this request's reads to a replica if that's safe."""
+
+        g.read_replica = None
+        g.db_wrote = False
+
+        pinned_until = session.get(PIN_KEY)
+        if pinned_until is not None and pinned_until <= time.time():
+            session.pop(PIN_KEY)
+            pinned_until = None
+
+        view = app.view_functions.get(request.endpoint)
+        if (pinned_until is None
+                and request.method in ('GET', 'HEAD')
+                and getattr(view, 'reads_from_replica', False)):
+            g.read_replica = random.choice(keys)
+
+    @app.after_request
+    def pin_writers_to_primary(response):
+        """After a write, keep this visitor on the primary for a while."""
+
+        if g.get('db_wrote'):
+            session[PIN_KEY] = time.time() + app.config['REPLICA_PIN_SECONDS']
+        return response
@@ -0,0 +1,63 @@
+"""Compact read-only rows for the pages that list messages and users.
+
+Listing pages only read a few attributes of each message or user. Loading
+full ORM instances for them costs an identity-map entry, change tracking
+and attribute instrumentation per object. Here the needed columns are
+selected directly into namedtuples instead: no per-instance ``__dict__``,
+immutable, cheap to pickle into the cache, and read the same way as ORM
+objects in templates (``message.user.username``).
+
+    rows = message_rows(db.session.execute(
+        select_messages().where(Message.user_id == user_id)))
+
+``python -m benchmarks.rows`` compares the two approaches.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from models import Message, User
+
+Author = namedtuple('Author', 'id username image_url')
+
+MessageRow = namedtuple('MessageRow', 'id text timestamp user_id user')
+
+UserCard = namedtuple('UserCard', 'id username image_url header_image_url bio')
+
+Profile = namedtuple(
+    'Profile', 'id username image_url header_image_url bio location')
+
+
+def select_messages():
+    """SELECT of the columns message_rows() needs, author joined in.
+
+    Messages of deleted accounts are left out.
+    """
+
+    return (select(Message.id, Message.text, Message.timestamp,
+                   Message.user_id, User.username, User.image_url)
+            .join(User, User.id == Message.user_id)
+            .where(User.deleted_at.is_(None)))
+
+
+def message_rows(result):
+    """MessageRows for the rows of a select_messages() query."""
+
+    return [MessageRow(id, text, timestamp, user_id,
+                       Author(user_id, username, image_url))
+            for id, text, timestamp, user_id, username, image_url in result]
+
+
+def select_cards():
+    """SELECT of the columns card_rows() needs, deleted accounts left out."""
+
+    return (select(User.id, User.username, User.image_url,
+                   User.header_image_url, User.bio)
+            .where(User.deleted_at.is_(None)))
+
+
+def card_rows(result):
+    """UserCards for the rows of a select_cards() query."""
+
+    return [UserCard(*row) for row in result]
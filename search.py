@@ -0,0 +1,123 @@
+"""Full-text message search.
+
+Matching uses the full-text index built with the messages table (see
+models.MESSAGE_SEARCH_DDL): a GIN index over ``to_tsvector('english',
+text)`` on Postgres, the ``messages_fts`` FTS5 table on SQLite. Either way
+only matching rows are touched, never the whole table.
+
+Ranking every match of a common word would grow with the table, so only the
+newest ``SEARCH_CANDIDATES`` matches are ranked (ts_rank on Postgres, bm25
+on SQLite) and paginated. For a stream of short messages, recent matches are
+the ones people want anyway.
+
+That bounds the ranking, not the matching. SQLite's FTS5 walks matches
+newest first and stops after ``SEARCH_CANDIDATES``. Postgres' GIN index
+hands back every match as a bitmap, and picking the newest means visiting
+them all, so there a query for a very common word costs in proportion to
+how many messages contain it. Keeping only recent messages in the table
+(see archive.py) is what keeps that in check.
+
+A database created before search existed gets its index with:
+
+    flask --app server search rebuild
+"""
+
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from models import db, Message, MESSAGE_SEARCH_DDL
+
+search_cli = AppGroup('search', help="Manage the message search index.")
+
+POSTGRES_SEARCH = text("""
+    WITH q AS (SELECT websearch_to_tsquery('english', :q) AS query),
+    candidates AS (
+        SELECT messages.id, messages.text
+        FROM messages, q
+        WHERE to_tsvector('english', messages.text) @@ q.query
+        ORDER BY messages.id DESC
+        LIMIT :candidates
+    )
+    SELECT candidates.id
+    FROM candidates, q
+    ORDER BY ts_rank(to_tsvector('english', candidates.text), q.query) DESC,
+             candidates.id DESC
+    LIMIT :limit OFFSET :offset
+""").columns(id=db.Integer)
+
+SQLITE_SEARCH = text("""
+    SELECT id FROM (
+        SELECT rowid AS id, bm25(messages_fts) AS rank
+        FROM messages_fts
+        WHERE messages_fts MATCH :q
+        ORDER BY rowid DESC
+        LIMIT :candidates
+    )
+    ORDER BY rank, id DESC
+    LIMIT :limit OFFSET :offset
+""").columns(id=db.Integer)
+
+
+def fts5_query(query):
+    """Quote each word of `query` so FTS5 treats it as plain text."""
+
+    return ' '.join('"' + word.replace('"', '""') + '"'
+                    for word in query.split())
+
+
+def search_message_ids(query, page=1, per_page=20):
+    """Ranked ids of messages matching `query` on `page`, and whether
+    there is another page after it."""
+
+    query = query.strip()
+    if not query:
+        return [], False
+
+    candidates = current_app.config['SEARCH_CANDIDATES']
+    offset = (page - 1) * per_page
+    if offset >= candidates:
+        return [], False
+
+    params = {'candidates': candidates, 'limit': per_page + 1,
+              'offset': offset}
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        rows = db.session.execute(POSTGRES_SEARCH, dict(params, q=query))
+    elif dialect == 'sqlite':
+        rows = db.session.execute(SQLITE_SEARCH,
+                                  dict(params, q=fts5_query(query)))
+    else:
+        rows = db.session.execute(
+            db.select(Message.id)
+            .where(Message.text.icontains(query, autoescape=True))
+            .order_by(Message.id.desc())
+            .limit(per_page + 1)
+            .offset(offset))
+
+    ids = [message_id for (message_id,) in rows]
+    return ids[:per_page], len(ids) > per_page
+
+
+@search_cli.command('rebuild')
+def rebuild():
+    """Create the search index if missing and reindex every message."""
+
+    connection = db.session.connection()
+    dialect = connection.dialect.name
+
+    for statement in MESSAGE_SEARCH_DDL.get(dialect, []):
+        connection.exec_driver_sql(statement)
+    if dialect == 'sqlite':
+        connection.exec_driver_sql(
+            "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    db.session.commit()
+
+
+def init_search(app):
+    """Register the search CLI on `app` and apply default config."""
+
+    app.config.setdefault('SEARCH_CANDIDATES', 1000)
+    app.config.setdefault('SEARCH_PER_PAGE', 20)
+    app.cli.add_command(search_cli)
@@ -1,21 +1,33 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Works against whatever DATABASE_URL points at, e.g.:
+
+    DATABASE_URL=sqlite:///warbler.db python seed.py
+"""
 
 from csv import DictReader
+from datetime import datetime
+
 from app import create_app
-from models import User, Message, Follows, db
+from models import User, Message, Follows, db, connect_db
 
 app = create_app('warbler', testing=False)
+connect_db(app)
 
-db.drop_all()
-db.create_all()
+with app.app_context():
+    db.drop_all()
+    db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+    with open('generator/users.csv') as users:
+        db.session.bulk_insert_mappings(User, DictReader(users))
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    with open('generator/messages.csv') as messages:
+        db.session.bulk_insert_mappings(Message, [
+            dict(row, timestamp=datetime.fromisoformat(row['timestamp']))
+            for row in DictReader(messages)
+        ])
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+    with open('generator/follows.csv') as follows:
+        db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+    db.session.commit()
@@ -0,0 +1,193 @@
+"""Slow query log with automatic EXPLAIN capture.
+
+Any SELECT that takes longer than ``SLOW_QUERY_MS`` milliseconds is a
+candidate for the log. To keep the overhead bounded only a
+``SLOW_QUERY_SAMPLE_RATE`` fraction of candidates is captured, and never
+more than ``SLOW_QUERY_MAX_PER_MINUTE`` per process. Each entry is a JSON
+line with the SQL, the shape (not the values) of its parameters, the Flask
+endpoint that ran it and the query plan:
+
+- Postgres: ``EXPLAIN (ANALYZE off)``, so the query is not run again.
+- SQLite: ``EXPLAIN QUERY PLAN``.
+
+The EXPLAIN runs later, on a background thread with a connection of its
+own, so requests never wait for it.
+
+Entries go to ``SLOW_QUERY_LOG`` (default ``<instance>/slow_queries.log``),
+rotated at ``SLOW_QUERY_LOG_BYTES``. Set ``SLOW_QUERY_MS`` to None to turn
+the log off.
+"""
+
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+from flask import current_app, has_app_context, has_request_context, request
+
+from instrumentation import query_observers
+
+logger = logging.getLogger('warbler.slow_queries')
+logger.propagate = False
+
+_budget_lock = threading.Lock()
+_budget = {'window': 0, 'used': 0}
+
+# Captures waiting for the explainer thread; more than this are dropped.
+_pending = queue.Queue(maxsize=100)
+_explainer = None
+_explainer_lock = threading.Lock()
+
+
+def params_shape(parameters):
+    """Describe `parameters` by type and size without recording values."""
+
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+
+    if isinstance(parameters, (list, tuple)):
+        types = [type(value).__name__ for value in parameters]
+        if len(types) > 10:
+            distinct = sorted(set(types))
+            return f"{len(types)} x {'|'.join(distinct)}"
+        return types
+
+    return type(parameters).__name__
+
+
+def _within_budget(per_minute):
+    """Take one capture from this minute's allowance, if any is left."""
+
+    window = int(time.time() // 60)
+    with _budget_lock:
+        if _budget['window'] != window:
+            _budget['window'] = window
+            _budget['used'] = 0
+        if _budget['used'] >= per_minute:
+            return False
+        _budget['used'] += 1
+        return True
+
+
+def explain(engine, statement, parameters):
+    """Return the query plan for `statement` as a list of lines.
+
+    Runs on a DBAPI connection of its own from `engine`'s pool, so it
+    doesn't fire SQLAlchemy events again or touch the caller's transaction.
+    """
+
+    dialect = engine.dialect.name
+    if dialect not in ('postgresql', 'sqlite'):
+        return [f"EXPLAIN not supported for {dialect}"]
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        try:
+            if dialect == 'postgresql':
+                cursor.execute(f"EXPLAIN (ANALYZE off) {statement}", parameters)
+                plan = [row[0] for row in cursor.fetchall()]
+            else:
+                cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+                plan = [row[-1] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+        connection.rollback()
+        return plan
+    finally:
+        connection.close()
+
+
+def _explain_pending():
+    """Background thread: explain and log the captured slow queries."""
+
+    while True:
+        engine, statement, parameters, entry = _pending.get()
+        try:
+            entry['plan'] = explain(engine, statement, parameters)
+        except Exception as exc:
+            entry['plan'] = [f"EXPLAIN failed: {type(exc).__name__}: {exc}"]
+        logger.warning(json.dumps(entry))
+        _pending.task_done()
+
+
+def _explain_later(engine, statement, parameters, entry):
+    """Hand a capture to the explainer thread, starting it if need be."""
+
+    global _explainer
+
+    with _explainer_lock:
+        if _explainer is None or not _explainer.is_alive():
+            _explainer = threading.Thread(target=_explain_pending, daemon=True,
+                                          name='slowlog-explain')
+            _explainer.start()
+
+    try:
+        _pending.put_nowait((engine, statement, parameters, entry))
+    except queue.Full:
+        entry['plan'] = ["EXPLAIN skipped: too many waiting"]
+        logger.warning(json.dumps(entry))
+
+
+def record_slow_query(conn, statement, parameters, duration):
+    """Query observer: log `statement` if it was slow and gets sampled.
+
+    Only the sampling happens here; the EXPLAIN and the write to the log
+    are left to a background thread, off the request path.
+    """
+
+    if not has_app_context():
+        return
+
+    config = current_app.config
+    threshold = config.get('SLOW_QUERY_MS')
+    if threshold is None or duration * 1000 < threshold:
+        return
+
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return
+
+    if random.random() >= config['SLOW_QUERY_SAMPLE_RATE']:
+        return
+
+    if not _within_budget(config['SLOW_QUERY_MAX_PER_MINUTE']):
+        return
+
+    _explain_later(conn.engine, statement, parameters, {
+        'at': datetime.utcnow().isoformat(),
+        'endpoint': request.endpoint if has_request_context() else None,
+        'ms': round(duration * 1000, 2),
+        'sql': statement,
+        'params': params_shape(parameters),
+    })
+
+
+def init_slowlog(app):
+    """Turn on the slow query log for `app`."""
+
+    app.config.setdefault('SLOW_QUERY_MS', 200)
+    app.config.setdefault('SLOW_QUERY_SAMPLE_RATE', 0.1)
+    app.config.setdefault('SLOW_QUERY_MAX_PER_MINUTE', 30)
+    app.config.setdefault('SLOW_QUERY_LOG',
+                          os.path.join(app.instance_path, 'slow_queries.log'))
+    app.config.setdefault('SLOW_QUERY_LOG_BYTES', 5 * 1024 * 1024)
+
+    if app.config['SLOW_QUERY_MS'] is None:
+        return
+
+    path = os.path.abspath(app.config['SLOW_QUERY_LOG'])
+    if not any(getattr(handler, 'baseFilename', None) == path
+               for handler in logger.handlers):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handler = RotatingFileHandler(
+            path, maxBytes=app.config['SLOW_QUERY_LOG_BYTES'], backupCount=5)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+
+    if record_slow_query not in query_observers:
+        query_observers.append(record_slow_query)
@@ -0,0 +1,193 @@
+"""#tags, @mentions and trending tags.
+
+When a message is posted, ``index_message()`` pulls its ``#tags`` and
+``@mentions`` out into the ``message_tags`` and ``mentions`` tables. All
+the mentioned usernames are resolved in one query.
+
+Each tag use also adds one to a per-tag counter for the
+``TRENDING_BUCKET_SECONDS``-long time bucket the message falls in
+(``tag_counts``). ``trending()`` sums those counters over a sliding window.
+The counters are upserted as messages come and go, so ranking tags never
+reads ``messages``; its cost depends on the number of tags in the window,
+not on how much was posted. Buckets older than the longest window can be
+dropped with:
+
+    flask --app server trending prune
+"""
+
+import re
+from collections import Counter
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Message, MessageTag, Mention, TagCount, User
+
+TAG = re.compile(r'(?<![\w#])#(\w{1,50})')
+MENTION = re.compile(r'(?<![\w@])@(\w{1,30})')
+
+# Windows trending() can sum over, by name.
+WINDOWS = {
+    '1h': timedelta(hours=1),
+    '24h': timedelta(days=1),
+    '7d': timedelta(days=7),
+}
+
+trending_cli = AppGroup('trending', help="Maintain the trending tag counters.")
+
+
+def extract(text):
+    """(tags, usernames) used in `text`: tags lowercased, each listed once."""
+
+    tags = sorted({tag.lower() for tag in TAG.findall(text)})
+    usernames = sorted(set(MENTION.findall(text)))
+    return tags, usernames
+
+
+def bucket_of(moment):
+    """Start of the trending bucket that `moment` falls in."""
+
+    seconds = current_app.config['TRENDING_BUCKET_SECONDS']
+    epoch = datetime(1970, 1, 1)
+    offset = (moment - epoch).total_seconds()
+    return epoch + timedelta(seconds=offset - offset % seconds)
+
+
+def _add_to_counts(tags, moment, amount):
+    """Add `amount` to each tag's counter for `moment`'s bucket."""
+
+    bucket = bucket_of(moment)
+
+    if amount < 0:
+        db.session.execute(
+            update(TagCount)
+            .where(TagCount.tag.in_(tags), TagCount.bucket == bucket)
+            .values(count=TagCount.count + amount)
+            .execution_options(synchronize_session=False))
+        return
+
+    _upsert_counts({(tag, bucket): amount for tag in tags})
+
+
+def _upsert_counts(amounts):
+    """Add each {(tag, bucket): amount} to its counter, in one statement."""
+
+    dialect = db.session.get_bind().dialect.name
+    upsert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    statement = upsert(TagCount).values(
+        [dict(tag=tag, bucket=bucket, count=amount)
+         for (tag, bucket), amount in amounts.items()])
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['tag', 'bucket'],
+        set_={'count': TagCount.count + statement.excluded.count}))
+
+
+def index_message(message):
+    """Record `message`'s tags and mentions. It must have been flushed."""
+
+    index_messages([message])
+
+
+def index_messages(messages):
+    """index_message() for many messages, in at most four statements."""
+
+    tag_rows, mention_rows, amounts = [], [], Counter()
+    for message in messages:
+        tags, usernames = extract(message.text)
+        bucket = bucket_of(message.timestamp)
+        for tag in tags:
+            tag_rows.append(dict(message_id=message.id, tag=tag))
+            amounts[tag, bucket] += 1
+        mention_rows.extend((message.id, username) for username in usernames)
+
+    if tag_rows:
+        db.session.execute(insert(MessageTag), tag_rows)
+        _upsert_counts(amounts)
+
+    if mention_rows:
+        # Every mentioned username is resolved in one query.
+        user_ids = dict(db.session.execute(
+            select(User.username, User.id)
+            .where(User.username.in_({name for _, name in mention_rows}))).all())
+        rows = [dict(message_id=message_id, user_id=user_ids[name])
+                for message_id, name in mention_rows if name in user_ids]
+        if rows:
+            db.session.execute(insert(Mention), rows)
+
+
+def unindex_message(message):
+    """Take `message`'s tags back out of the trending counters.
+
+    Its message_tags and mentions rows go with it by ON DELETE CASCADE.
+    """
+
+    tags = db.session.scalars(
+        select(MessageTag.tag).where(MessageTag.message_id == message.id)).all()
+    if tags:
+        _add_to_counts(tags, message.timestamp, -1)
+
+
+def unindex_messages(message_ids):
+    """unindex_message() for the messages with ids in `message_ids`.
+
+    Counters are decremented with one UPDATE per bucket and amount.
+    """
+
+    uses = Counter(
+        (tag, bucket_of(timestamp)) for tag, timestamp in db.session.execute(
+            select(MessageTag.tag, Message.timestamp)
+            .join(Message, Message.id == MessageTag.message_id)
+            .where(MessageTag.message_id.in_(message_ids))))
+
+    groups = {}
+    for (tag, bucket), amount in uses.items():
+        groups.setdefault((bucket, amount), []).append(tag)
+
+    for (bucket, amount), tags in groups.items():
+        db.session.execute(
+            update(TagCount)
+            .where(TagCount.tag.in_(tags), TagCount.bucket == bucket)
+            .values(count=TagCount.count - amount)
+            .execution_options(synchronize_session=False))
+
+
+def trending(window, limit=10):
+    """[{'tag', 'count'}] for the most used tags in the last `window`."""
+
+    since = bucket_of(datetime.utcnow() - WINDOWS[window])
+    uses = func.sum(TagCount.count).label('uses')
+
+    rows = db.session.execute(
+        select(TagCount.tag, uses)
+        .where(TagCount.bucket >= since)
+        .group_by(TagCount.tag)
+        .having(uses > 0)
+        .order_by(uses.desc(), TagCount.tag)
+        .limit(limit))
+
+    return [{'tag': tag, 'count': count} for tag, count in rows]
+
+
+@trending_cli.command('prune')
+def prune():
+    """Delete counter buckets older than the longest trending window."""
+
+    cutoff = bucket_of(datetime.utcnow() - max(WINDOWS.values()))
+    result = db.session.execute(
+        delete(TagCount)
+        .where(TagCount.bucket < cutoff)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    click.echo(f"Removed {result.rowcount} old buckets.")
+
+
+def init_tags(app):
+    """Register the trending CLI on `app` and apply default config."""
+
+    app.config.setdefault('TRENDING_BUCKET_SECONDS', 300)
+    app.config.setdefault('TRENDING_CACHE_TTL', 60)
+    app.cli.add_command(trending_cli)
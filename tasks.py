@@ -0,0 +1,128 @@
+"""Background work for Warbler routes, run by the queue in jobs.py."""
+
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, select, update
+
+from cache import invalidate
+from jobs import job
+from models import (db, User, Message, Follows, Likes, ArchivedLike,
+                    ArchivedMessage)
+import archive
+import followgraph
+import recommendations
+import tags
+
+# Rows removed per statement (and per transaction) when purging an account.
+PURGE_BATCH_SIZE = 1000
+
+
+def _delete_in_batches(model, key_column, condition, batch_size,
+                       before_delete=None):
+    """Delete rows of `model` matching `condition`, `batch_size` at a time.
+
+    Each batch is its own short transaction, so a prolific account never
+    turns into one huge delete. `before_delete`, if given, is called with
+    each batch's keys inside that transaction. Returns the number of rows
+    removed.
+    """
+
+    removed = 0
+
+    while True:
+        batch = (select(key_column)
+                 .where(condition)
+                 .limit(batch_size))
+        if before_delete is None:
+            batch = batch.scalar_subquery()
+        else:
+            batch = db.session.scalars(batch).all()
+            before_delete(batch)
+        result = db.session.execute(
+            delete(model)
+            .where(condition, key_column.in_(batch))
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+
+        removed += result.rowcount
+        if result.rowcount < batch_size:
+            return removed
+
+
+@job('delete_user')
+def delete_user(user_id):
+    """Delete a user account and everything that hangs off it.
+
+    Rows are removed with set-based DELETEs in bounded batches rather than by
+    loading the user's collections through the ORM. Likes on the user's
+    messages go with them through ON DELETE CASCADE. Safe to re-run: a retry
+    picks up wherever the last attempt stopped.
+    """
+
+    batch_size = current_app.config.get('PURGE_BATCH_SIZE', PURGE_BATCH_SIZE)
+
+    # Normally done by the request; make sure the account is hidden while
+    # the purge runs, and stays hidden if it fails.
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id, User.deleted_at.is_(None))
+        .values(deleted_at=datetime.utcnow())
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+
+    # Trending counters are taken down with each batch of messages.
+    _delete_in_batches(Message, Message.id,
+                       Message.user_id == user_id, batch_size,
+                       before_delete=tags.unindex_messages)
+    _delete_in_batches(ArchivedLike, ArchivedLike.message_id,
+                       ArchivedLike.message_id.in_(
+                           select(ArchivedMessage.id)
+                           .where(ArchivedMessage.user_id == user_id)),
+                       batch_size)
+    _delete_in_batches(ArchivedMessage, ArchivedMessage.id,
+                       ArchivedMessage.user_id == user_id, batch_size)
+    _delete_in_batches(ArchivedLike, ArchivedLike.message_id,
+                       ArchivedLike.user_id == user_id, batch_size)
+    _delete_in_batches(Likes, Likes.id,
+                       Likes.user_id == user_id, batch_size)
+    _delete_in_batches(Follows, Follows.user_being_followed_id,
+                       Follows.user_following_id == user_id, batch_size)
+    _delete_in_batches(Follows, Follows.user_following_id,
+                       Follows.user_being_followed_id == user_id, batch_size)
+
+    # By now the cascade has nothing left to do for the user row itself.
+    db.session.execute(
+        delete(User)
+        .where(User.id == user_id)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+
+    followgraph.record_follow_change(followgraph.DELETE_USER, user_id)
+    db.session.commit()
+
+    # Counts of the people they followed catch up when their entries expire.
+    invalidate('users', f'user:{user_id}')
+    current_app.extensions['latest_feed'].clear()
+
+
+@job('refresh_recommendations')
+def refresh_recommendations():
+    """Recompute every user's "who to follow" suggestions."""
+
+    recommendations.refresh()
+
+
+@job('archive_messages')
+def archive_messages():
+    """Move messages past the hot window into the archive."""
+
+    archive.archive_messages(archive.hot_cutoff(),
+                             current_app.config['ARCHIVE_BATCH_SIZE'])
+
+
+@job('rebuild_follow_graph')
+def rebuild_follow_graph():
+    """Fold the follow graph's delta log into a fresh snapshot."""
+
+    followgraph.rebuild(current_app.config['FOLLOW_GRAPH_DIR'])
@@ -0,0 +1,111 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+from datetime import datetime, timedelta
+
+from archive import archive_messages, hot_cutoff, next_month
+from export import export_records
+from models import db, ArchivedLike, ArchivedMessage, Likes, Message, User
+from search import search_message_ids
+from tasks import delete_user
+from testing import DBTestCase
+
+from app import create_app, CURR_USER_KEY
+app = create_app('warbler-test', testing=True)
+
+
+class ArchiveTestCase(DBTestCase):
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.author = User.signup('author', 'author@test.com', 'password', None)
+        self.fan = User.signup('fan', 'fan@test.com', 'password', None)
+        db.session.commit()
+        self.author_id, self.fan_id = self.author.id, self.fan.id
+
+        now = datetime.utcnow()
+        self.old = [Message(text=f'old warble {i}', user_id=self.author_id,
+                            timestamp=now - timedelta(days=200 + i))
+                    for i in range(3)]
+        self.new = Message(text='new warble', user_id=self.author_id,
+                           timestamp=now - timedelta(days=1))
+        db.session.add_all(self.old + [self.new])
+        db.session.commit()
+        self.old_ids = [message.id for message in self.old]
+        db.session.add_all([Likes(user_id=self.fan_id, message_id=self.old_ids[0]),
+                            Likes(user_id=self.fan_id, message_id=self.new.id)])
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.fan_id
+
+    def test_archive(self):
+        self.client.get(f'/users/{self.author_id}')
+
+        self.assertEqual(archive_messages(hot_cutoff(), batch_size=2), 3)
+        self.assertEqual(archive_messages(hot_cutoff(), batch_size=2), 0)
+
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(sorted(db.session.scalars(
+            db.select(ArchivedMessage.id))), sorted(self.old_ids))
+        self.assertEqual(db.session.scalars(db.select(ArchivedLike.message_id)).all(),
+                         [self.old_ids[0]])
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(search_message_ids('old')[0], [])
+
+        # Totals still include the archive; the cached ones were dropped.
+        self.assertEqual(User.counts_for(self.author_id)['messages'], 4)
+        self.assertEqual(User.counts_for(self.fan_id)['likes'], 2)
+        html = self.client.get(f'/users/{self.author_id}').get_data(as_text=True)
+        self.assertIn('new warble', html)
+        self.assertNotIn('old warble', html)
+        self.assertIn(f'<a href="/users/{self.author_id}">4</a>', html)
+
+    def test_still_trending(self):
+        with self.assertRaises(ValueError):
+            archive_messages(datetime.utcnow() - timedelta(days=1), 100)
+
+    def test_archive_page(self):
+        archive_messages(hot_cutoff(), 100)
+        app.config['ARCHIVE_PAGE_SIZE'] = 2
+        try:
+            resp = self.client.get(f'/users/{self.author_id}/archive')
+            html = resp.get_data(as_text=True)
+            self.assertIn('old warble 0', html)
+            self.assertIn('old warble 1', html)
+            self.assertNotIn('old warble 2', html)
+
+            start = html.index('before=') + len('before=')
+            cursor = html[start:html.index('"', start)]
+            html = self.client.get(f'/users/{self.author_id}/archive?before={cursor}'
+                                   ).get_data(as_text=True)
+            self.assertIn('old warble 2', html)
+            self.assertNotIn('old warble 1', html)
+        finally:
+            app.config['ARCHIVE_PAGE_SIZE'] = 100
+
+        self.assertEqual(self.client.get(f'/users/{self.author_id}/archive?before=x')
+                         .status_code, 400)
+
+    def test_export_and_delete(self):
+        archive_messages(hot_cutoff(), 100)
+
+        texts = [record['text'] for record in export_records(self.author_id)
+                 if record['type'] == 'message']
+        self.assertEqual(texts, ['old warble 2', 'old warble 1', 'old warble 0',
+                                 'new warble'])
+
+        delete_user(self.author_id)
+        self.assertEqual(ArchivedMessage.query.count(), 0)
+        self.assertEqual(ArchivedLike.query.count(), 0)
+
+    def test_next_month(self):
+        self.assertEqual(next_month(datetime(2023, 12, 1)), datetime(2024, 1, 1))
+        self.assertEqual(next_month(datetime(2024, 1, 1)), datetime(2024, 2, 1))
@@ -0,0 +1,206 @@
+"""Bulk follow and message ingestion API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk.py
+
+import json
+from unittest.mock import patch
+
+from models import db, Follows, Mention, Message, MessageTag, User
+from tags import index_messages
+from testing import DBTestCase
+
+from app import create_app, CURR_USER_KEY
+app = create_app('warbler-test', testing=True)
+
+
+class BulkFollowTestCase(DBTestCase):
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.users = [User.signup(f'bulk{i}', f'bulk{i}@test.com',
+                                  'password', None)
+                      for i in range(5)]
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.ids[0]
+
+    def following(self):
+        return set(db.session.scalars(
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.ids[0])))
+
+    def test_follow_by_id_and_username(self):
+        me, a, b, c, d = self.ids
+        db.session.add(Follows(user_following_id=me, user_being_followed_id=a))
+        db.session.commit()
+
+        resp = self.client.post('/api/follows', json={
+            'users': [a, 'bulk2', c, 'nobody', 9999, c, me]})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['changed'], [b, c])
+        self.assertEqual(resp.json['unchanged'], [a, me])
+        self.assertEqual(resp.json['missing'], ['nobody', 9999])
+        self.assertEqual(self.following(), {a, b, c})
+
+    def test_conflict_error_writes_nothing(self):
+        me, a, b, c, d = self.ids
+        db.session.add(Follows(user_following_id=me, user_being_followed_id=a))
+        db.session.commit()
+
+        resp = self.client.post('/api/follows', json={
+            'users': [a, b], 'on_conflict': 'error'})
+
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.json['conflicts'], [a])
+        self.assertEqual(self.following(), {a})
+
+    def test_unfollow(self):
+        me, a, b, c, d = self.ids
+        db.session.add_all([
+            Follows(user_following_id=me, user_being_followed_id=a),
+            Follows(user_following_id=me, user_being_followed_id=b)])
+        db.session.commit()
+
+        # Warm the cached counts so we can see them invalidated.
+        self.client.get(f'/users/{me}')
+
+        resp = self.client.post('/api/follows', json={
+            'action': 'unfollow', 'users': ['bulk1', c]})
+
+        self.assertEqual(resp.json['changed'], [a])
+        self.assertEqual(resp.json['unchanged'], [c])
+        self.assertEqual(self.following(), {b})
+
+        html = self.client.get(f'/users/{me}').get_data(as_text=True)
+        self.assertIn(f'<a href="/users/{me}/following">1</a>', html)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.post('/api/follows', data={'users': 1})
+                         .status_code, 400)
+        self.assertEqual(self.client.post('/api/follows', json={
+            'action': 'block', 'users': []}).status_code, 400)
+        self.assertEqual(self.client.post('/api/follows', json={
+            'users': [{'id': 1}]}).status_code, 400)
+
+        app.config['BULK_FOLLOW_MAX'] = 2
+        try:
+            self.assertEqual(self.client.post('/api/follows', json={
+                'users': [1, 2, 3]}).status_code, 413)
+        finally:
+            app.config['BULK_FOLLOW_MAX'] = 1000
+
+        with self.client.session_transaction() as session:
+            del session[CURR_USER_KEY]
+        self.assertEqual(self.client.post('/api/follows', json={
+            'users': []}).status_code, 401)
+
+
+class IngestMessagesTestCase(DBTestCase):
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup('poster', 'poster@test.com', 'password', None)
+        User.signup('friend', 'friend@test.com', 'password', None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+
+    def post(self, lines):
+        return self.client.post('/api/messages', data='\n'.join(lines),
+                                content_type='application/x-ndjson')
+
+    def results(self, resp):
+        return [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+
+    def test_ingest(self):
+        app.config['INGEST_BATCH_SIZE'] = 2
+        try:
+            resp = self.post([
+                '{"text": "one #launch"}',
+                '{"text": "' + 'x' * 141 + '"}',
+                '',
+                'not json',
+                '{"text": "two @friend"}',
+                '{"text": "three #launch"}',
+                '{"nothing": 1}',
+            ])
+        finally:
+            app.config['INGEST_BATCH_SIZE'] = 500
+
+        self.assertEqual(resp.status_code, 200)
+        results = self.results(resp)
+        self.assertEqual([result['line'] for result in results],
+                         [1, 2, 4, 5, 6, 7])
+        self.assertIn('id', results[0])
+        self.assertIn('140', results[1]['errors'][0])
+        self.assertEqual(results[2]['errors'], ["Not valid JSON."])
+        self.assertIn('errors', results[5])
+
+        texts = db.session.scalars(
+            db.select(Message.text).where(Message.user_id == self.user_id)
+            .order_by(Message.id)).all()
+        self.assertEqual(texts, ['one #launch', 'two @friend', 'three #launch'])
+        self.assertEqual(db.session.scalar(
+            db.select(db.func.count()).select_from(MessageTag)), 2)
+        self.assertEqual(db.session.scalar(
+            db.select(db.func.count()).select_from(Mention)), 1)
+
+        html = self.client.get(f'/users/{self.user_id}').get_data(as_text=True)
+        self.assertIn('three #launch', html)
+
+    def test_limit(self):
+        app.config['INGEST_MAX_ITEMS'] = 2
+        try:
+            results = self.results(self.post(['{"text": "hi"}'] * 3))
+        finally:
+            app.config['INGEST_MAX_ITEMS'] = 10000
+
+        self.assertEqual(len(results), 3)
+        self.assertIn('Too many', results[2]['errors'][0])
+        self.assertEqual(Message.query.count(), 2)
+
+    def test_failed_batch_keeps_earlier_results(self):
+        calls = []
+
+        def index_or_fail(messages):
+            calls.append(messages)
+            if len(calls) == 2:
+                raise RuntimeError("index unavailable")
+            index_messages(messages)
+
+        app.config['INGEST_BATCH_SIZE'] = 1
+        try:
+            with patch('bulk.index_messages', index_or_fail):
+                results = self.results(self.post(
+                    ['{"text": "one"}', '{"text": "two"}', '{"text": "three"}']))
+        finally:
+            app.config['INGEST_BATCH_SIZE'] = 500
+
+        self.assertEqual(results[0]['line'], 1)
+        self.assertIn('error', results[1])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(db.session.scalars(db.select(Message.text)).all(),
+                         ['one'])
+
+    def test_needs_ndjson_and_login(self):
+        resp = self.client.post('/api/messages', data={'text': 'hi'})
+        self.assertEqual(resp.status_code, 415)
+
+        with self.client.session_transaction() as session:
+            del session[CURR_USER_KEY]
+        self.assertEqual(self.post(['{"text": "hi"}']).status_code, 401)
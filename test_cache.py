@@ -0,0 +1,206 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+import os
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+import cache
+from cache import MemoryCache, RedisCache, cached, invalidate
+from models import db, Message, User
+from testing import DBTestCase
+
+from app import create_app, CURR_USER_KEY
+app = create_app('warbler-test', testing=True)
+
+
+class FakeRedis:
+    """Just enough of redis-py's client for RedisCache, kept in a dict."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            return None
+        return value
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and self.get(key) is not None:
+            return None
+        expires_at = None if px is None else time.monotonic() + px / 1000
+        self.data[key] = (value, expires_at)
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def flushdb(self):
+        self.data.clear()
+
+
+class MemoryCacheTestCase(TestCase):
+
+    def test_lru_eviction(self):
+        lru = MemoryCache(max_entries=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_memory_needs_single_process(self):
+        with patch.dict(os.environ, {'CACHE_BACKEND': 'memory'}):
+            os.environ.pop('CACHE_SINGLE_PROCESS', None)
+            with self.assertRaises(RuntimeError):
+                create_app('warbler-test', profile='prod')
+
+            os.environ['CACHE_SINGLE_PROCESS'] = '1'
+            self.assertEqual(create_app('warbler-test', profile='prod')
+                             .config['CACHE_BACKEND'], 'memory')
+
+        self.assertEqual(app.config['CACHE_BACKEND'], 'memory')
+        self.assertEqual(app.config['CACHE_TTL'], 30)
+
+    def test_ttl(self):
+        lru = MemoryCache()
+        lru.set('a', 1, ttl=-1)
+        lru.set('b', 2, ttl=60)
+
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru.get('b'), 2)
+
+    def test_only_if_missing(self):
+        lru = MemoryCache()
+
+        self.assertTrue(lru.set('a', 1, only_if_missing=True))
+        self.assertFalse(lru.set('a', 2, only_if_missing=True))
+        self.assertEqual(lru.get('a'), 1)
+
+
+class CachedTestCase(TestCase):
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        cache.clear()
+        self.calls = 0
+
+    def tearDown(self):
+        app.extensions['warbler_cache'] = MemoryCache()
+        self.app_context.pop()
+
+    def compute(self):
+        self.calls += 1
+        return {'calls': self.calls}
+
+    def check_backend(self):
+        self.assertEqual(cached('user:1', 'counts', self.compute), {'calls': 1})
+        self.assertEqual(cached('user:1', 'counts', self.compute), {'calls': 1})
+
+        invalidate('user:1')
+        self.assertEqual(cached('user:1', 'counts', self.compute), {'calls': 2})
+
+        invalidate('user:2')
+        self.assertEqual(cached('user:1', 'counts', self.compute), {'calls': 2})
+
+    def test_memory_backend(self):
+        self.check_backend()
+
+    def test_redis_backend(self):
+        app.extensions['warbler_cache'] = RedisCache(FakeRedis())
+        self.check_backend()
+
+    def check_single_flight(self):
+        started = threading.Barrier(8)
+        results = []
+
+        def slow_compute():
+            time.sleep(0.05)
+            return self.compute()
+
+        def request():
+            with app.app_context():
+                started.wait()
+                results.append(cached('user:1', 'profile', slow_compute))
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [{'calls': 1}] * 8)
+
+    def test_single_flight(self):
+        self.check_single_flight()
+
+    def test_single_flight_shared_backend(self):
+        app.extensions['warbler_cache'] = RedisCache(FakeRedis())
+        self.check_single_flight()
+
+    def test_ttl_jitter(self):
+        backend = app.extensions['warbler_cache']
+        for i in range(20):
+            cached('user:1', f'key{i}', self.compute, ttl=100)
+
+        expiries = {expires_at for _, expires_at in backend._entries.values()
+                    if expires_at is not None}
+        self.assertGreater(len(expiries), 1)
+        self.assertLess(max(expiries) - min(expiries), 100 * 0.1 + 1)
+
+    def test_bypass_header(self):
+        with app.test_request_context(headers={'X-Cache-Bypass': '1'}):
+            app.config['CACHE_ALLOW_BYPASS'] = True
+            try:
+                cached('user:1', 'counts', self.compute)
+                cached('user:1', 'counts', self.compute)
+            finally:
+                app.config['CACHE_ALLOW_BYPASS'] = False
+
+        self.assertEqual(self.calls, 2)
+
+
+class CachedViewTestCase(DBTestCase):
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup("cacheuser", "cache@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_new_message_invalidates_profile(self):
+        self.client.get(f'/users/{self.user_id}')
+        self.client.post('/messages/new', data={'text': 'fresh'})
+
+        resp = self.client.get(f'/users/{self.user_id}')
+        html = resp.get_data(as_text=True)
+
+        self.assertIn('fresh', html)
+        self.assertIn(f'<a href="/users/{self.user_id}">1</a>', html)
+
+    def test_profile_served_from_cache(self):
+        self.client.get(f'/users/{self.user_id}')
+
+        # Written behind the app's back, so nothing invalidates the entry.
+        db.session.add(Message(text='sneaky', user_id=self.user_id))
+        db.session.commit()
+
+        resp = self.client.get(f'/users/{self.user_id}')
+        self.assertNotIn('sneaky', resp.get_data(as_text=True))
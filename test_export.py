@@ -0,0 +1,135 @@
+"""Account export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+import csv
+import io
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from archive import archive_messages
+from export import BadCursor, export_records
+from models import db, Follows, Likes, Message, User
+from testing import DBTestCase
+
+from app import create_app, CURR_USER_KEY
+app = create_app('warbler-test', testing=True)
+
+
+class ExportTestCase(DBTestCase):
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = User.signup('exporter', 'exporter@test.com', 'password', None)
+        self.other = User.signup('other', 'other@test.com', 'password', None)
+        db.session.commit()
+        self.user_id, self.other_id = self.user.id, self.other.id
+
+        now = datetime(2024, 1, 1)
+        self.messages = [Message(text=f'message {i}', user_id=self.user_id,
+                                 timestamp=now + timedelta(minutes=i))
+                         for i in range(5)]
+        db.session.add_all(self.messages)
+        db.session.commit()
+        db.session.add_all([
+            Likes(user_id=self.user_id, message_id=self.messages[0].id),
+            Follows(user_following_id=self.user_id,
+                    user_being_followed_id=self.other_id),
+            Follows(user_following_id=self.other_id,
+                    user_being_followed_id=self.user_id),
+        ])
+        db.session.commit()
+        app.config['EXPORT_CHUNK_SIZE'] = 2
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        app.config['EXPORT_CHUNK_SIZE'] = 1000
+        super().tearDown()
+
+    def test_records(self):
+        records = list(export_records(self.user_id))
+
+        self.assertEqual([record['type'] for record in records],
+                         ['profile'] + ['message'] * 5
+                         + ['like', 'follower', 'following'])
+        self.assertEqual(records[0]['email'], 'exporter@test.com')
+        self.assertEqual([record['text'] for record in records[1:6]],
+                         [f'message {i}' for i in range(5)])
+        self.assertEqual(records[7]['username'], 'other')
+
+    def test_deleted_accounts_left_out(self):
+        db.session.get(User, self.other_id).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        self.assertNotIn('other', [record.get('username') for record in
+                                   export_records(self.user_id)])
+
+    def test_resume(self):
+        records = list(export_records(self.user_id))
+
+        for i, record in enumerate(records):
+            self.assertEqual(list(export_records(self.user_id, record['cursor'])),
+                             records[i + 1:])
+
+        for bad in ('messages:yesterday/1', 'likes:x', 'secrets:1', 'nope'):
+            with self.assertRaises(BadCursor):
+                export_records(self.user_id, bad)
+
+    def test_resume_across_archiving(self):
+        records = list(export_records(self.user_id))
+
+        # Cut short after message 1; messages 0-2 and the like are archived
+        # before the export resumes.
+        archive_messages(datetime(2024, 1, 1, 0, 3), batch_size=10)
+
+        self.assertEqual(list(export_records(self.user_id, records[2]['cursor'])),
+                         records[3:])
+        self.assertEqual(list(export_records(self.user_id)), records)
+
+    def test_ndjson_download(self):
+        resp = self.client.get('/users/export')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertIn('warbler-exporter.ndjson',
+                      resp.headers['Content-Disposition'])
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(json.loads(lines[1])['text'], 'message 0')
+
+        cursor = json.loads(lines[3])['cursor']
+        resp = self.client.get('/users/export', query_string={'after': cursor})
+        self.assertEqual(resp.get_data(as_text=True).splitlines(), lines[4:])
+
+    def test_csv_download(self):
+        resp = self.client.get('/users/export?format=csv')
+
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(rows[6]['type'], 'like')
+        self.assertEqual(rows[6]['message_id'], str(self.messages[0].id))
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get('/users/export?format=xml')
+                         .status_code, 400)
+        self.assertEqual(self.client.get('/users/export?after=likes:x')
+                         .status_code, 400)
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'export.ndjson')
+            result = app.test_cli_runner().invoke(
+                args=['export', 'user', str(self.user_id), '--out', path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open(path) as exported:
+                self.assertEqual(len(exported.readlines()), 9)
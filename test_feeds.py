@@ -0,0 +1,169 @@
+"""Shared feed tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_feeds.py
+
+import threading
+import time
+from collections import namedtuple
+from unittest import TestCase
+
+from feeds import SharedFeed
+from models import db, Message, User
+from testing import DBTestCase
+
+from app import create_app, CURR_USER_KEY
+app = create_app('warbler-test', testing=True)
+
+Row = namedtuple('Row', 'id')
+
+
+class SharedFeedTestCase(TestCase):
+
+    def setUp(self):
+        self.loads = 0
+        self.app_context = app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def load(self, size):
+        self.loads += 1
+        return [Row(self.loads)]
+
+    def test_loads_once_per_interval(self):
+        feed = SharedFeed(self.load, interval=60)
+
+        self.assertEqual(feed.rows(), [Row(1)])
+        self.assertEqual(feed.rows(), [Row(1)])
+        self.assertEqual(self.loads, 1)
+
+    def test_stale_while_revalidate(self):
+        release = threading.Event()
+        refreshed = threading.Event()
+
+        def load(size):
+            if self.loads:
+                release.wait(1)
+            rows = self.load(size)
+            if self.loads > 1:
+                refreshed.set()
+            return rows
+
+        feed = SharedFeed(load, interval=0, max_stale=60)
+        feed.rows()
+
+        # Stale: served straight away while a thread reloads it.
+        self.assertEqual(feed.rows(), [Row(1)])
+        release.set()
+        self.assertTrue(refreshed.wait(1))
+        time.sleep(0.01)
+        self.assertEqual(feed._rows, [Row(2)])
+
+    def test_changes_during_refresh_survive(self):
+        loading = threading.Event()
+        release = threading.Event()
+        refreshed = threading.Event()
+
+        def load(size):
+            if self.loads:
+                loading.set()
+                release.wait(1)
+            self.loads += 1
+            rows = [Row(2), Row(1)][-self.loads:]
+            if self.loads > 1:
+                refreshed.set()
+            return rows
+
+        feed = SharedFeed(load, interval=0, max_stale=60)
+        feed.rows()
+        feed.rows()
+
+        # Made after the refresh read the table, before it swapped the rows in.
+        self.assertTrue(loading.wait(1))
+        feed.push(Row(3))
+        feed.push(Row(2))
+        feed.remove(1)
+        release.set()
+        self.assertTrue(refreshed.wait(1))
+        time.sleep(0.01)
+        self.assertEqual(feed._rows, [Row(2), Row(3)])
+
+    def test_clear_drops_refresh(self):
+        loading = threading.Event()
+        release = threading.Event()
+        done = threading.Event()
+
+        def load(size):
+            if self.loads:
+                loading.set()
+                release.wait(1)
+            rows = self.load(size)
+            if self.loads > 1:
+                done.set()
+            return rows
+
+        feed = SharedFeed(load, interval=0, max_stale=60)
+        feed.rows()
+        feed.rows()
+
+        self.assertTrue(loading.wait(1))
+        feed.clear()
+        release.set()
+        self.assertTrue(done.wait(1))
+        time.sleep(0.01)
+        self.assertIsNone(feed._rows)
+
+    def test_too_stale_reloads_inline(self):
+        feed = SharedFeed(self.load, interval=0, max_stale=0)
+        feed.rows()
+
+        self.assertEqual(feed.rows(), [Row(2)])
+
+    def test_push_and_remove(self):
+        feed = SharedFeed(self.load, size=2, interval=60)
+        feed.push(Row(5))
+        self.assertEqual(feed.rows(), [Row(1)])
+
+        feed.push(Row(7))
+        feed.push(Row(8))
+        self.assertEqual(feed.rows(), [Row(8), Row(7)])
+
+        feed.remove(7)
+        self.assertEqual(feed.rows(), [Row(8)])
+
+
+class LatestFeedViewTestCase(DBTestCase):
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        self.author_id = author.id
+        db.session.add(Message(text="hello world", user_id=self.author_id))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_anonymous_teaser(self):
+        resp = self.client.get('/')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Sign up", html)
+        self.assertIn("hello world", html)
+
+    def test_no_follows_sees_latest(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+        self.client.get('/')
+        self.client.post('/messages/new', data={'text': 'second thoughts'})
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn("hello world", html)
+        self.assertIn("second thoughts", html)
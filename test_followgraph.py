@@ -0,0 +1,244 @@
+"""Shared follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_followgraph.py
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from followgraph import (FOLLOW, UNFOLLOW, DELETE_USER, SharedGraph, _RECORD,
+                         _write_generation, rebuild, record_follow_change,
+                         shared_graph, write_snapshot)
+from instrumentation import record_queries
+from models import db, Follows, Job, User
+from testing import DBTestCase
+
+from app import create_app, CURR_USER_KEY
+app = create_app('warbler-test', testing=True)
+
+
+class SharedGraphTestCase(TestCase):
+    """The snapshot plus overlay, without a database."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+
+        # 1 -> 2, 1 -> 3, 2 -> 3, 4 -> 1
+        write_snapshot(self.directory, [1, 1, 2, 4], [2, 3, 3, 1], 1)
+        _write_generation(self.directory, 'WRITING', 1)
+        _write_generation(self.directory, 'CURRENT', 1)
+
+        self.app_context = app.app_context()
+        self.app_context.push()
+        app.config['FOLLOW_GRAPH_DIR'] = self.directory
+        app.config['FOLLOW_GRAPH_SINGLE_HOST'] = True
+
+    def tearDown(self):
+        app.config['FOLLOW_GRAPH_DIR'] = None
+        app.config['FOLLOW_GRAPH_SINGLE_HOST'] = False
+        app.config['FOLLOW_GRAPH_REFRESH_MS'] = 100
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_snapshot(self):
+        graph = shared_graph()
+
+        self.assertTrue(graph.follows(1, 3))
+        self.assertFalse(graph.follows(3, 1))
+        self.assertFalse(graph.follows(99, 1))
+        self.assertEqual(graph.following(1), [2, 3])
+        self.assertEqual(graph.followers(3), [1, 2])
+        self.assertEqual(graph.following_among(1, [3, 4, 99]), {3})
+        self.assertEqual(graph.following_count(1), 2)
+        self.assertEqual(graph.followers_count(3), 2)
+
+    def test_deltas(self):
+        graph = shared_graph()
+
+        record_follow_change(FOLLOW, 3, 1)
+        record_follow_change(UNFOLLOW, 1, 2)
+        # Already in the snapshot or never there: nothing to do.
+        record_follow_change(FOLLOW, 2, 3)
+        record_follow_change(UNFOLLOW, 5, 6)
+
+        self.assertIs(shared_graph(), graph)
+        self.assertTrue(graph.follows(3, 1))
+        self.assertFalse(graph.follows(1, 2))
+        self.assertEqual(graph.following(1), [3])
+        self.assertEqual(graph.followers(1), [3, 4])
+        self.assertEqual(graph.following_count(1), 1)
+        self.assertEqual(graph.followers_count(1), 2)
+        self.assertEqual(graph.followers_count(2), 0)
+
+        record_follow_change(DELETE_USER, 3)
+        shared_graph()
+        self.assertEqual(graph.following(3), [])
+        self.assertEqual(graph.followers(3), [])
+        self.assertEqual(graph.followers_count(1), 1)
+
+    def test_workers_share_files(self):
+        """A second view of the same directory sees the same changes."""
+
+        record_follow_change(FOLLOW, 2, 4)
+
+        other = SharedGraph(self.directory)
+        other.refresh()
+        self.assertTrue(other.follows(2, 4))
+        self.assertEqual(other.followers_count(4), 1)
+
+    def test_refresh_is_rate_limited(self):
+        app.config['FOLLOW_GRAPH_REFRESH_MS'] = 60000
+        graph = shared_graph()
+
+        # Another process's change waits for the next check...
+        with open(os.path.join(self.directory, 'deltas-1.log'), 'ab') as log:
+            log.write(_RECORD.pack(FOLLOW, 3, 4))
+        self.assertFalse(shared_graph().follows(3, 4))
+
+        # ...but this process's own changes show up at once.
+        record_follow_change(FOLLOW, 2, 4)
+        self.assertTrue(shared_graph().follows(3, 4))
+        self.assertTrue(graph.follows(2, 4))
+
+    def test_torn_record_waits(self):
+        graph = shared_graph()
+        with open(os.path.join(self.directory, 'deltas-1.log'), 'ab') as log:
+            log.write(b'\x01\x00')
+
+        graph.refresh()
+        self.assertEqual(graph.following(1), [2, 3])
+
+    def test_no_snapshot(self):
+        app.config['FOLLOW_GRAPH_DIR'] = os.path.join(self.directory, 'none')
+        self.assertIsNone(shared_graph())
+        record_follow_change(FOLLOW, 1, 2)
+
+    def test_needs_single_host(self):
+        app.config['FOLLOW_GRAPH_SINGLE_HOST'] = False
+
+        self.assertIsNone(shared_graph())
+        record_follow_change(FOLLOW, 3, 1)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.directory, 'deltas-1.log')))
+
+    def test_old_snapshot_not_used(self):
+        day_ago = time.time() - 24 * 60 * 60 - 1
+        os.utime(os.path.join(self.directory, 'out_indptr-1.npy'),
+                 (day_ago, day_ago))
+
+        self.assertIsNone(shared_graph())
+
+
+class FollowGraphViewsTestCase(DBTestCase):
+    """Follow routes keep the graph in step with the follows table."""
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        app.config['FOLLOW_GRAPH_DIR'] = self.tmp.name
+        app.config['FOLLOW_GRAPH_SINGLE_HOST'] = True
+
+        self.users = [User.signup(f'graph{i}', f'graph{i}@test.com',
+                                  'password', None)
+                      for i in range(4)]
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+
+        a, b, c, d = self.ids
+        db.session.add_all([Follows(user_following_id=a, user_being_followed_id=b),
+                            Follows(user_following_id=c, user_being_followed_id=a)])
+        db.session.commit()
+        rebuild(self.tmp.name)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = a
+
+    def tearDown(self):
+        app.config['FOLLOW_GRAPH_DIR'] = None
+        app.config['FOLLOW_GRAPH_SINGLE_HOST'] = False
+        app.config['FOLLOW_GRAPH_MAX_DELTAS'] = 100000
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def test_follow_and_unfollow(self):
+        a, b, c, d = self.ids
+
+        self.client.post(f'/users/follow/{d}')
+        self.assertTrue(shared_graph().follows(a, d))
+        self.assertEqual(User.counts_for(d)['followers'], 1)
+
+        self.client.post(f'/users/stop-following/{b}')
+        self.assertFalse(shared_graph().follows(a, b))
+        self.assertEqual(User.counts_for(a)['following'], 1)
+        self.assertIsNone(db.session.get(Follows, (b, a)))
+
+    def test_follow_when_graph_trails_table(self):
+        a, b, c, d = self.ids
+        # Its log record was lost: the table has it, this graph doesn't.
+        db.session.add(Follows(user_following_id=a, user_being_followed_id=c))
+        db.session.commit()
+        self.assertFalse(shared_graph().follows(a, c))
+
+        resp = self.client.post(f'/users/follow/{c}')
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Follows.query.filter_by(user_following_id=a).count(), 2)
+
+    def test_lookups_skip_follows_table(self):
+        a, b, c, d = self.ids
+        user, other = db.session.get(User, a), db.session.get(User, b)
+
+        with record_queries() as stats:
+            self.assertTrue(user.is_following(other))
+            self.assertEqual(user.following_ids(among=[b, c]), {b})
+            self.assertEqual(user.following_ids(), {b})
+        self.assertEqual(stats.count, 0)
+
+    def test_delete_user(self):
+        a, b, c, d = self.ids
+        with self.client.session_transaction() as session:
+            session[CURR_USER_KEY] = c
+
+        self.client.post('/users/delete')
+        self.assertEqual(shared_graph().followers(a), [])
+        self.assertEqual(User.counts_for(a)['followers'], 0)
+
+    def test_rebuild_when_log_is_long(self):
+        a, b, c, d = self.ids
+        app.config['FOLLOW_GRAPH_MAX_DELTAS'] = 2
+
+        self.client.post(f'/users/follow/{c}')
+        self.client.post(f'/users/follow/{d}')
+
+        self.assertEqual(Job.query.filter_by(name='rebuild_follow_graph').count(), 1)
+        graph = shared_graph()
+        self.assertEqual(graph.generation, 2)
+        self.assertEqual(graph.following(a), [b, c, d])
+
+    def test_rebuild_when_log_write_fails(self):
+        a, b, c, d = self.ids
+        log = os.path.join(self.tmp.name, 'deltas-1.log')
+        os.remove(log)
+        os.mkdir(log)
+
+        with self.assertLogs(app.logger, 'ERROR'):
+            self.client.post(f'/users/follow/{c}')
+
+        self.assertEqual(Job.query.filter_by(name='rebuild_follow_graph').count(), 1)
+        self.assertTrue(shared_graph().follows(a, c))
+
+    def test_rebuild_when_snapshot_ages(self):
+        a, b, c, d = self.ids
+        half_day_ago = time.time() - 12 * 60 * 60 - 1
+        os.utime(os.path.join(self.tmp.name, 'out_indptr-1.npy'),
+                 (half_day_ago, half_day_ago))
+
+        self.client.post(f'/users/follow/{c}')
+
+        self.assertEqual(shared_graph().generation, 2)
@@ -0,0 +1,88 @@
+"""Per-request SQL instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import create_engine, text
+
+from instrumentation import (RepeatedQueryError, init_instrumentation,
+                             record_queries, statement_shape)
+
+# The hooks listen on every engine, so a bare app and engine are enough.
+
+engine = create_engine('sqlite://')
+
+app = Flask(__name__)
+app.testing = True
+init_instrumentation(app)
+
+
+@app.route('/repeat')
+def repeat():
+    with engine.connect() as conn:
+        for number in range(3):
+            conn.execute(text("SELECT :number"), {'number': number})
+    return ''
+
+
+class StatementShapeTestCase(TestCase):
+
+    def test_values_collapse(self):
+        self.assertEqual(
+            statement_shape("SELECT * FROM users\n WHERE id IN (?, ?, ?) "
+                            "AND name = 'x' LIMIT 10"),
+            statement_shape("SELECT * FROM users WHERE id IN (?) "
+                            "AND name = 'y' LIMIT 20"))
+
+    def test_postgres_casts_survive(self):
+        self.assertEqual(
+            statement_shape("SELECT %(day)s::date, :bucket, $1"),
+            "SELECT ?::date, ?, ?")
+
+    def test_record_queries(self):
+        with record_queries() as stats, engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            conn.execute(text("SELECT 2"))
+
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.shapes, {"SELECT ?": 2})
+        self.assertEqual(len(stats.slowest), 2)
+
+
+class RequestStatsTestCase(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['SQL_REPEAT_THRESHOLD'] = 10
+        app.config['SQL_REPEAT_RAISE'] = False
+
+    def test_server_timing(self):
+        resp = self.client.get('/repeat')
+
+        timings = resp.headers.getlist('Server-Timing')
+        self.assertEqual(len(timings), 2)
+        self.assertRegex(timings[0], r'^db;dur=[\d.]+;desc="3 queries"$')
+        self.assertRegex(timings[1], r'^app;dur=[\d.]+$')
+
+    def test_repeated_query_warns(self):
+        app.config['SQL_REPEAT_THRESHOLD'] = 2
+
+        with self.assertLogs('warbler.sql', 'WARNING') as logs:
+            self.assertEqual(self.client.get('/repeat').status_code, 200)
+        self.assertIn('ran the same query 3 times (limit 2)', logs.output[-1])
+
+    def test_repeated_query_raises(self):
+        app.config['SQL_REPEAT_THRESHOLD'] = 2
+        app.config['SQL_REPEAT_RAISE'] = True
+
+        with self.assertRaises(RepeatedQueryError):
+            self.client.get('/repeat')
+
+        app.config['SQL_REPEAT_THRESHOLD'] = 3
+        self.assertEqual(self.client.get('/repeat').status_code, 200)
@@ -0,0 +1,129 @@
+"""Job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+from datetime import datetime, timedelta
+
+import jobs
+from jobs import _claim_next, enqueue, job, requeue_stale, run_worker
+from models import db, Job
+from testing import DBTestCase
+
+from app import create_app
+app = create_app('warbler-test', testing=True)
+
+calls = []
+
+
+@job('test_record')
+def record(value):
+    calls.append(value)
+
+
+@job('test_fail')
+def fail():
+    raise RuntimeError("boom")
+
+
+class JobQueueTestCase(DBTestCase):
+    app = app
+
+    def setUp(self):
+        super().setUp()
+        app.config['JOBS_EAGER'] = False
+        calls.clear()
+
+    def tearDown(self):
+        app.config['JOBS_EAGER'] = True
+        super().tearDown()
+
+    def test_claims_in_order(self):
+        first = enqueue('test_record', {'value': 1})
+        second = enqueue('test_record', {'value': 2})
+        enqueue('test_record', {'value': 3}, delay=60)
+        db.session.commit()
+
+        claimed = _claim_next()
+        self.assertEqual(claimed.id, first.id)
+        self.assertEqual((claimed.status, claimed.attempts), ('running', 1))
+        self.assertIsNotNone(claimed.heartbeat_at)
+        self.assertEqual(_claim_next().id, second.id)
+
+        # The delayed job isn't due yet.
+        self.assertIsNone(_claim_next())
+
+    def test_run_worker(self):
+        for value in range(3):
+            enqueue('test_record', {'value': value})
+        db.session.commit()
+
+        self.assertEqual(run_worker(burst=True), 3)
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertEqual({job.status for job in Job.query}, {'done'})
+
+    def test_retry_with_backoff(self):
+        failing = enqueue('test_fail', max_attempts=2)
+        db.session.commit()
+        job_id = failing.id
+
+        run_worker(burst=True)
+        failed = db.session.get(Job, job_id)
+        self.assertEqual((failed.status, failed.attempts), ('queued', 1))
+        self.assertEqual(failed.last_error, "RuntimeError: boom")
+        self.assertGreater(failed.run_at, datetime.utcnow())
+
+        failed.run_at = datetime.utcnow()
+        db.session.commit()
+        run_worker(burst=True)
+        failed = db.session.get(Job, job_id)
+        self.assertEqual((failed.status, failed.attempts), ('failed', 2))
+
+    def test_unknown_handler_fails_normally(self):
+        db.session.add(Job(name='renamed_long_ago', max_attempts=1))
+        db.session.commit()
+
+        self.assertEqual(run_worker(burst=True), 1)
+        lost = Job.query.one()
+        self.assertEqual(lost.status, 'failed')
+        self.assertIn("renamed_long_ago", lost.last_error)
+
+    def test_idempotency_key(self):
+        first = enqueue('test_record', {'value': 1}, idempotency_key='once')
+        again = enqueue('test_record', {'value': 2}, idempotency_key='once')
+        db.session.commit()
+        self.assertEqual(again.id, first.id)
+
+        run_worker(burst=True)
+        self.assertEqual(calls, [1])
+
+        # Once done, the key can be used again.
+        later = enqueue('test_record', {'value': 3}, idempotency_key='once')
+        db.session.commit()
+        self.assertNotEqual(later.id, first.id)
+
+    def test_eager(self):
+        app.config['JOBS_EAGER'] = True
+        eager = enqueue('test_record', {'value': 1})
+
+        self.assertEqual(calls, [1])
+        self.assertEqual((eager.status, eager.attempts), ('done', 1))
+
+    def test_requeue_stale(self):
+        now = datetime.utcnow()
+        lapsed = now - jobs.STALE_AFTER - timedelta(seconds=1)
+        db.session.add_all([
+            Job(name='test_record', status='running', attempts=1,
+                started_at=lapsed, heartbeat_at=lapsed),
+            Job(name='test_record', status='running', attempts=5,
+                max_attempts=5, started_at=lapsed, heartbeat_at=lapsed),
+            # Started long ago, but its worker is still beating.
+            Job(name='test_record', status='running', attempts=1,
+                started_at=lapsed, heartbeat_at=now),
+        ])
+        db.session.commit()
+
+        self.assertEqual(requeue_stale(), 1)
+        self.assertEqual([job.status for job in Job.query.order_by(Job.id)],
+                         ['queued', 'failed', 'running'])
@@ -5,40 +5,27 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
-
 from models import db, User, Message, Follows
 from sqlalchemy import exc
+from testing import DBTestCase
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
+# create_app(testing=True) runs the app against an in-memory SQLite
+# database with its tables already created; see config.TestingConfig.
 
 from app import create_app
 
 app = create_app('warbler-test', testing=True)
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DBTestCase):
     """Test views for messages."""
 
+    app = app
+
     def setUp(self):
         """Create test client, add sample data."""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         u1 = User.signup("test1", "email1@email.com", "password", None)
         u1_id = 11111
@@ -62,9 +49,8 @@ class UserModelTestCase(TestCase):
         self.client = app.test_client()
 
     def tearDown(self):
-        res = super().tearDown()
         db.session.rollback()
-        return res
+        return super().tearDown()
 
     def test_message_model(self):
         """Does basic model work?"""
@@ -2,46 +2,28 @@
 
 # run these tests like:
 #
-#    FLASK_ENV=production python -m unittest test_message_views.py
+#    python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
+from models import db, Message, User
+from testing import DBTestCase
 
-from models import db, connect_db, Message, User
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
+# create_app(testing=True) runs the app against an in-memory SQLite
+# database with its tables already created; see config.TestingConfig.
 
 from app import create_app, CURR_USER_KEY
 app = create_app('warbler-test', testing=True)
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(DBTestCase):
     """Test views for messages."""
 
+    app = app
+
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -107,6 +89,20 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Test Text', html)
 
+    def test_see_message_posted_after_miss(self):
+        """A 404 for a message id isn't remembered once it exists"""
+        with self.client as c:
+            resp = c.get("/messages/12345")
+            self.assertEqual(resp.status_code, 404)
+
+            db.session.add(Message(id=12345, text="Now here",
+                                   user_id=self.testuser_id))
+            db.session.commit()
+
+            resp = c.get("/messages/12345")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Now here", resp.get_data(as_text=True))
+
     def test_delete_message(self):
         """Can we delete a message"""
         with self.client as c:
@@ -0,0 +1,135 @@
+"""Metrics endpoint tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from flask import Flask
+
+import metrics
+from metrics import init_metrics, render
+
+app = Flask(__name__)
+app.testing = True
+init_metrics(app)
+
+
+@app.route('/hello')
+def hello():
+    return 'hello'
+
+
+proxied_app = Flask(__name__)
+proxied_app.config['PROXY_HOPS'] = 1
+init_metrics(proxied_app)
+
+collections = []
+
+
+def queue_gauges():
+    collections.append(1)
+    return [('warbler_test_queued', "Jobs waiting.", {'queue': 'default'}, 3)]
+
+
+class MetricsTestCase(TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.directory = tempfile.mkdtemp(prefix='warbler-metrics-')
+        metrics._last_flush = 0
+
+        # Only our own collector, not whatever the app modules registered.
+        for name, value in (('_collectors', [queue_gauges]), ('_collected', {})):
+            patcher = mock.patch.object(metrics, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        collections.clear()
+
+    def tearDown(self):
+        app.config['METRICS_DIR'] = None
+        app.config['METRICS_TOKEN'] = None
+        shutil.rmtree(self.directory)
+
+    def scrape(self, remote_addr='127.0.0.1', **headers):
+        return self.client.get('/metrics', headers=headers,
+                               environ_base={'REMOTE_ADDR': remote_addr})
+
+    def test_scrape(self):
+        self.client.get('/hello')
+
+        resp = self.scrape()
+        self.assertEqual(resp.status_code, 200)
+        body = resp.get_data(as_text=True)
+        self.assertIn('# TYPE warbler_request_duration_seconds histogram', body)
+        self.assertIn('warbler_request_duration_seconds_count{method="GET",'
+                      'route="/hello"}', body)
+        self.assertIn('warbler_test_queued{queue="default"} 3', body)
+
+    def test_only_allowed_scrapers(self):
+        self.assertEqual(self.scrape('203.0.113.9').status_code, 403)
+
+        app.config['METRICS_TOKEN'] = 'sesame'
+        self.assertEqual(self.scrape('203.0.113.9', Authorization='Bearer nope')
+                         .status_code, 403)
+        self.assertEqual(self.scrape('203.0.113.9', Authorization='Bearer sesame')
+                         .status_code, 200)
+
+    def test_proxied_scrapes_need_token(self):
+        forwarded = {'X-Forwarded-For': '203.0.113.9'}
+        self.assertEqual(self.scrape(**forwarded).status_code, 403)
+
+        app.config['METRICS_TOKEN'] = 'sesame'
+        self.assertEqual(self.scrape(Authorization='Bearer sesame', **forwarded)
+                         .status_code, 200)
+
+    def test_proxy_hops(self):
+        client = proxied_app.test_client()
+
+        def scrape(forwarded_for):
+            return client.get('/metrics',
+                              headers={'X-Forwarded-For': forwarded_for},
+                              environ_base={'REMOTE_ADDR': '10.0.0.2'})
+
+        self.assertEqual(scrape('127.0.0.1').status_code, 200)
+        self.assertEqual(scrape('203.0.113.9').status_code, 403)
+        # Only the last hop is trusted; an address the client added isn't.
+        self.assertEqual(scrape('127.0.0.1, 203.0.113.9').status_code, 403)
+
+    def test_collectors_run_once_per_interval(self):
+        self.scrape()
+        self.scrape()
+        self.assertEqual(len(collections), 1)
+
+        render(max_age=0)
+        self.assertEqual(len(collections), 2)
+
+    def test_flush(self):
+        app.config['METRICS_DIR'] = self.directory
+
+        self.client.get('/hello')
+        self.assertEqual(os.listdir(self.directory),
+                         [f'metrics-{os.getpid()}.json'])
+
+    def test_flush_failure_spares_the_request(self):
+        app.config['METRICS_DIR'] = os.path.join(self.directory, 'gone', 'x')
+
+        with self.assertLogs(app.logger, 'ERROR'):
+            resp = self.client.get('/hello')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_merges_other_processes(self):
+        metrics.inc(metrics.counter('warbler_test_total', "Test counter."), 2)
+
+        # A snapshot left by another worker.
+        with open(os.path.join(self.directory, 'metrics-1.json'), 'w') as other:
+            json.dump({'counters': [['warbler_test_total', [], 5]],
+                       'histograms': []}, other)
+
+        self.assertIn('warbler_test_total 7', render(self.directory))
+        self.assertIn('warbler_test_total 2', render())
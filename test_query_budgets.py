@@ -0,0 +1,96 @@
+"""Query budget tests: routes must not issue more SQL as data grows."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_budgets.py
+
+
+from models import db, User, Message, Follows, Likes
+from testing import DBTestCase, query_budget
+
+from app import create_app, CURR_USER_KEY
+
+app = create_app('warbler-test', testing=True)
+
+
+class QueryBudgetTestCase(DBTestCase):
+    """Each route stays within its budget with few and with many rows."""
+
+    app = app
+
+    def setUp(self):
+        """Create a viewer plus some other users with messages."""
+
+        super().setUp()
+
+        self.client = app.test_client()
+
+        self.viewer = User.signup("viewer", "viewer@test.com", "password", None)
+        self.others = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                       for i in range(20)]
+        db.session.commit()
+
+        for other in self.others:
+            db.session.add(Message(text=f"hello from {other.username}",
+                                   user_id=other.id))
+        db.session.commit()
+
+        self.viewer_id = self.viewer.id
+        self.other_id = self.others[0].id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def grow(self):
+        """Make the viewer follow, be followed by and like many others."""
+
+        for other in self.others:
+            db.session.add(Follows(user_following_id=self.viewer_id,
+                                   user_being_followed_id=other.id))
+            db.session.add(Follows(user_following_id=other.id,
+                                   user_being_followed_id=self.viewer_id))
+        for message in Message.query.all():
+            db.session.add(Likes(user_id=self.viewer_id, message_id=message.id))
+            db.session.add(Message(text="my own", user_id=self.viewer_id))
+        db.session.commit()
+
+    def check_reads(self):
+        with query_budget('homepage'):
+            resp = self.client.get("/")
+        self.assertEqual(resp.status_code, 200)
+
+        with query_budget('users_show'):
+            resp = self.client.get(f"/users/{self.other_id}")
+        self.assertEqual(resp.status_code, 200)
+
+        with query_budget('show_following'):
+            resp = self.client.get(f"/users/{self.viewer_id}/following")
+        self.assertEqual(resp.status_code, 200)
+
+        with query_budget('users_followers'):
+            resp = self.client.get(f"/users/{self.viewer_id}/followers")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_reads_with_empty_graph(self):
+        self.check_reads()
+
+    def test_reads_with_large_graph(self):
+        self.grow()
+        self.check_reads()
+
+    def test_add_like(self):
+        self.grow()
+        message = Message.query.filter_by(user_id=self.other_id).first()
+        Likes.query.filter_by(message_id=message.id).delete()
+        db.session.commit()
+
+        with query_budget('add_like'):
+            resp = self.client.post(f"/users/add_like/{message.id}")
+        self.assertEqual(resp.status_code, 302)
+
+    def test_messages_add(self):
+        self.grow()
+
+        with query_budget('messages_add'):
+            resp = self.client.post("/messages/new", data={"text": "Hello"})
+        self.assertEqual(resp.status_code, 302)
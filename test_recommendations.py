@@ -0,0 +1,126 @@
+"""Friends-of-friends recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+import random
+from collections import Counter
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, Follows, Recommendation, User
+from recommendations import FollowGraph, refresh
+from testing import DBTestCase
+
+from app import create_app, CURR_USER_KEY
+app = create_app('warbler-test', testing=True)
+
+
+def naive_top(edges, user, top_k):
+    """Straightforward version of FollowGraph.top_candidates for one user."""
+
+    follows = {}
+    for source, target in edges:
+        follows.setdefault(source, set()).add(target)
+    in_degree = Counter(target for _, target in edges)
+
+    scores = Counter(candidate
+                     for middle in follows.get(user, ())
+                     for candidate in follows.get(middle, ())
+                     if candidate != user
+                     and candidate not in follows.get(user, ()))
+    ranked = sorted(scores.items(),
+                    key=lambda item: (-item[1], -in_degree[item[0]], item[0]))
+    return ranked[:top_k]
+
+
+class FollowGraphTestCase(TestCase):
+
+    def test_matches_naive_version(self):
+        rng = random.Random(7)
+        edges = sorted({(rng.randrange(1, 60), rng.randrange(1, 60))
+                        for _ in range(600)} - {(i, i) for i in range(60)})
+        array = np.array(edges)
+        graph = FollowGraph(array[:, 0], array[:, 1])
+
+        origin, candidates, scores, ranks = graph.top_candidates(
+            np.arange(graph.size), top_k=5, fanout=graph.size)
+
+        got = {}
+        for user, candidate, score in zip(graph.user_ids[origin],
+                                          graph.user_ids[candidates], scores):
+            got.setdefault(int(user), []).append((int(candidate), int(score)))
+
+        for user in graph.user_ids:
+            self.assertEqual(got.get(int(user), []),
+                             naive_top(edges, int(user), 5))
+
+
+    def test_fanout_cap(self):
+        # 0 follows 1..3, each of which follows 4..6.
+        edges = np.array([(0, m) for m in (1, 2, 3)]
+                         + [(m, c) for m in (1, 2, 3) for c in (4, 5, 6)])
+        graph = FollowGraph(edges[:, 0], edges[:, 1])
+
+        origin, candidates, scores, _ = graph.top_candidates(
+            np.array([0]), top_k=5, fanout=2)
+
+        # Only 1 and 2 are expanded, and only to 4 and 5.
+        self.assertEqual(candidates.tolist(), [4, 5])
+        self.assertEqual(scores.tolist(), [2, 2])
+
+
+class RecommendationsTestCase(DBTestCase):
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                 for i in range(5)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+        a, b, c, d, e = self.ids
+
+        # a follows b and c; both follow d; only c follows e.
+        db.session.add_all([Follows(user_following_id=x, user_being_followed_id=y)
+                            for x, y in [(a, b), (a, c), (b, d), (c, d), (c, e)]])
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = a
+
+    def test_refresh_stores_ranked_candidates(self):
+        with app.app_context():
+            refresh()
+
+        a, b, c, d, e = self.ids
+        rows = (Recommendation.query
+                .filter_by(user_id=a)
+                .order_by(Recommendation.rank)
+                .all())
+        self.assertEqual([(r.candidate_id, r.score) for r in rows],
+                         [(d, 2), (e, 1)])
+
+    def sidebar(self):
+        html = self.client.get('/').get_data(as_text=True)
+        start = html.find('id="who-to-follow"')
+        return html[start:html.find('</aside>', start)] if start >= 0 else ''
+
+    def test_home_sidebar(self):
+        with app.app_context():
+            refresh()
+
+        sidebar = self.sidebar()
+        self.assertIn('@user3', sidebar)
+        self.assertIn('@user4', sidebar)
+        self.assertLess(sidebar.index('@user3'), sidebar.index('@user4'))
+
+        # Following a suggestion takes it off the list straight away.
+        self.client.post(f'/users/follow/{self.ids[3]}')
+        sidebar = self.sidebar()
+        self.assertNotIn('@user3', sidebar)
+        self.assertIn('@user4', sidebar)
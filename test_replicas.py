@@ -0,0 +1,103 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from sqlalchemy import insert
+
+from app import create_app, CURR_USER_KEY
+from models import db, User, Message
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Two SQLite files: the replica is a copy that lags behind."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='warbler-replica-')
+        primary = os.path.join(self.directory, 'primary.db')
+        replica = os.path.join(self.directory, 'replica.db')
+
+        with mock.patch.dict(os.environ, {
+                'TEST_DATABASE_URL': f'sqlite:///{primary}',
+                'DATABASE_REPLICA_URLS': f'sqlite:///{replica}'}):
+            self.app = create_app('warbler-test', testing=True)
+
+        with self.app.app_context():
+            db.metadata.create_all(db.engines['replica-0'])
+            for engine in (db.engine, db.engines['replica-0']):
+                with engine.begin() as conn:
+                    conn.execute(insert(User), [dict(
+                        id=1, username='reader', email='reader@test.com',
+                        password='x')])
+
+            # Only the primary has seen this message so far.
+            db.session.add(Message(text='fresh off the primary', user_id=1))
+            db.session.commit()
+
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_reads_go_to_replica(self):
+        # Cache misses read the primary; see test_cache_fills_read_primary.
+        self.app.config['CACHE_ENABLED'] = False
+
+        resp = self.client.get('/users/1')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('fresh off the primary', resp.get_data(as_text=True))
+
+    def test_unmarked_views_read_primary(self):
+        resp = self.client.get('/users/1/following')
+
+        self.assertEqual(resp.status_code, 200)
+        # The message count comes from the primary.
+        self.assertIn('<a href="/users/1">1</a>', resp.get_data(as_text=True))
+
+    def test_read_your_writes(self):
+        resp = self.client.post('/messages/new', data={'text': 'my own words'})
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.get('/users/1')
+        html = resp.get_data(as_text=True)
+
+        self.assertIn('my own words', html)
+        self.assertIn('fresh off the primary', html)
+
+    def test_pin_expires(self):
+        self.app.config['CACHE_ENABLED'] = False
+
+        self.client.post('/messages/new', data={'text': 'my own words'})
+        with self.client.session_transaction() as sess:
+            sess['db_pinned_until'] = 0
+
+        resp = self.client.get('/users/1')
+
+        self.assertNotIn('my own words', resp.get_data(as_text=True))
+
+    def test_cache_fills_read_primary(self):
+        self.client.get('/users/1')
+        self.client.post('/messages/new', data={'text': 'my own words'})
+
+        # A visitor who isn't pinned refills the cache in a replica view.
+        html = self.app.test_client().get('/users/1').get_data(as_text=True)
+        self.assertIn('my own words', html)
+
+        # Long after their pin, the writer still sees their change.
+        with self.client.session_transaction() as sess:
+            sess['db_pinned_until'] = 0
+        html = self.client.get('/users/1').get_data(as_text=True)
+        self.assertIn('my own words', html)
@@ -0,0 +1,60 @@
+"""Lightweight row tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_rows.py
+
+import pickle
+
+from models import db, Message, User
+from rows import (card_rows, message_rows, select_cards, select_messages,
+                  Author, MessageRow, UserCard)
+from testing import DBTestCase
+
+from app import create_app, CURR_USER_KEY
+app = create_app('warbler-test', testing=True)
+
+
+class RowsTestCase(DBTestCase):
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        db.session.commit()
+        self.message = Message(text="hello rows", user_id=self.author.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_message_rows(self):
+        [row] = message_rows(db.session.execute(select_messages()))
+
+        self.assertIsInstance(row, MessageRow)
+        self.assertEqual(row.id, self.message.id)
+        self.assertEqual(row.text, "hello rows")
+        self.assertEqual(row.user, Author(self.author.id, "author",
+                                          self.author.image_url))
+
+        # No per-instance dict, and safe to put in the cache.
+        self.assertFalse(hasattr(row, '__dict__'))
+        self.assertEqual(pickle.loads(pickle.dumps(row)), row)
+
+    def test_card_rows(self):
+        [card] = card_rows(db.session.execute(select_cards()))
+
+        self.assertIsInstance(card, UserCard)
+        self.assertEqual((card.id, card.username),
+                         (self.author.id, "author"))
+
+    def test_pages_render_rows(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author.id
+
+        for url in ('/', f'/users/{self.author.id}', '/users',
+                    f'/messages/{self.message.id}'):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200, url)
+            self.assertIn("author", resp.get_data(as_text=True), url)
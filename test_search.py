@@ -0,0 +1,72 @@
+"""Message search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+from models import db, Message, User
+from search import fts5_query, search_message_ids
+from testing import DBTestCase
+
+from app import create_app
+app = create_app('warbler-test', testing=True)
+
+
+class SearchTestCase(DBTestCase):
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        user = User.signup("searcher", "search@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        texts = ["warblers sing at dawn",
+                 "a warbler singing warbler songs",
+                 "nothing to see here",
+                 'quotes " and OR operators']
+        self.messages = [Message(text=text, user_id=self.user_id)
+                         for text in texts]
+        db.session.add_all(self.messages)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_ranked_matches(self):
+        ids, has_more = search_message_ids("warbler")
+
+        # Stemming matches "warblers"; the message saying it twice ranks first.
+        self.assertEqual(ids, [self.messages[1].id, self.messages[0].id])
+        self.assertFalse(has_more)
+
+    def test_pagination(self):
+        first, has_more = search_message_ids("warbler", page=1, per_page=1)
+        second, more_after = search_message_ids("warbler", page=2, per_page=1)
+
+        self.assertEqual(first + second,
+                         [self.messages[1].id, self.messages[0].id])
+        self.assertTrue(has_more)
+        self.assertFalse(more_after)
+
+    def test_index_follows_deletes(self):
+        db.session.delete(self.messages[1])
+        db.session.commit()
+
+        ids, _ = search_message_ids("warbler")
+        self.assertEqual(ids, [self.messages[0].id])
+
+    def test_query_syntax_is_plain_text(self):
+        self.assertEqual(fts5_query('a "b'), '"a" """b"')
+
+        ids, _ = search_message_ids('" OR')
+        self.assertEqual(ids, [self.messages[3].id])
+
+    def test_search_view(self):
+        resp = self.client.get("/messages/search?q=sing")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("warblers sing at dawn", html)
+        self.assertIn("@searcher", html)
+        self.assertNotIn("nothing to see here", html)
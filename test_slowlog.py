@@ -0,0 +1,74 @@
+"""Slow query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slowlog.py
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import create_engine
+
+import slowlog
+from slowlog import explain, params_shape, record_slow_query
+
+
+class SlowLogTestCase(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='warbler-slowlog-')
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.directory, 'slow.db')}")
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("CREATE TABLE things (id INTEGER PRIMARY KEY, "
+                                 "name TEXT)")
+
+        self.app = Flask(__name__)
+        self.app.config.update(SLOW_QUERY_MS=50, SLOW_QUERY_SAMPLE_RATE=1,
+                               SLOW_QUERY_MAX_PER_MINUTE=30)
+        slowlog._budget.update(window=0, used=0)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def test_params_shape(self):
+        self.assertEqual(params_shape({'id': 1, 'name': 'x'}),
+                         {'id': 'int', 'name': 'str'})
+        self.assertEqual(params_shape((1,) * 20), "20 x int")
+
+    def test_explain(self):
+        plan = explain(self.engine, "SELECT name FROM things WHERE id = ?", (1,))
+        self.assertIn('USING INTEGER PRIMARY KEY', ' '.join(plan))
+
+    def test_logs_slow_selects_off_the_request_path(self):
+        statement = "SELECT name FROM things WHERE id = ?"
+
+        with self.assertLogs('warbler.slow_queries', 'WARNING') as logs:
+            with self.app.test_request_context(), self.engine.connect() as conn:
+                record_slow_query(conn, statement, (1,), 0.01)
+                record_slow_query(conn, "UPDATE things SET name = ?",
+                                  ('x',), 0.5)
+                record_slow_query(conn, statement, (1,), 0.5)
+            slowlog._pending.join()
+
+        self.assertEqual(len(logs.records), 1)
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual((entry['sql'], entry['ms'], entry['params']),
+                         (statement, 500, ['int']))
+        self.assertIn('USING INTEGER PRIMARY KEY', ' '.join(entry['plan']))
+
+    def test_per_minute_budget(self):
+        self.app.config['SLOW_QUERY_MAX_PER_MINUTE'] = 1
+
+        with self.assertLogs('warbler.slow_queries', 'WARNING') as logs:
+            with self.app.app_context(), self.engine.connect() as conn:
+                for _ in range(3):
+                    record_slow_query(conn, "SELECT 1", (), 0.5)
+            slowlog._pending.join()
+
+        self.assertEqual(len(logs.records), 1)
@@ -0,0 +1,61 @@
+"""SQLite transaction mode tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sqlite.py
+
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy import create_engine
+
+from models import writes
+
+
+class BeginModeTestCase(TestCase):
+    """Only work that writes takes the write lock when it begins."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='warbler-sqlite-')
+        self.path = os.path.join(self.directory, 'warbler.db')
+        self.engine = create_engine(f'sqlite:///{self.path}')
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.directory)
+
+    def locked(self):
+        """Whether a transaction begun now holds the write lock."""
+
+        with self.engine.connect() as conn:
+            with conn.begin():
+                other = sqlite3.connect(self.path, timeout=0,
+                                        isolation_level=None)
+                try:
+                    other.execute("BEGIN IMMEDIATE")
+                    other.execute("ROLLBACK")
+                    return False
+                except sqlite3.OperationalError:
+                    return True
+                finally:
+                    other.close()
+
+    def test_reads_start_deferred(self):
+        self.assertFalse(self.locked())
+
+        app = Flask(__name__)
+        with app.test_request_context('/', method='GET'):
+            self.assertFalse(self.locked())
+
+    def test_writes_start_immediate(self):
+        with writes():
+            self.assertTrue(self.locked())
+        self.assertFalse(self.locked())
+
+        app = Flask(__name__)
+        with app.test_request_context('/', method='POST'):
+            self.assertTrue(self.locked())
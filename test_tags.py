@@ -0,0 +1,84 @@
+"""Tag, mention and trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+from datetime import datetime, timedelta
+
+from instrumentation import record_queries
+from models import db, Message, MessageTag, Mention, TagCount, User
+from tags import bucket_of, extract
+from testing import DBTestCase
+
+from app import create_app, CURR_USER_KEY
+app = create_app('warbler-test', testing=True)
+
+
+class TagsTestCase(DBTestCase):
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@test.com",
+                                  "password", None)
+                      for i in range(3)]
+        db.session.commit()
+        self.user_ids = [user.id for user in self.users]
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_ids[0]
+
+    def post(self, text):
+        self.client.post('/messages/new', data={'text': text})
+        return Message.query.order_by(Message.id.desc()).first()
+
+    def test_extract(self):
+        self.assertEqual(
+            extract("#Flask and #flask, @user1 me@example.com #sql!"),
+            (['flask', 'sql'], ['user1']))
+
+    def test_post_indexes_tags_and_mentions(self):
+        with record_queries() as stats:
+            msg = self.post("hi @user1 @user2 @nobody #python #Python #web")
+
+        self.assertEqual(
+            sorted(tag.tag for tag in MessageTag.query.filter_by(message_id=msg.id)),
+            ['python', 'web'])
+        self.assertEqual(
+            sorted(m.user_id for m in Mention.query.filter_by(message_id=msg.id)),
+            self.user_ids[1:])
+
+        user_lookups = sum(count for shape, count in stats.shapes.items()
+                           if 'FROM users' in shape and 'IN' in shape)
+        self.assertEqual(user_lookups, 1)
+
+    def test_trending_windows(self):
+        self.post("#python #web")
+        self.post("#python")
+
+        # Older uses that only the wider windows see.
+        with app.app_context():
+            old = bucket_of(datetime.utcnow() - timedelta(hours=3))
+        db.session.add(TagCount(tag='sql', bucket=old, count=5))
+        db.session.commit()
+
+        hour = self.client.get('/trending?window=1h').get_json()
+        self.assertEqual(hour['tags'], [{'tag': 'python', 'count': 2},
+                                        {'tag': 'web', 'count': 1}])
+
+        day = self.client.get('/trending?window=24h').get_json()
+        self.assertEqual([t['tag'] for t in day['tags']],
+                         ['sql', 'python', 'web'])
+
+        self.assertEqual(self.client.get('/trending?window=1y').status_code, 400)
+
+    def test_delete_uncounts_tags(self):
+        msg = self.post("#python")
+        self.client.post(f'/messages/{msg.id}/delete')
+
+        resp = self.client.get('/trending?window=1h')
+        self.assertEqual(resp.get_json()['tags'], [])
+        self.assertEqual(MessageTag.query.count(), 0)
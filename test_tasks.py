@@ -0,0 +1,103 @@
+"""Background job handler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tasks.py
+
+from datetime import datetime, timedelta
+
+from models import (db, ArchivedLike, ArchivedMessage, Follows, Likes,
+                    Message, User)
+from tags import index_messages, trending
+from tasks import delete_user
+from testing import DBTestCase
+
+from app import create_app
+app = create_app('warbler-test', testing=True)
+
+
+class DeleteUserTestCase(DBTestCase):
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.gone = User.signup('gone', 'gone@test.com', 'password', None)
+        self.other = User.signup('other', 'other@test.com', 'password', None)
+        db.session.commit()
+        self.gone_id, self.other_id = self.gone.id, self.other.id
+        gone_id, other_id = self.gone_id, self.other_id
+
+        old = datetime.utcnow() - timedelta(days=400)
+        theirs = Message(text='mine', user_id=gone_id)
+        kept = Message(text='yours', user_id=other_id)
+        db.session.add_all([theirs, kept])
+        db.session.add_all([
+            Follows(user_following_id=gone_id, user_being_followed_id=other_id),
+            Follows(user_following_id=other_id, user_being_followed_id=gone_id),
+            ArchivedMessage(id=1000, timestamp=old, text='old mine',
+                            user_id=gone_id),
+            ArchivedMessage(id=1001, timestamp=old, text='old yours',
+                            user_id=other_id),
+        ])
+        db.session.commit()
+        self.kept_id = kept.id
+        db.session.add_all([
+            Likes(user_id=gone_id, message_id=kept.id),
+            Likes(user_id=other_id, message_id=theirs.id),
+            Likes(user_id=other_id, message_id=kept.id),
+            ArchivedLike(user_id=gone_id, message_id=1001),
+            ArchivedLike(user_id=other_id, message_id=1000),
+            ArchivedLike(user_id=other_id, message_id=1001),
+        ])
+        db.session.commit()
+
+    def test_purges_everything(self):
+        app.config['PURGE_BATCH_SIZE'] = 1
+        try:
+            delete_user(self.gone_id)
+        finally:
+            del app.config['PURGE_BATCH_SIZE']
+
+        self.assertIsNone(db.session.get(User, self.gone_id))
+        self.assertEqual(
+            [msg.id for msg in Message.query], [self.kept_id])
+        self.assertEqual(
+            [(like.user_id, like.message_id) for like in Likes.query],
+            [(self.other_id, self.kept_id)])
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual([msg.id for msg in ArchivedMessage.query], [1001])
+        self.assertEqual(
+            [(like.user_id, like.message_id) for like in ArchivedLike.query],
+            [(self.other_id, 1001)])
+
+    def test_uncounts_tags(self):
+        messages = [Message(text='#python #flask', user_id=self.gone_id),
+                    Message(text='#python', user_id=self.gone_id),
+                    Message(text='#python', user_id=self.other_id)]
+        db.session.add_all(messages)
+        db.session.flush()
+        index_messages(messages)
+        db.session.commit()
+
+        app.config['PURGE_BATCH_SIZE'] = 2
+        try:
+            delete_user(self.gone_id)
+        finally:
+            del app.config['PURGE_BATCH_SIZE']
+
+        self.assertEqual(trending('1h'), [{'tag': 'python', 'count': 1}])
+
+    def test_leaves_latest_feed(self):
+        latest_feed = app.extensions['latest_feed']
+        self.assertIn('mine', [row.text for row in latest_feed.rows()])
+
+        delete_user(self.gone_id)
+
+        self.assertEqual([row.text for row in latest_feed.rows()], ['yours'])
+
+    def test_rerun_is_harmless(self):
+        delete_user(self.gone_id)
+        delete_user(self.gone_id)
+
+        self.assertEqual(User.query.count(), 1)
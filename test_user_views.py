@@ -2,43 +2,26 @@
 
 # run these tests like:
 #
-#    FLASK_ENV=production python -m unittest test_user_views.py
+#    python -m unittest test_user_views.py
 
 
-import os
-from unittest import TestCase
+from models import db, Follows, Message, User
+from testing import DBTestCase
 
-from models import db, connect_db, Message, User
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
+# create_app(testing=True) runs the app against an in-memory SQLite
+# database with its tables already created; see config.TestingConfig.
 
 from app import create_app, CURR_USER_KEY
 app = create_app('warbler-test', testing=True)
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
+class UserViewTestCase(DBTestCase):
+    app = app
 
-app.config['WTF_CSRF_ENABLED'] = False
-
-class UserViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -155,6 +138,38 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("newuser", html)
 
+    def test_followers_pages(self):
+        others = [User.signup(username=f"fan{i:02}", email=f"fan{i}@test.com",
+                              password="password", image_url=None)
+                  for i in range(5)]
+        db.session.commit()
+        for other in others:
+            db.session.add(Follows(user_following_id=other.id,
+                                   user_being_followed_id=self.testuser.id))
+        db.session.commit()
+        ids = sorted(other.id for other in others)
+        app.config['FOLLOW_PAGE_SIZE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.get(f"/users/{self.testuser.id}/followers")
+                html = resp.get_data(as_text=True)
+                self.assertIn(f"/users/{ids[0]}\"", html)
+                self.assertIn(f"/users/{ids[1]}\"", html)
+                self.assertNotIn(f"/users/{ids[2]}\"", html)
+                self.assertIn(f"after={ids[1]}", html)
+
+                resp = c.get(f"/users/{self.testuser.id}/followers?after={ids[3]}")
+                html = resp.get_data(as_text=True)
+                self.assertIn(f"/users/{ids[4]}\"", html)
+                self.assertNotIn(f"/users/{ids[3]}\"", html)
+                self.assertNotIn("after=", html)
+        finally:
+            app.config['FOLLOW_PAGE_SIZE'] = 48
+
     def test_update_form(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -185,3 +200,20 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 404)
 
+
+    def test_user_delete_hides_account_before_purge(self):
+        app.config['JOBS_EAGER'] = False
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+                c.get("/users")
+                c.post("/users/delete")
+
+                # The purge hasn't run, but the account is gone already.
+                self.assertIsNotNone(db.session.get(User, self.testuser_id))
+                self.assertEqual(c.get("/users/9999").status_code, 404)
+                self.assertNotIn("testuser", c.get("/users").get_data(as_text=True))
+                self.assertFalse(User.authenticate("testuser", "testuser"))
+        finally:
+            app.config['JOBS_EAGER'] = True
@@ -0,0 +1,92 @@
+"""Helpers shared by the test suite."""
+
+import re
+from contextlib import contextmanager
+from unittest import TestCase
+
+import cache
+from instrumentation import record_queries
+from models import db
+
+# Most SQL statements each route may issue for one request, however many
+# follows, likes or messages are involved. Raise a number here only with a
+# good reason: these are what keep N+1 queries out of the views.
+QUERY_BUDGETS = {
+    'homepage': 4,
+    'users_show': 5,
+    'show_following': 5,
+    'users_followers': 5,
+    'add_like': 4,
+    'messages_add': 2,
+}
+
+
+# SAVEPOINTs come from the test harness's transaction, not from the route.
+_TRANSACTION_CONTROL = re.compile(
+    r'\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.I)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A block of code issued more SQL statements than its budget."""
+
+
+@contextmanager
+def query_budget(route):
+    """Fail if the block issues more statements than QUERY_BUDGETS[route].
+
+        with query_budget('homepage'):
+            client.get('/')
+    """
+
+    budget = QUERY_BUDGETS[route]
+
+    with record_queries() as stats:
+        yield stats
+
+    shapes = {shape: count for shape, count in stats.shapes.items()
+              if not _TRANSACTION_CONTROL.match(shape)}
+    issued = sum(shapes.values())
+
+    if issued > budget:
+        listing = '\n\n'.join(f"{count} x {shape}"
+                               for shape, count in shapes.items())
+        raise QueryBudgetExceeded(
+            f"{route} issued {issued} queries (budget {budget}):\n\n"
+            f"{listing}")
+
+
+class DBTestCase(TestCase):
+    """TestCase whose database changes are rolled back after every test.
+
+    Set `app` to an app made with create_app(..., testing=True). Each test
+    runs inside its own app context, on one connection with an open
+    transaction; commits made by the test or by requests through the test
+    client only release SAVEPOINTs, and tearDown rolls the lot back. No
+    table wipes are needed between tests. The cache and the latest feed
+    start empty too.
+    """
+
+    app = None
+
+    def setUp(self):
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        cache.clear()
+        self.app.extensions['latest_feed'].clear()
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+
+        db.session.remove()
+        self.session_options = dict(db.session.session_factory.kw)
+        db.session.configure(bind=self.connection,
+                             join_transaction_mode='create_savepoint')
+
+    def tearDown(self):
+        db.session.remove()
+        db.session.session_factory.kw.clear()
+        db.session.session_factory.kw.update(self.session_options)
+
+        self.transaction.rollback()
+        self.connection.close()
+        self.app_context.pop()